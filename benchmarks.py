@@ -0,0 +1,822 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010-2024  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+"""Benchmarks for the tcollector core.
+
+Run all of them with ./benchmarks.py, or only some of them by passing their
+names on the command line, e.g. ./benchmarks.py reader.
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+import tcollector
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Registers a benchmark, named after the function minus 'bench_'."""
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def cpu_time():
+    """Returns the user+system CPU time used so far by this process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, pct):
+    """Returns the given percentile of a list of numbers."""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def report(name, **results):
+    print("%-24s %s" % (name, "  ".join("%s=%s" % (k, v) for k, v in results.items())))
+
+
+def write_collector(tmpdir, name, body):
+    """Writes an executable Python collector and returns its path."""
+    filename = os.path.join(tmpdir, name)
+    with open(filename, "w") as f:
+        f.write("#!%s\n%s" % (sys.executable, body))
+    os.chmod(filename, 0o755)
+    return filename
+
+
+# Emits one line every PERIOD seconds whose value is the time it was written.
+LATENCY_COLLECTOR = """
+import sys, time
+PERIOD = %f
+while True:
+    now = time.time()
+    sys.stdout.write("bench.latency %%d %%f\\n" %% (now, now))
+    sys.stdout.flush()
+    time.sleep(PERIOD)
+"""
+
+
+def stop_collectors():
+    """Kills all the collectors started by a benchmark, without the
+       per-collector grace period of Collector.shutdown()."""
+    cols = list(tcollector.all_living_collectors())
+    for col in cols:
+        tcollector.kill(col.proc)
+    for col in cols:
+        col.proc.wait()
+        col.proc = None
+    tcollector.COLLECTORS.clear()
+
+
+def run_reader(poller, filenames, duration):
+    """Runs a ReaderThread over the given collectors for some time and
+       returns (latencies, wakeups, reads, empty reads, cpu seconds)."""
+    tcollector.ALIVE = True
+    tcollector.POLLER = poller
+    tcollector.COLLECTORS.clear()
+    latencies = []
+    reads = [0, 0]  # [total, empty]
+    reader = tcollector.ReaderThread(0, 10, False, poller=poller)
+    process_line = reader.process_line
+
+    def timed_process_line(col, line, flush=True):
+        sent = float(line.split()[2])
+        # Lines written while the collectors were starting up and before
+        # the reader was running don't tell us anything.
+        if sent >= start_time:
+            latencies.append(time.time() - sent)
+        process_line(col, line, flush)
+    reader.process_line = timed_process_line
+
+    class CountingCollector(tcollector.Collector):
+        def read(self, size=-1):
+            before = len(self.datalines)
+            super(CountingCollector, self).read(size)
+            reads[0] += 1
+            if len(self.datalines) == before:
+                reads[1] += 1
+
+    for filename in filenames:
+        col = CountingCollector(os.path.basename(filename), 0, filename)
+        tcollector.register_collector(col)
+        tcollector.spawn_collector(col)
+
+    start_cpu = cpu_time()
+    start_time = time.time()
+    reader.start()
+    time.sleep(duration)
+    tcollector.ALIVE = False
+    if poller is not None:
+        poller.wakeup()
+    reader.join()
+    cpu = cpu_time() - start_cpu
+    stop_collectors()
+    tcollector.POLLER = None
+    return latencies, reader.wakeups, reads[0], reads[1], cpu
+
+
+@benchmark
+def bench_reader(duration=10):
+    """Read latency, wakeups and reads of the polling vs. select()-based
+       reader, with busy, sparse and completely idle collectors."""
+    for scenario, collectors, period in (("busy", 50, 0.5), ("sparse", 200, 5),
+                                         ("idle", 200, 3600)):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filenames = [write_collector(tmpdir, "c%d.py" % i, LATENCY_COLLECTOR % period)
+                         for i in range(collectors)]
+            for mode, poller in (("poll", None), ("select", tcollector.CollectorPoller())):
+                latencies, wakeups, reads, empty_reads, cpu = run_reader(poller, filenames,
+                                                                         duration)
+                report("reader[%s,%s]" % (scenario, mode),
+                       lines=len(latencies),
+                       p50_ms="%.1f" % (percentile(latencies, 50) * 1000),
+                       p99_ms="%.1f" % (percentile(latencies, 99) * 1000),
+                       wakeups=wakeups,
+                       reads=reads,
+                       empty_reads=empty_reads,
+                       cpu_s="%.2f" % cpu)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class FakePipe:
+    """A non-blocking pipe that hands out the given chunks, then None."""
+
+    def __init__(self, chunks):
+        self.chunks = deque(chunks)
+
+    def read(self, size=-1):
+        if self.chunks:
+            return self.chunks.popleft()
+        return None
+
+
+class FakeProc:
+    def __init__(self, stdout_chunks):
+        self.stdout = FakePipe(stdout_chunks)
+        self.stderr = FakePipe([])
+
+
+def legacy_collect(chunks):
+    """The str-based framing Collector.read()/collect() used to do."""
+    buf = ""
+    datalines = []
+    for chunk in chunks:
+        buf += chunk
+        while buf:
+            idx = buf.find('\n')
+            if idx == -1:
+                break
+            line = buf[0:idx].strip()
+            if line:
+                datalines.append(line)
+            buf = buf[idx + 1:]
+    while datalines:
+        yield datalines.pop(0)
+
+
+def burst(lines, chunk_size=65536):
+    """Returns the chunks a reader gets for a burst of that many lines."""
+    data = b"".join(b"proc.stat.cpu %d %d cpu=%d type=user\n" % (1700000000, i, i % 256)
+                    for i in range(lines))
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+@benchmark
+def bench_framing():
+    """Splitting large bursts of collector output into lines."""
+    for lines in (1000, 10000, 50000):
+        chunks = burst(lines)
+        start = time.time()
+        count = sum(1 for _ in legacy_collect([c.decode("utf-8") for c in chunks]))
+        legacy = time.time() - start
+        assert count == lines, count
+
+        col = tcollector.Collector("bench", 0, "bench")
+        col.proc = FakeProc(chunks)
+        start = time.time()
+        count = 0
+        # Like the reader does, pick up lines after each chunk is read.
+        while col.proc.stdout.chunks:
+            count += sum(1 for _ in col.collect())
+        current = time.time() - start
+        assert count == lines, count
+        report("framing[%d lines]" % lines,
+               legacy_ms="%.1f" % (legacy * 1000),
+               current_ms="%.1f" % (current * 1000),
+               speedup="%.1fx" % (legacy / current))
+
+
+def legacy_parse(line):
+    """What ReaderThread.process_line() used to do to validate a line."""
+    line = ' '.join(line.split())
+    if len(line) >= 1024:
+        return None
+    parsed = re.match(r'^([-_./a-zA-Z0-9]+)\s+'
+                      r'(\d+\.?\d+)\s+'
+                      r'(\S+?)'
+                      r'((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$',
+                      line)
+    if parsed is None:
+        return None
+    metric, timestamp, value, tags = parsed.groups()
+    if isinstance(value, str) and value.lower() == 'true':
+        value = 1
+    if isinstance(value, str) and value.lower() == 'false':
+        value = 0
+    try:
+        float(value)
+    except:  # pylint:disable=bare-except
+        return None
+    return metric, timestamp, value, tags
+
+
+def current_parse(parser, line):
+    """The same validation as legacy_parse(), with a DatapointParser."""
+    line = ' '.join(line.split())
+    if len(line) >= 1024:
+        return None
+    parsed = parser.parse(line)
+    if parsed is None:
+        return None
+    metric, timestamp, value, tags = parsed
+    if value[0] in 'tTfF':
+        value = tcollector.BOOLEAN_VALUES.get(value.lower(), value)
+    try:
+        float(value)
+    except ValueError:
+        return None
+    return metric, timestamp, value, tags
+
+
+class NullQueue:
+    """Stands in for the reader queue when we only care about parsing."""
+
+    def nput(self, value):  # pylint:disable=unused-argument
+        return True
+
+    def put_batch(self, lines):  # pylint:disable=unused-argument
+        return 0
+
+
+@benchmark
+def bench_parser(lines=200000):
+    """Lines/sec going through ReaderThread.process_line, before and after
+       the DatapointParser fast path."""
+    rand = random.Random(42)
+    corpus = ["proc.stat.cpu %d %d cpu=%d type=%s host=web%02d"
+              % (1700000000 + i, rand.randint(0, 10 ** 6), i % 64,
+                 rand.choice(("user", "system", "idle")), i % 10)
+              for i in range(lines)]
+    # A few oddities for good measure.
+    for i in range(0, lines, 100):
+        corpus[i] = rand.choice(("iostat.disk.read_requests 1700000000 True dev=sda",
+                                 "bad metric line", "net.bytes 1700000000 12 iface=eth0  "))
+    col = tcollector.Collector("bench", 0, "bench")
+
+    start = time.time()
+    legacy_ok = sum(1 for line in corpus if legacy_parse(line) is not None)
+    legacy = time.time() - start
+
+    parser = tcollector.DatapointParser()
+    start = time.time()
+    current_ok = sum(1 for line in corpus if current_parse(parser, line) is not None)
+    current = time.time() - start
+    assert legacy_ok == current_ok, (legacy_ok, current_ok)
+
+    # And the whole of process_line(), without dedup.
+    reader = tcollector.ReaderThread(0, 10, False)
+    reader.readerq = NullQueue()
+    start = time.time()
+    for line in corpus:
+        reader.process_line(col, line)
+    process_line = time.time() - start
+    assert legacy_ok == col.lines_received - col.lines_invalid, (legacy_ok, col.lines_invalid)
+    report("parser[%d lines]" % lines,
+           legacy_lps="%d" % (lines / legacy),
+           current_lps="%d" % (lines / current),
+           process_line_lps="%d" % (lines / process_line),
+           fast_path="%.1f%%" % (100.0 * parser.fast_parsed / lines))
+
+
+def series_lines(series):
+    """Lines for that many distinct series, looking like procstats output."""
+    metrics = ["proc.stat.cpu", "proc.meminfo.memfree", "iostat.disk.read_requests",
+               "net.stat.tcp.retransmit", "proc.net.bytes"]
+    return ["%s 1700000000 %d host=web%02d cpu=%d type=user"
+            % (metrics[i % len(metrics)], i, i % 50, i // len(metrics))
+            for i in range(series)]
+
+
+@benchmark
+def bench_dedup_memory(series=200000):
+    """Memory used by the dedup cache, with the old tuple-per-series layout
+       and with DedupStore."""
+    lines = series_lines(series)
+    col = tcollector.Collector("procstats.py", 0, "procstats.py")
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    values = {}
+    for line in lines:
+        metric, timestamp, value, tags = legacy_parse(line)
+        values[(metric, tags)] = (value, False, line, float(timestamp))
+    legacy = tracemalloc.get_traced_memory()[0] - start
+    del values
+
+    reader = tcollector.ReaderThread(300, 600, False)
+    reader.readerq = NullQueue()
+    start = tracemalloc.get_traced_memory()[0]
+    for line in lines:
+        reader.process_line(col, line)
+    current = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    report("dedup_memory[%d series]" % series,
+           legacy_bytes_per_series=legacy // series,
+           current_bytes_per_series=current // series,
+           estimated_bytes_per_series=reader.dedup.bytes // series)
+
+
+@benchmark
+def bench_eviction(series=500000, evictinterval=6000):
+    """Longest reader stall while evicting old dedup keys: the old full scan
+       vs. the bucketed index, when 1/64th of the series have expired."""
+    now = 1700000000
+    legacy = {}
+    store = tcollector.DedupStore(bucket_width=evictinterval // tcollector.EVICTION_BUCKETS)
+    for i in range(series):
+        timestamp = now - evictinterval * i / series
+        key = store.make_key("procstats.py", "proc.stat.cpu", " cpu=%d" % i)
+        legacy[("proc.stat.cpu", " cpu=%d" % i)] = ("1", False, "line", timestamp)
+        store.put(key, "1", timestamp, str(int(timestamp)))
+    cut_off = now - evictinterval * (1 - 1.0 / tcollector.EVICTION_BUCKETS)
+
+    start = time.time()
+    for key in list(legacy):
+        if legacy[key][3] < cut_off:
+            del legacy[key]
+    legacy_stall = time.time() - start
+
+    stalls = []
+    done = False
+    while not done:
+        start = time.time()
+        done = store.evict_old_keys(cut_off, tcollector.EVICTION_BATCH_SIZE)
+        stalls.append(time.time() - start)
+    report("eviction[%d series]" % series,
+           legacy_stall_ms="%.1f" % (legacy_stall * 1000),
+           current_max_stall_ms="%.1f" % (max(stalls) * 1000),
+           current_total_ms="%.1f" % (sum(stalls) * 1000),
+           iterations=len(stalls),
+           evicted=series - len(store))
+
+
+class FakeTSDHandler(BaseHTTPRequestHandler):
+    """Accepts anything posted to it, keeping the connection open."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def legacy_http_send(url, body):
+    """What send_data_via_http() used to do: a new connection per batch."""
+    req = Request(url)
+    req.add_header("Content-Type", "application/json")
+    urlopen(req, body).read()
+
+
+@benchmark
+def bench_http(duration=5, points=100):
+    """Batches/sec sent to a local fake TSD, with a new connection per batch
+       and with the keep-alive HTTPConnectionPool."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTSDHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+    body = json.dumps([{"metric": metric, "timestamp": int(timestamp), "value": float(value),
+                        "tags": dict(tag.split("=") for tag in tags)}
+                       for metric, timestamp, value, *tags in
+                       (line.split() for line in series_lines(points))]).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    pool = tcollector.HTTPConnectionPool()
+
+    def run(send):
+        sent = 0
+        start = time.time()
+        while time.time() - start < duration:
+            send()
+            sent += 1
+        return sent / (time.time() - start)
+
+    try:
+        legacy = run(lambda: legacy_http_send("http://127.0.0.1:%d/api/put" % port, body))
+        current = run(lambda: pool.request("127.0.0.1", port, "POST", "/api/put", body, headers))
+    finally:
+        pool.close_all()
+        server.shutdown()
+        server.server_close()
+    report("http[%d points/batch]" % points,
+           legacy_batches_per_sec="%d" % legacy,
+           current_batches_per_sec="%d" % current,
+           connects=pool.connects)
+
+
+def legacy_put_body(lines, tags):
+    """What send_data_via_http() used to do to build its request."""
+    metrics = []
+    for line in lines:
+        parts = line.split(None, 3)
+        if len(parts) == 4:
+            (metric, timestamp, value, raw_tags) = parts
+        else:
+            (metric, timestamp, value) = parts
+            raw_tags = ""
+        metric_tags = {}
+        for tag in raw_tags.strip().split():
+            (tag_key, tag_value) = tag.split("=", 1)
+            metric_tags[tag_key] = tag_value
+        metric_entry = {}
+        metric_entry["metric"] = metric
+        metric_entry["timestamp"] = int(timestamp)
+        metric_entry["value"] = float(value)
+        metric_entry["tags"] = dict(tags).copy()
+        metric_entry["tags"].update(metric_tags)
+        metrics.append(metric_entry)
+    return json.dumps(metrics).encode("utf-8")
+
+
+@benchmark
+def bench_put_encoder(points=100000):
+    """Points/sec encoded into /api/put requests, with a dict per point and
+       json.dumps(), and with the PutEncoder."""
+    tags = [("dc", "eu-west-1"), ("env", "prod")]
+    lines = series_lines(points)
+
+    start = time.time()
+    legacy_body = legacy_put_body(lines, tags)
+    legacy = time.time() - start
+
+    encoder = tcollector.PutEncoder(tags, 8)
+    start = time.time()
+    current_body = encoder.encode(lines)
+    current = time.time() - start
+    assert json.loads(legacy_body) == json.loads(current_body)
+
+    tracemalloc.start()
+    legacy_put_body(lines, tags)
+    legacy_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    tracemalloc.start()
+    encoder.encode(lines)
+    current_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    report("put_encoder[%d points]" % points,
+           legacy_pps="%d" % (points / legacy),
+           current_pps="%d" % (points / current),
+           legacy_peak_mb="%.1f" % (legacy_peak / 1e6),
+           current_peak_mb="%.1f" % (current_peak / 1e6),
+           body_mb="%.1f/%.1f" % (len(legacy_body) / 1e6, len(current_body) / 1e6))
+
+
+@benchmark
+def bench_handoff(lines=1000000, batch=1000):
+    """Lines/sec handed from the ReaderThread to the SenderThread, one at a
+       time through a queue.Queue and in batches through the ReaderQueue."""
+    corpus = series_lines(batch)
+
+    def run(produce, consume):
+        done = []
+        consumer = threading.Thread(target=lambda: done.append(consume()))
+        start = time.time()
+        consumer.start()
+        for _ in range(lines // batch):
+            produce()
+        consumer.join()
+        assert done == [lines], done
+        return lines / (time.time() - start)
+
+    legacy_q = queue.Queue(tcollector.MAX_READQ_SIZE)
+
+    def legacy_produce():
+        for line in corpus:
+            legacy_q.put(line)  # Blocks rather than drop, to compare like with like.
+
+    def legacy_consume():
+        count = 0
+        while count < lines:
+            legacy_q.get(True, 5)
+            count += 1
+            while count < lines:
+                try:
+                    legacy_q.get(False)
+                except queue.Empty:
+                    break
+                count += 1
+        return count
+
+    current_q = tcollector.ReaderQueue(tcollector.MAX_READQ_SIZE)
+
+    def current_produce():
+        while current_q.points + batch > current_q.max_points:
+            time.sleep(0.001)  # Don't drop either.
+        current_q.put_batch(list(corpus))
+
+    def current_consume():
+        count = 0
+        while count < lines:
+            count += len(current_q.get_batch(tcollector.MAX_SENDQ_SIZE, 5))
+        return count
+
+    report("handoff[%d lines]" % lines,
+           legacy_lps="%d" % run(legacy_produce, legacy_consume),
+           current_lps="%d" % run(current_produce, current_consume))
+
+
+# Reads /proc like most collectors do, either once or every PERIOD seconds.
+PROC_COLLECTOR = """
+import sys, time
+
+PERIOD = %f
+
+
+def main():
+    while True:
+        with open("/proc/loadavg") as f:
+            values = f.read().split()
+        now = int(time.time())
+        for i, name in enumerate(("1m", "5m", "15m")):
+            print("bench.load %%d %%s period=%%s" %% (now, values[i], name))
+        sys.stdout.flush()
+        if not PERIOD:
+            return 0
+        time.sleep(PERIOD)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+"""
+
+
+def rss_kb(pid="self"):
+    """Returns the resident set size of the given process, in KB."""
+    with open("/proc/%s/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def children_cpu_time():
+    """Returns the user+system CPU time used by our reaped children."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@benchmark
+def bench_in_process(collectors=20, runs=10):
+    """Memory used by long-lived collectors, and CPU and time it takes to
+       run interval collectors, as subprocesses vs. in our own process."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for mode in ("subprocess", "in_process"):
+            names = ["%s%d.py" % (mode, i) for i in range(collectors)]
+            if mode == "in_process":
+                cdir = os.path.join(os.path.dirname(os.path.abspath(tcollector.__file__)),
+                                    "collectors", "enabled")
+                tcollector.setup_in_process_collectors(names + ["once_" + name for name in names],
+                                                       cdir)
+            tcollector.ALIVE = True
+            base_rss = rss_kb()
+            cols = []
+            for name in names:
+                col = tcollector.Collector(name, 0, write_collector(tmpdir, name,
+                                                                   PROC_COLLECTOR % 1))
+                tcollector.register_collector(col)
+                tcollector.spawn_collector(col)
+                cols.append(col)
+            time.sleep(2)
+            lines = sum(len(list(col.collect())) for col in cols)
+            rss = rss_kb() - base_rss
+            if mode == "subprocess":
+                rss += sum(rss_kb(col.proc.pid) for col in cols)
+            stop_collectors()
+
+            cols = [tcollector.Collector("once_" + name, 60,
+                                         write_collector(tmpdir, "once_" + name,
+                                                         PROC_COLLECTOR % 0))
+                    for name in names]
+            start_cpu = cpu_time() + children_cpu_time()
+            start = time.time()
+            for _ in range(runs):
+                for col in cols:
+                    tcollector.spawn_collector(col)
+                for col in cols:
+                    col.proc.wait()
+                    lines += len(list(col.collect()))
+                    col.proc = None
+            elapsed = time.time() - start
+            cpu = cpu_time() + children_cpu_time() - start_cpu
+            assert lines >= collectors * 3 * (runs + 1), lines
+            report("in_process[%s]" % mode,
+                   rss_mb="%.1f" % (rss / 1024.0),
+                   interval_runs=collectors * runs,
+                   run_ms="%.2f" % (elapsed * 1000 / (collectors * runs)),
+                   cpu_ms_per_run="%.2f" % (cpu * 1000 / (collectors * runs)))
+    finally:
+        tcollector.IN_PROCESS_COLLECTORS.clear()
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def bench_zygote(collectors=10, runs=10):
+    """Spawn latency, run time and CPU of interval collectors importing
+       what they commonly do, started from scratch vs. forked by a zygote."""
+    tmpdir = tempfile.mkdtemp()
+    # So that they can import collectors.lib, as with setup_python_path().
+    python_path = os.environ.get("PYTHONPATH")
+    os.environ["PYTHONPATH"] = os.path.dirname(os.path.abspath(tcollector.__file__))
+    try:
+        body = ("import http.client, json\nfrom collectors.lib import utils\n"
+                + PROC_COLLECTOR % 0)
+        cols = [tcollector.Collector("c%d.py" % i, 300,
+                                     write_collector(tmpdir, "c%d.py" % i, body))
+                for i in range(collectors)]
+        for mode in ("exec", "zygote"):
+            if mode == "zygote":
+                tcollector.ZYGOTE = tcollector.Zygote()
+                # Let it get its imports done.
+                col = cols[0]
+                tcollector.spawn_collector(col)
+                col.proc.wait()
+                col.proc = None
+            latencies = []
+            start_cpu = cpu_time() + children_cpu_time()
+            start = time.time()
+            for _ in range(runs):
+                for col in cols:
+                    tcollector.spawn_collector(col)
+                    latencies.append(col.spawn_latency)
+                for col in cols:
+                    assert col.proc.wait() == 0
+                    col.proc = None
+            elapsed = time.time() - start
+            if mode == "zygote":
+                # Its children's CPU time only counts once it's reaped.
+                tcollector.ZYGOTE.stop()
+                tcollector.ZYGOTE = None
+            cpu = cpu_time() + children_cpu_time() - start_cpu
+            report("zygote[%s]" % mode,
+                   spawn_p50_ms="%.2f" % (percentile(latencies, 50) * 1000),
+                   spawn_p99_ms="%.2f" % (percentile(latencies, 99) * 1000),
+                   run_ms="%.1f" % (elapsed * 1000 / (collectors * runs)),
+                   cpu_ms_per_run="%.1f" % (cpu * 1000 / (collectors * runs)))
+    finally:
+        tcollector.ZYGOTE = None
+        if python_path is None:
+            del os.environ["PYTHONPATH"]
+        else:
+            os.environ["PYTHONPATH"] = python_path
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def bench_watch(collectors=500, scans=20, changes=20):
+    """What it costs to rescan the collector directory, and how long a
+       change takes to be picked up by a DirectoryWatcher."""
+    cdir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(cdir, "60"))
+        for i in range(collectors):
+            write_collector(os.path.join(cdir, "60"), "c%d.py" % i, "")
+        start_cpu = cpu_time()
+        start = time.time()
+        for _ in range(scans):
+            tcollector.populate_collectors(cdir)
+        scan = (time.time() - start) / scans
+        scan_cpu = (cpu_time() - start_cpu) / scans
+        report("watch[scan]", collectors=collectors,
+               scan_ms="%.2f" % (scan * 1000), scan_cpu_ms="%.2f" % (scan_cpu * 1000),
+               cpu_ms_per_hour_every_15s="%.0f" % (scan_cpu * 1000 * 3600 / 15),
+               cpu_ms_per_hour_every_300s="%.0f" % (scan_cpu * 1000 * 3600 / 300))
+
+        options = tcollector.parse_cmdline(["tcollector.py", "-c", cdir])[0]
+        watcher = tcollector.DirectoryWatcher()
+        tcollector.watch_collector_dirs(watcher, cdir)
+        latencies = []
+        for i in range(changes):
+            start = time.time()
+            write_collector(os.path.join(cdir, "60"), "new%d.py" % i, "")
+            while "new%d.py" % i not in tcollector.COLLECTORS:
+                tcollector.apply_watch_events(watcher.wait(1), options, {}, None, {})
+            latencies.append(time.time() - start)
+        watcher.close()
+        report("watch[inotify]",
+               pickup_p50_ms="%.2f" % (percentile(latencies, 50) * 1000),
+               pickup_p99_ms="%.2f" % (percentile(latencies, 99) * 1000))
+    finally:
+        tcollector.COLLECTORS.clear()
+        shutil.rmtree(cdir)
+
+
+# A long-lived collector which does what they commonly do before their first
+# datapoint: import a few modules.
+STARTUP_COLLECTOR = """
+import http.client, json, sys, time
+print("bench.up %d 1" % time.time())
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+
+@benchmark
+def bench_startup(collectors=80):
+    """Time to first datapoint of long-lived collectors started all at once
+       vs. in waves, and how many of them are starting at the same time."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filenames = [write_collector(tmpdir, "c%d.py" % i, STARTUP_COLLECTOR)
+                     for i in range(collectors)]
+        for concurrency in (0, 8):
+            tcollector.SCHEDULER = tcollector.Scheduler("bench", concurrency)
+            for i, filename in enumerate(filenames):
+                tcollector.register_collector(tcollector.Collector("c%d.py" % i, 0, filename))
+            start = time.time()
+            peak = 0
+            while True:
+                tcollector.spawn_children()
+                for col in tcollector.all_living_collectors():
+                    list(col.collect())
+                cols = list(tcollector.all_collectors())
+                peak = max(peak, sum(1 for col in cols
+                                     if col.proc is not None and not col.first_datapoint))
+                if all(col.first_datapoint for col in cols):
+                    break
+                time.sleep(0.005)
+            elapsed = time.time() - start
+            ttfd = [col.first_datapoint - col.firstspawn for col in cols]
+            stop_collectors()
+            report("startup[concurrency=%d]" % concurrency,
+                   all_up_ms="%.0f" % (elapsed * 1000),
+                   ttfd_p50_ms="%.1f" % (percentile(ttfd, 50) * 1000),
+                   ttfd_p99_ms="%.1f" % (percentile(ttfd, 99) * 1000),
+                   peak_starting=peak)
+    finally:
+        tcollector.SCHEDULER = None
+        shutil.rmtree(tmpdir)
+
+
+def main(argv):
+    # Keep the collectors' complaints from drowning the results.
+    tcollector.LOG.setLevel(logging.CRITICAL)
+    names = argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.stderr.write("No such benchmark: %s (choose from %s)\n"
+                             % (name, ", ".join(sorted(BENCHMARKS))))
+            return 1
+    for name in names:
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -77,6 +77,32 @@ def get_defaults():
         "monitoring_interface": None,
         "monitoring_port": 13280,
         "namespace_prefix": "",
+        "reader_mode": "poll",
+        "dedup_max_bytes": 0,
+        "spool_dir": None,
+        "spool_max_bytes": 1024 * 1024 * 1024,
+        "spool_fsync": "segment",
+        "spool_replay_rate": 10000,
+        "http_gzip_level": 0,
+        "http_gzip_min_bytes": 1024,
+        "flush_max_points": 10000,
+        "flush_max_bytes": 1024 * 1024,
+        "flush_min_linger": 1.0,
+        "flush_max_linger": 5.0,
+        "shards": 0,
+        "send_rate_points": 0,
+        "send_rate_bytes": 0,
+        "reconnect_jitter": 0,
+        "collector_priorities": ("dfstat=high,ifstat=high,iostat=high,netstat=high,"
+                                 "procstats=high,sysload=high,graphite_bridge=low,"
+                                 "jolokia=low,prometheus=low,tcp_bridge=low,"
+                                 "udp_bridge=low,zabbix_bridge=low"),
+        "overload": "drop",
+        "pipe_size": 0,
+        "in_process_collectors": "",
+        "zygote": False,
+        "rescan_interval": 300,
+        "startup_concurrency": 0,
     }
 
     return defaults
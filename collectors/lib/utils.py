@@ -24,6 +24,15 @@ import sys
 
 # If we're running as root and this user exists, we'll drop privileges.
 USER = "nobody"
+# Set by tcollector when it runs collectors in its own process rather than
+# as subprocesses, see --in-process-collectors.
+IN_PROCESS = False
+
+
+class NeedsOwnProcess(Exception):
+    """Raised by drop_privileges() when we run in the tcollector process as
+       root: its privileges aren't ours to drop, and we mustn't keep them,
+       so tcollector has to run us as a subprocess instead."""
 
 
 def drop_privileges(user=USER):
@@ -36,6 +45,8 @@ def drop_privileges(user=USER):
     if os.getuid() != 0:
         return
 
+    if IN_PROCESS:
+        raise NeedsOwnProcess('cannot drop privileges in the tcollector process')
     os.setgid(ent.pw_gid)
     os.setuid(ent.pw_uid)
 
@@ -250,6 +250,7 @@ class TcollectorAgent(eossdk.AgentHandler,
       tcollector.setup_python_path(TCOLLECTOR_PATH)
       self.tags_["host"] = self._get_hostname()
       modules = tcollector.load_etc_dir(options, self.tags_)
+      tcollector.setup_collector_priorities(options)
 
       reader = tcollector.ReaderThread(options.dedupinterval,
                                        options.evictinterval,
@@ -20,29 +20,45 @@
 # by Mark Smith <msmith@stumbleupon.com>.
 #
 
+import array
 import atexit
+import bisect
+import ctypes
 import errno
 import fcntl
+import gzip
+import hashlib
+import heapq
+import http.client
 import logging
+import math
 import os
 import random
 import re
+import runpy
+import selectors
 import signal
 import socket
+import ssl
+import struct
 import subprocess
 import sys
+import termios
 import threading
 import time
+import traceback
+import weakref
 import json
 import base64
 
+from json.encoder import encode_basestring_ascii
 from optparse import OptionParser
 
 import importlib
-from queue import Queue, Empty, Full
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError, URLError
+import importlib.util
+from queue import Empty
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict, deque
 from collections.abc import Callable
 
 # global variables.
@@ -62,6 +78,194 @@ MAX_REASONABLE_TIMESTAMP = 2209212000  # Good until Tue  3 Jan 14:00:00 GMT 2040
 ALLOWED_INACTIVITY_TIME = 600  # seconds
 MAX_SENDQ_SIZE = 10000
 MAX_READQ_SIZE = 100000
+MAX_READQ_BYTES = 32 * 1024 * 1024
+# What happens when a queue is full: either we drop lines, or we stop reading
+# from the collectors until there's room again, so that they block writing
+# to their pipes instead.  The lines we drop are logged in a summary at most
+# once every DROP_LOG_INTERVAL.
+OVERLOAD_MODES = ('drop', 'backpressure')
+DROP_LOG_INTERVAL = 10  # seconds
+# Collectors are in one of these priority classes, from the most to the
+# least important.  When the reader queue is backed up, the sender takes
+# lines from each class in proportion to its weight, and when it's full,
+# the lines of the least important classes are dropped first.
+PRIORITY_WEIGHTS = OrderedDict([('high', 4), ('normal', 2), ('low', 1)])
+DEFAULT_PRIORITY = 'normal'
+DEFAULT_COLLECTOR_PRIORITIES = ('dfstat=high,ifstat=high,iostat=high,netstat=high,'
+                                'procstats=high,sysload=high,graphite_bridge=low,'
+                                'jolokia=low,prometheus=low,tcp_bridge=low,'
+                                'udp_bridge=low,zabbix_bridge=low')
+# Maps collector names, with or without their extension, to their priority
+# class, from --collector-priorities.
+COLLECTOR_PRIORITIES = {}
+# When the ReaderThread waits on a selector, it still wakes up at least this
+# often so that it notices ALIVE being flipped by code that doesn't go through
+# shutdown() (e.g. when tcollector is embedded in the EOS agent).
+MAX_READER_SLEEP = 10  # seconds
+# How many lines, and bytes of them, the ReaderThread reads from a collector
+# before moving on to the next one, so that a chatty collector can't keep
+# the others waiting while their pipes fill up.
+READ_BUDGET_LINES = 10000
+READ_BUDGET_BYTES = 1024 * 1024
+# The CollectorPoller used by the ReaderThread when --reader-mode=select.
+POLLER = None
+# The size of the stdout pipes of the collectors we spawn, from --pipe-size,
+# or 0 to leave them alone.  F_SETPIPE_SZ is only in the fcntl module as of
+# Python 3.10.
+PIPE_SIZE = 0
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+# Python collectors, by name with or without extension, that we run in
+# threads of our own process rather than as subprocesses, from
+# --in-process-collectors.  Their threads hand what they print over to the
+# reader when they flush stdout or every IN_PROCESS_BATCH_LINES lines, and
+# wait while more than IN_PROCESS_MAX_BACKLOG of their lines haven't been
+# read yet, as they would on a full pipe.
+IN_PROCESS_COLLECTORS = set()
+IN_PROCESS_BATCH_LINES = 1000
+IN_PROCESS_MAX_BACKLOG = 10000
+# The modules of the in-process collectors, by filename, with the time they
+# were last modified when we imported them.
+IN_PROCESS_MODULES = {}
+IN_PROCESS_LOCK = threading.Lock()
+# The last CollectorThread of each in-process collector that we gave up
+# waiting for, by filename.
+ABANDONED_THREADS = {}
+# What collectors.lib.utils.drop_privileges() raises in an in-process
+# collector when we run as root, once setup_in_process_collectors() has
+# imported it.  Such a collector is run as a subprocess instead.
+IN_PROCESS_REFUSED = ()
+# With --zygote, the Python interval collectors are forked by this Zygote,
+# which imported the modules they commonly use beforehand, rather than each
+# run starting a new interpreter.  It's restarted when one of those modules
+# changes.  We give up on it if it doesn't answer within ZYGOTE_TIMEOUT.
+ZYGOTE = None
+ZYGOTE_PRELOAD = ('collectors.lib.utils', 'collectors.lib.hadoop_http', 'errno', 'glob',
+                  'http.client', 'json', 'platform', 're', 'signal', 'socket',
+                  'subprocess', 'urllib.request')
+ZYGOTE_TIMEOUT = 5  # seconds
+# The exit status of a child of the zygote that exited after the zygote
+# itself was gone, which we have no way to know.
+UNKNOWN_EXIT_STATUS = 'unknown'
+# The Scheduler that tells main_loop when each collector is due, set up by
+# setup_scheduler().  Interval collectors run at an offset into each interval
+# derived from the host and collector names, so that neither the collectors of
+# one host nor the same collector across hosts all run at once.  Unless
+# --startup-concurrency is set, one that has never run starts within
+# SCHEDULE_SPREAD seconds rather than waiting for its slot.  Those due within
+# SCHEDULE_JITTER seconds of each other are started together.
+SCHEDULER = None
+SCHEDULE_SPREAD = 15  # seconds
+SCHEDULE_JITTER = 0.25  # seconds
+# How often main_loop looks for new collectors and changed config modules,
+# unless a DirectoryWatcher tells it about them as they happen, in which case
+# it only rescans them every --rescan-interval in case it missed some.
+HOUSEKEEPING_INTERVAL = 15  # seconds
+# The events of inotify(7) the DirectoryWatcher asks for, and those it gets
+# on top of them.
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# How long a collector marked dead waits before we give it another chance.
+DEAD_COLLECTOR_RETRY = 3600  # seconds
+# How long we wait after a collector exited for the ReaderThread to read what
+# it printed, in case something it started keeps its stdout open.
+REAP_GRACE = 5  # seconds
+# With --startup-concurrency=N, collectors that have never run are started in
+# waves of at most N, long-lived ones first and then by priority class.  One
+# is done starting once it has sent a datapoint or exited, or after
+# STARTUP_TIMEOUT.  main_loop checks on them every
+# STARTUP_POLL_INTERVAL while some are waiting.
+STARTUP_TIMEOUT = 5  # seconds
+STARTUP_POLL_INTERVAL = 0.1  # seconds
+# The dedup cache indexes series in about this many buckets spanning the
+# evict interval, and evicts at most EVICTION_BATCH_SIZE series per
+# iteration of the ReaderThread.
+EVICTION_BUCKETS = 64
+EVICTION_BATCH_SIZE = 10000
+# Boolean values some collectors send, and what we convert them to.
+BOOLEAN_VALUES = {'true': 1, 'false': 0}
+# Size of the files the SenderThread spools datapoints to while the TSD is
+# unreachable.
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+# How long to wait for the TSD when sending data over HTTP.
+HTTP_TIMEOUT = 60  # seconds
+# A batch of datapoints that isn't full waits for more for this many times
+# as long as it takes to send one, and we keep the latency of this many
+# batches to report its percentiles.
+LINGER_RTT_RATIO = 10
+RTT_EWMA_WEIGHT = 0.2
+FLUSH_LATENCY_SAMPLES = 1000
+# How long the TSD has to answer a version command before we give up on the
+# connection, and how many metrics we keep count of TSD errors for.
+TSD_RESPONSE_TIMEOUT = 15  # seconds
+MAX_TSD_ERROR_METRICS = 100
+# With --shards, how many points each shard gets on the hash ring, and how
+# long a shard can be disconnected before its series go to the others.
+SHARD_VNODES = 100
+SHARD_FAILOVER_DELAY = 30  # seconds
+# How the SenderThread scores the TSDs it can pick from: a host's latency
+# (connect time, version and HTTP round trips) is a moving average, and so
+# is its error rate, each error making it look up to HOST_ERROR_PENALTY
+# times slower.  Hosts scoring within HOST_SCORE_TOLERANCE of the best one
+# are taken in turn.  A blacklisted host gets another chance after
+# BLACKLIST_TIME, and then looks SLOW_START_PENALTY times slower, less and
+# less so over SLOW_START_TIME.
+HEALTH_EWMA_WEIGHT = 0.3
+HOST_ERROR_PENALTY = 10
+HOST_SCORE_TOLERANCE = 1.5
+BLACKLIST_TIME = 300  # seconds
+SLOW_START_PENALTY = 4
+SLOW_START_TIME = 300  # seconds
+# How long we remember what the TSD host names resolve to, or that they
+# don't, and how we connect to their addresses: a new attempt starts every
+# CONNECT_RACE_DELAY, or as soon as one fails, and each of them gives up
+# after CONNECT_TIMEOUT.
+DNS_CACHE_TTL = 300  # seconds
+DNS_NEGATIVE_TTL = 30  # seconds
+CONNECT_RACE_DELAY = 0.25  # seconds
+CONNECT_TIMEOUT = 3  # seconds
+# The rate limits of the SenderThread let through this many seconds' worth
+# of datapoints at once.
+RATE_LIMIT_BURST = 1  # seconds
+
+
+def collector_priority(name):
+    """Returns the priority class of the collector with the given name."""
+    if name in COLLECTOR_PRIORITIES:
+        return COLLECTOR_PRIORITIES[name]
+    return COLLECTOR_PRIORITIES.get(os.path.splitext(name)[0], DEFAULT_PRIORITY)
+
+
+def parse_collector_priorities(value):
+    """Parses a comma separated list of collector=class pairs into a dict.
+       Raises ValueError if it's not valid."""
+    priorities = {}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        name, sep, priority = pair.strip().partition('=')
+        if not sep or not name or priority not in PRIORITY_WEIGHTS:
+            raise ValueError('invalid collector priority %r, expected name=%s'
+                             % (pair, '|'.join(PRIORITY_WEIGHTS)))
+        priorities[name] = priority
+    return priorities
+
+
+def setup_collector_priorities(options):
+    """Sets up COLLECTOR_PRIORITIES from --collector-priorities.  Anything
+       running the main_loop needs to call this, not only main()."""
+    COLLECTOR_PRIORITIES.clear()
+    COLLECTOR_PRIORITIES.update(parse_collector_priorities(options.collector_priorities))
 
 
 def register_collector(collector):
@@ -78,20 +282,268 @@ def register_collector(collector):
             col.shutdown()
 
     COLLECTORS[collector.name] = collector
-
-
-class ReaderQueue(Queue):
-    """A Queue for the reader thread"""
+    if SCHEDULER is not None:
+        SCHEDULER.add(collector)
+
+
+class QueueLane:
+    """The lines of one priority class in the ReaderQueue, in batches,
+       oldest first."""
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.batches = deque()
+        self.points = 0
+        self.bytes = 0
+        self.dropped = 0  # Lines of this class we had to drop.
+
+    def append(self, lines, nbytes):
+        self.batches.append(lines)
+        self.points += len(lines)
+        self.bytes += nbytes
+
+    def take(self, max_points, max_bytes=None, oversize=True):
+        """Removes and returns up to max_points lines, oldest first, and no
+           more than max_bytes bytes of them, unless oversize is true and the
+           first line alone is bigger."""
+        lines = []
+        nbytes = 0
+        while self.batches and len(lines) < max_points:
+            batch = self.batches[0]
+            room = max_points - len(lines)
+            if max_bytes is not None:
+                for i in range(min(room, len(batch))):
+                    if nbytes + len(batch[i]) > max_bytes and (lines or i or not oversize):
+                        room = i
+                        break
+                    nbytes += len(batch[i])
+                if not room:
+                    break
+            if len(batch) <= room:
+                self.batches.popleft()
+            else:
+                self.batches[0] = batch[room:]
+                batch = batch[:room]
+            if lines:
+                lines.extend(batch)
+            else:
+                lines = batch
+        self.points -= len(lines)
+        self.bytes -= sum(len(line) for line in lines)
+        return lines
+
+    def shed(self, points, nbytes):
+        """Drops the oldest lines until at least points lines and nbytes
+           bytes are gone, or there are none left, and returns them."""
+        dropped = []
+        size = 0
+        while self.batches and (len(dropped) < points or size < nbytes):
+            batch = self.batches[0]
+            i = 0
+            while i < len(batch) and (len(dropped) + i < points or size < nbytes):
+                size += len(batch[i])
+                i += 1
+            dropped.extend(batch[:i])
+            if i == len(batch):
+                self.batches.popleft()
+            else:
+                self.batches[0] = batch[i:]
+        self.points -= len(dropped)
+        self.bytes -= size
+        self.dropped += len(dropped)
+        return dropped
+
+
+class ReaderQueue:
+    """A Queue for the reader thread.
+
+       The ReaderThread hands lines over in batches and the SenderThread
+       takes them out in batches, so that we take the lock once per batch
+       rather than once per line.  The queue holds at most max_points lines
+       and max_bytes bytes of them.
+
+       Lines are kept in a lane per priority class (see PRIORITY_WEIGHTS).
+       When the queue is backed up, each lane gets a share of every batch
+       taken out in proportion to its weight, and when it's full, the lines
+       of the least important lanes are dropped to make room for the more
+       important ones.
+
+       With overload='backpressure', nothing is ever dropped: whoever fills
+       the queue is expected to check is_full() and to stop producing until
+       there's room again, so the queue can go over its limits by as much as
+       was handed over in the meantime."""
+
+    def __init__(self, max_points, max_bytes=MAX_READQ_BYTES, overload='drop'):
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.backpressure = overload == 'backpressure'
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.lanes = OrderedDict((priority, QueueLane(weight))
+                                 for priority, weight in PRIORITY_WEIGHTS.items())
+        self.points = 0
+        self.bytes = 0
+        # Lines dropped since we last logged about it, and when we can next.
+        self.unlogged_drops = 0
+        self.next_drop_log = 0
+
+    def put_batch(self, lines, priority=DEFAULT_PRIORITY):
+        """Adds a list of lines of the given priority class to the queue, or
+           as many of them as fit, without blocking.  The ones that don't fit,
+           or that we dropped from less important lanes to make room, are
+           discarded.  Returns how many lines were dropped."""
+        if not lines:
+            return 0
+        lane = self.lanes[priority]
+        nbytes = sum(len(line) for line in lines)
+        dropped = []
+        summary = None
+        with self.not_empty:
+            # Make room by shedding the least important lines first.
+            for victim in reversed(self.lanes.values()):
+                if victim is lane or self.backpressure:
+                    break
+                excess_points = self.points + len(lines) - self.max_points
+                excess_bytes = self.bytes + nbytes - self.max_bytes
+                if excess_points <= 0 and excess_bytes <= 0:
+                    break
+                if victim.points:
+                    shed = victim.shed(excess_points, excess_bytes)
+                    self.points -= len(shed)
+                    self.bytes -= sum(len(line) for line in shed)
+                    dropped.extend(shed)
+            if not self.backpressure and (self.points + len(lines) > self.max_points
+                                          or self.bytes + nbytes > self.max_bytes):
+                nbytes = 0
+                for i, line in enumerate(lines):
+                    if (self.points + i >= self.max_points
+                            or self.bytes + nbytes + len(line) > self.max_bytes):
+                        break
+                    nbytes += len(line)
+                else:
+                    i = len(lines)
+                lane.dropped += len(lines) - i
+                dropped.extend(lines[i:])
+                lines = lines[:i]
+            if lines:
+                lane.append(lines, nbytes)
+                self.points += len(lines)
+                self.bytes += nbytes
+                self.not_empty.notify()
+            if dropped:
+                self.unlogged_drops += len(dropped)
+                now = time.time()
+                if now >= self.next_drop_log:
+                    summary = self.unlogged_drops
+                    self.unlogged_drops = 0
+                    self.next_drop_log = now + DROP_LOG_INTERVAL
+        # Logging every line we drop would only slow us down further.
+        if summary:
+            LOG.error('Queue full, dropped %d lines since the last report, e.g.: %s',
+                      summary, dropped[-1])
+        if dropped and LOG.isEnabledFor(logging.DEBUG):
+            for line in dropped:
+                LOG.debug("DROPPED LINE: %s", line)
+        return len(dropped)
+
+    def is_full(self, pending=0):
+        """Returns whether the queue is full, or would be with that many
+           more lines."""
+        return self.points + pending >= self.max_points or self.bytes >= self.max_bytes
+
+    def wait_for_room(self, timeout):
+        """Waits up to timeout seconds for the queue not to be full, and
+           returns whether it isn't."""
+        with self.not_full:
+            if self.is_full():
+                self.not_full.wait(timeout)
+            return not self.is_full()
 
     def nput(self, value):
         """A nonblocking put, that simply logs and discards the value when the
            queue is full, and returns false if we dropped."""
-        try:
-            self.put(value, False)
-        except Full:
-            LOG.error("DROPPED LINE: %s", value)
-            return False
-        return True
+        return not self.put_batch([value])
+
+    def get_batches(self, max_points=None, timeout=None, max_bytes=None):
+        """Removes up to max_points lines (all of them if None), and no more
+           than max_bytes bytes of them unless the first line alone is
+           bigger.  If the queue is empty, waits up to timeout seconds
+           (forever if None) for some.  Returns an OrderedDict mapping each
+           priority class, most important first, to its lines, oldest first.
+
+           Each lane first gets a share of max_points in proportion to its
+           weight, then what's left goes to the most important lanes."""
+        with self.not_empty:
+            if timeout is None:
+                while not self.points:
+                    self.not_empty.wait()
+            elif timeout > 0:
+                deadline = time.time() + timeout
+                while not self.points:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            if max_points is None:
+                max_points = self.points
+            result = OrderedDict()
+            lanes = [(priority, lane) for priority, lane in self.lanes.items() if lane.points]
+            total_weight = sum(lane.weight for _, lane in lanes)
+            taken = 0
+            nbytes = 0
+            for fair_share in (True, False):
+                for priority, lane in lanes:
+                    room = max_points - taken
+                    if room <= 0:
+                        break
+                    if fair_share:
+                        room = min(room, max(1, max_points * lane.weight // total_weight))
+                    lane_bytes = lane.bytes
+                    lines = lane.take(room, None if max_bytes is None else max_bytes - nbytes,
+                                      oversize=not taken)
+                    if not lines:
+                        continue
+                    size = lane_bytes - lane.bytes
+                    taken += len(lines)
+                    nbytes += size
+                    self.points -= len(lines)
+                    self.bytes -= size
+                    if priority in result:
+                        result[priority].extend(lines)
+                    else:
+                        result[priority] = lines
+            if result:
+                self.not_full.notify_all()
+            return result
+
+    def get_batch(self, max_points=None, timeout=None, max_bytes=None):
+        """Like get_batches(), but returns a single list of lines, the most
+           important ones first.  Returns an empty list if there were none."""
+        batches = list(self.get_batches(max_points, timeout, max_bytes).values())
+        if len(batches) == 1:
+            return batches[0]
+        return [line for batch in batches for line in batch]
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns a single line, like Queue.get()."""
+        lines = self.get_batch(1, timeout if block else 0)
+        if not lines:
+            raise Empty
+        return lines[0]
+
+    def qsize(self):
+        return self.points
+
+    def dropped(self):
+        """Returns how many lines we dropped, by priority class."""
+        return OrderedDict((priority, lane.dropped) for priority, lane in self.lanes.items())
+
+    def to_json(self):
+        """Expose the state of each lane in JSON-serializable format."""
+        return OrderedDict((priority, {"weight": lane.weight, "queued": lane.points,
+                                       "bytes": lane.bytes, "dropped": lane.dropped})
+                           for priority, lane in self.lanes.items())
 
 
 class Collector:
@@ -101,42 +553,60 @@ class Collector:
        collector and gives us utility methods for working with
        it."""
 
+    # Whether the ReaderThread should queue up each line as soon as it
+    # reads it, rather than all of those it got in one go.
+    flush_each_line = False
+
     def __init__(self, colname, interval, filename, mtime=0, lastspawn=0):
         """Construct a new Collector."""
         self.name = colname
+        self.priority = collector_priority(colname)
         self.interval = interval
         self.filename = filename
         self.lastspawn = lastspawn
         self.proc = None
         self.nextkill = 0
         self.killstate = 0
+        # When the Scheduler next looks at this collector, and how late it
+        # was to start its last run, in seconds.
+        self.nextdue = 0
+        self.schedule_lag = 0
+        self.exited = 0  # When we noticed its process had exited.
+        # When we first started it, and when it first sent us a datapoint.
+        self.firstspawn = 0
+        self.first_datapoint = 0
         self.dead = False
         self.mtime = mtime
         self.generation = GENERATION
-        self.buffer = ""
-        self.datalines = []
-        # Maps (metric, tags) to (value, repeated, line, timestamp) where:
-        #  value: Last value seen.
-        #  repeated: boolean, whether the last value was seen more than once.
-        #  line: The last line that was read from that collector.
-        #  timestamp: Time at which we saw the value for the first time.
-        # This dict is used to keep track of and remove duplicate values.
-        # Since it might grow unbounded (in case we see many different
-        # combinations of metrics and tags) someone needs to regularly call
-        # evict_old_keys() to remove old entries.
-        self.values = {}
+        # Bytes of a line we've only read part of so far.
+        self.buffer = bytearray()
+        # Complete lines waiting to be picked up by collect().
+        self.datalines = deque()
+        # Set once we've read EOF on the corresponding pipe, so that the
+        # CollectorPoller can stop watching it before the process is reaped.
+        self.stdout_eof = False
+        self.stderr_eof = False
         self.lines_sent = 0
         self.lines_received = 0
         self.lines_invalid = 0
         self.last_datapoint = int(time.time())
-
-    def read(self):
+        self.bytes_read = 0
+        # Whether the last collect() stopped short of reading everything,
+        # and how many times that happened.
+        self.over_budget = False
+        self.budget_exhausted = 0
+        self.spawn_latency = 0  # How long the last spawn took, in seconds.
+
+    def read(self, size=-1):
         """Read bytes from our subprocess and store them in our temporary
-           line storage buffer.  This needs to be non-blocking."""
+           line storage buffer, at most size bytes of stdout if it's not
+           negative.  This needs to be non-blocking."""
 
-        # we have to use a buffer because sometimes the collectors
-        # will write out a bunch of data points at one time and we
-        # get some weird sized chunk.  This read call is non-blocking.
+        if isinstance(self.proc, CollectorThread):
+            # It hands its lines over to us itself, and may be waiting for
+            # us to take those it already did.
+            self.proc.lines_taken()
+            return
 
         # now read stderr for log messages, we could buffer here but since
         # we're just logging the messages, I don't care to
@@ -145,69 +615,142 @@ class Collector:
             if out:
                 LOG.debug('reading %s got %d bytes on stderr',
                           self.name, len(out))
-                for line in out.splitlines():
+                for line in out.decode('utf-8', 'replace').splitlines():
                     LOG.warning('%s: %s', self.name, line)
+            elif out == b'':
+                self.stderr_eof = True
         except IOError as exc:
             if exc.errno != errno.EAGAIN:
                 raise
-        except TypeError as exc:
-            # Sometimes the underlying buffer.read() returns None
-            pass
         except:
             LOG.exception('uncaught exception in stderr read')
 
         # we have to use a buffer because sometimes the collectors will write
         # out a bunch of data points at one time and we get some weird sized
-        # chunk.  This read call is non-blocking.
+        # chunk.  This read call is non-blocking and returns None when there
+        # is nothing to read.
         try:
-            self.buffer += self.proc.stdout.read()
-            if len(self.buffer):
-                LOG.debug('reading %s, buffer now %d bytes',
-                          self.name, len(self.buffer))
+            if size < 0:
+                out = self.proc.stdout.read()
+            else:
+                out = self.proc.stdout.read(size)
         except IOError as exc:
             if exc.errno != errno.EAGAIN:
                 raise
+            return
         except AttributeError:
             # sometimes the process goes away in another thread and we don't
             # have it anymore, so log an error and bail
             LOG.exception('caught exception, collector process went away while reading stdout')
-        except TypeError as exc:
-            # Sometimes the underlying buffer.read() returns None
-            pass
+            return
         except:
             LOG.exception('uncaught exception in stdout read')
             return
 
-        # iterate for each line we have
-        while self.buffer:
-            idx = self.buffer.find('\n')
-            if idx == -1:
-                break
-
-            # one full line is now found and we can pull it out of the buffer
-            line = self.buffer[0:idx].strip()
-            if line:
-                self.datalines.append(line)
-                self.last_datapoint = int(time.time())
-            self.buffer = self.buffer[idx + 1:]
+        if out == b'':
+            self.stdout_eof = True
+        if out:
+            self.bytes_read += len(out)
+            self.frame_lines(out)
+
+    def frame_lines(self, data):
+        """Splits the bytes read from the collector into lines, and queues
+           up the complete ones in self.datalines.  Whatever follows the last
+           newline is kept in self.buffer until the rest of it shows up."""
+
+        end = data.rfind(b'\n')
+        if end == -1:
+            self.buffer += data
+            LOG.debug('reading %s, buffer now %d bytes',
+                      self.name, len(self.buffer))
+            return
 
-    def collect(self):
+        # Only copy the data into our buffer if there is a partial line to
+        # complete, which is not the common case.
+        if self.buffer:
+            self.buffer += memoryview(data)[:end]
+            chunk = self.buffer
+        else:
+            chunk = memoryview(data)[:end]
+        lines = [line for line in map(str.strip, str(chunk, 'utf-8', 'replace').split('\n'))
+                 if line]
+        self.buffer = bytearray(memoryview(data)[end + 1:])
+        if lines:
+            self.add_lines(lines)
+
+    def add_lines(self, lines):
+        """Queues up complete lines for collect()."""
+        self.datalines.extend(lines)
+        now = time.time()
+        self.last_datapoint = int(now)
+        if not self.first_datapoint:
+            self.first_datapoint = now
+
+    def collect(self, max_lines=0, max_bytes=0):
         """Reads input from the collector and returns the lines up to whomever
            is calling us.  This is a generator that returns a line as it
-           becomes available."""
+           becomes available.
+
+           If max_lines or max_bytes are set, stops once it has returned that
+           many lines or read that many bytes, and sets self.over_budget:
+           the rest is left for the next call."""
 
+        self.over_budget = False
+        lines = 0
+        start = self.bytes_read
         while self.proc is not None:
-            self.read()
-            if not len(self.datalines):
-                return
-            while len(self.datalines):
-                yield self.datalines.pop(0)
+            if max_lines and lines >= max_lines:
+                break
+            if not self.datalines:
+                if max_bytes:
+                    budget = max_bytes - (self.bytes_read - start)
+                    if budget <= 0:
+                        break
+                    self.read(budget)
+                else:
+                    self.read()
+                if not self.datalines:
+                    # Having used up the budget doesn't mean there's nothing
+                    # left, e.g. in the buffer of self.proc.stdout, which the
+                    # CollectorPoller can't see.
+                    if max_bytes and self.bytes_read - start >= max_bytes:
+                        break
+                    return
+            lines += 1
+            yield self.datalines.popleft()
+        if self.proc is not None:
+            self.over_budget = True
+            self.budget_exhausted += 1
+
+    def has_unread_output(self):
+        """Whether the ReaderThread may not have all of its lines yet."""
+        if self.datalines:
+            return True
+        return not isinstance(self.proc, CollectorThread) and not self.stdout_eof
+
+    def pipe_backlog(self):
+        """Returns how many bytes are waiting for us in the stdout pipe."""
+        if self.proc is None or self.proc is True:
+            return 0
+        try:
+            data = fcntl.ioctl(self.proc.stdout.fileno(), termios.FIONREAD, b'\0\0\0\0')
+        except (AttributeError, OSError, ValueError):
+            return 0  # The process went away.
+        return struct.unpack('i', data)[0]
 
     def shutdown(self):
         """Cleanly shut down the collector"""
 
         if not self.proc:
             return
+        if POLLER is not None:
+            POLLER.unregister(self)
+        if isinstance(self.proc, CollectorThread):
+            # There's no telling when it'll be done with a sleep(), so stop
+            # it without waiting.
+            kill(self.proc, signal.SIGKILL)
+            self.proc = None
+            return
         try:
             if self.proc.poll() is None:
                 kill(self.proc)
@@ -224,26 +767,324 @@ class Collector:
             # we really don't want to die as we're trying to exit gracefully
             LOG.exception('ignoring uncaught exception while shutting down')
 
-    def evict_old_keys(self, cut_off):
+    def to_json(self):
+        """Expose collector information in JSON-serializable format."""
+        result = {}
+        for attr in ["name", "mtime", "lastspawn", "killstate", "nextkill",
+                     "nextdue", "lines_sent", "lines_received", "lines_invalid",
+                     "last_datapoint", "dead", "priority", "bytes_read",
+                     "budget_exhausted"]:
+            result[attr] = getattr(self, attr)
+        result["in_process"] = runs_in_process(self)
+        result["spawn_latency_ms"] = self.spawn_latency * 1000
+        result["schedule_lag_ms"] = self.schedule_lag * 1000
+        result["time_to_first_datapoint_ms"] = None
+        if self.first_datapoint:
+            result["time_to_first_datapoint_ms"] = (self.first_datapoint - self.firstspawn) * 1000
+        result["lines_backlog"] = len(self.datalines)
+        result["pipe_backlog_bytes"] = self.pipe_backlog()
+        return result
+
+
+class Scheduler:
+    """Keeps a heap of when each collector next needs spawn_children() to
+       look at it: when it's due to run, when to kill it if it overstayed
+       its welcome, or when to give it another chance after it died.  Each
+       collector only has one pending entry; any older ones, or those of
+       collectors that have since been replaced, are skipped.  Collectors
+       that have never run wait for their turn to start, see
+       start_next_wave()."""
+
+    def __init__(self, host=None, concurrency=0):
+        self.host = host or socket.gethostname()
+        self.heap = []
+        self.seq = 0  # Breaks ties between entries due at the same time.
+        # How many collectors may be starting for the first time at once,
+        # or 0 for no limit.  Those waiting for their turn are in a heap of
+        # their startup_order(), those starting map to when they're done.
+        self.concurrency = concurrency
+        self.waiting = []
+        self.starting = {}
+
+    def phase(self, col):
+        """Returns the offset into each of its intervals at which `col` runs."""
+        digest = hashlib.md5(('%s/%s' % (self.host, col.name)).encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 * col.interval
+
+    def next_slot(self, col, after):
+        """Returns the first time from `after` on at which `col` is due."""
+        return after + (self.phase(col) - after) % col.interval
+
+    def add(self, col, now=None):
+        """Schedules the first run of a newly registered collector."""
+        if now is None:
+            now = time.time()
+        if self.concurrency and not col.lastspawn:
+            col.nextdue = 0
+            self.seq += 1
+            heapq.heappush(self.waiting, (self.startup_order(col), self.seq, col))
+            return
+        if not col.interval:
+            # Don't restart a long-lived collector that keeps exiting in a
+            # tight loop; it waits for the next housekeeping pass instead.
+            when = max(now, col.lastspawn + HOUSEKEEPING_INTERVAL)
+        elif col.lastspawn:
+            # It's a new run of the same collector, which keeps its slot.
+            when = self.next_slot(col, max(col.lastspawn + col.interval / 2, now))
+        else:
+            when = now + (self.next_slot(col, now) - now) % min(col.interval, SCHEDULE_SPREAD)
+        self.schedule(col, when)
+
+    def schedule(self, col, when):
+        """Has spawn_children() look at `col` again at `when`."""
+        col.nextdue = when
+        self.seq += 1
+        heapq.heappush(self.heap, (when, self.seq, col))
+
+    def pop_due(self, now):
+        """Returns the (time it was due, collector) of those due by `now`."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, col = heapq.heappop(self.heap)
+            if col.nextdue == when and COLLECTORS.get(col.name) is col:
+                col.nextdue = 0
+                due.append((when, col))
+        return due
+
+    def next_due(self):
+        """Returns when the next collector is due, or None if none is."""
+        due = None
+        while self.heap:
+            when, _, col = self.heap[0]
+            if col.nextdue == when and COLLECTORS.get(col.name) is col:
+                due = when
+                break
+            heapq.heappop(self.heap)
+        if self.waiting:
+            check = time.time() + STARTUP_POLL_INTERVAL
+            due = check if due is None else min(due, check)
+        return due
+
+    @staticmethod
+    def startup_order(col):
+        """Returns what collectors starting for the first time are sorted by."""
+        return (col.interval != 0, list(PRIORITY_WEIGHTS).index(col.priority))
+
+    def start_next_wave(self, now):
+        """Schedules as many of the collectors waiting to start for the first
+           time as there is room for, now that some may be done starting."""
+        for col, deadline in list(self.starting.items()):
+            if (COLLECTORS.get(col.name) is not col or col.first_datapoint or col.dead
+                    or deadline <= now):
+                del self.starting[col]
+        while self.waiting and len(self.starting) < self.concurrency:
+            _, _, col = heapq.heappop(self.waiting)
+            if COLLECTORS.get(col.name) is col:
+                self.starting[col] = now + STARTUP_TIMEOUT
+                self.schedule(col, now)
+
+
+def bytes_per_item(items):
+    """Returns how many bytes each item adds to a container like the given
+       one on average, including the room it keeps spare."""
+    return (sys.getsizeof(items) - sys.getsizeof(type(items)())) // len(items)
+
+
+class DedupEntry:
+    """What we remember about the last value of a series, for DedupStore.
+
+       The line to replay, if any, is rebuilt from these fields rather than
+       kept around, since that would double the memory we need per series."""
+
+    __slots__ = ('value', 'timestamp', 'last_timestamp', 'repeated')
+
+    def __init__(self, value, timestamp, last_timestamp):
+        self.value = value  # Last value seen, as sent by the collector.
+        self.timestamp = timestamp  # When we first saw this value.
+        self.last_timestamp = last_timestamp  # Formats as sent with the last value.
+        self.repeated = False  # Whether the last value was seen more than once.
+
+    def same_value(self, value):
+        """Whether value, once booleans are converted, is our last value."""
+        last = self.value
+        if last[0] in 'tTfF':
+            last = BOOLEAN_VALUES.get(last.lower(), last)
+        return last == value
+
+
+class DedupStore:
+    """Keeps track of the last value seen for each (metric, tags) of each
+       collector, so that the ReaderThread can suppress duplicate values.
+
+       The state is kept by collector name rather than in the Collector
+       objects: interval collectors get a brand new Collector every time
+       they run, and would otherwise never see a duplicate.
+
+       Each series is keyed by a single string made of the collector name,
+       metric and tags (see make_key()), which takes a lot less memory than
+       a tuple of separate strings.  If max_bytes is set, the least recently
+       updated series are evicted to stay under it.
+
+       To evict old entries without scanning all of them, the keys are also
+       indexed in buckets of bucket_width seconds, by the time their value
+       last changed.  Eviction drops whole buckets, so an entry may outlive
+       the cut-off by up to bucket_width seconds."""
+
+    # Approximate size of a DedupEntry and of its slots in the dict of
+    # entries and in the set of its eviction bucket, the key and value being
+    # counted separately.  An OrderedDict costs over twice as much per item
+    # as a dict, so we only use one when we need the LRU order.
+    ENTRY_BYTES = (sys.getsizeof(DedupEntry('', 0, ''))
+                   + bytes_per_item(dict.fromkeys(range(1000)))
+                   + bytes_per_item(set(range(1000))))
+    LRU_ENTRY_BYTES = (ENTRY_BYTES - bytes_per_item(dict.fromkeys(range(1000)))
+                       + bytes_per_item(OrderedDict.fromkeys(range(1000))))
+
+    def __init__(self, max_bytes=0, bucket_width=1):
+        # Maps a key to a DedupEntry.  Since it might grow unbounded (in case
+        # we see many different combinations of metrics and tags) someone
+        # needs to regularly call evict_old_keys() to remove old entries.
+        # With max_bytes, entries are ordered from the least to the most
+        # recently updated.
+        self.max_bytes = max_bytes  # 0 means no limit.
+        if max_bytes:
+            self.entries = OrderedDict()
+            self.entry_bytes = self.LRU_ENTRY_BYTES
+        else:
+            self.entries = {}
+            self.entry_bytes = self.ENTRY_BYTES
+        self.bytes = 0  # Approximate memory used.
+        self.lru_evictions = 0
+        self.bucket_width = bucket_width
+        # Maps a bucket number to the set of keys in that bucket, and a heap
+        # of bucket numbers so we can find the oldest one quickly.
+        self.buckets = {}
+        self.bucket_heap = []
+
+    @staticmethod
+    def make_key(colname, metric, tags):
+        """Returns the key of a series: the collector name, a NUL character
+           (which can't be in file names), then the metric and tags."""
+        return '%s\0%s%s' % (colname, metric, tags)
+
+    @staticmethod
+    def compact_timestamp(timestamp):
+        """Returns a timestamp as sent by a collector in whichever form takes
+           the least memory, as long as it formats back to the same text."""
+        if timestamp.isdigit() and timestamp[0] != '0':
+            return int(timestamp)
+        return timestamp
+
+    def get(self, key):
+        """Returns the DedupEntry for the given key, or None."""
+        return self.entries.get(key)
+
+    def bucket(self, timestamp):
+        """Returns the number of the bucket for a timestamp, which may be
+           in seconds or milliseconds."""
+        if timestamp >= MAX_REASONABLE_TIMESTAMP:
+            timestamp /= 1000
+        return int(timestamp // self.bucket_width)
+
+    def _index(self, key, bucket):
+        keys = self.buckets.get(bucket)
+        if keys is None:
+            keys = self.buckets[bucket] = set()
+            heapq.heappush(self.bucket_heap, bucket)
+        keys.add(key)
+
+    def put(self, key, value, timestamp, last_timestamp):
+        """Records a new value for the series with the given key."""
+        entry = self.entries.get(key)
+        if entry is None:
+            last_timestamp = self.compact_timestamp(last_timestamp)
+            self.entries[key] = DedupEntry(value, timestamp, last_timestamp)
+            self._index(key, self.bucket(timestamp))
+            self.bytes += (self.entry_bytes + sys.getsizeof(key) + sys.getsizeof(value)
+                           + sys.getsizeof(last_timestamp))
+            if self.max_bytes:
+                self._enforce_max_bytes()
+            return
+        self.update(key, entry, value, last_timestamp)
+        old_bucket = self.bucket(entry.timestamp)
+        new_bucket = self.bucket(timestamp)
+        if new_bucket != old_bucket:
+            self.buckets[old_bucket].discard(key)
+            self._index(key, new_bucket)
+        entry.timestamp = timestamp
+        entry.repeated = False
+
+    def update(self, key, entry, value, last_timestamp):
+        """Updates the last value and timestamp we saw for a series."""
+        last_timestamp = self.compact_timestamp(last_timestamp)
+        self.bytes += (sys.getsizeof(value) + sys.getsizeof(last_timestamp)
+                       - sys.getsizeof(entry.value) - sys.getsizeof(entry.last_timestamp))
+        entry.value = value
+        entry.last_timestamp = last_timestamp
+        if self.max_bytes:
+            self.entries.move_to_end(key)
+
+    @staticmethod
+    def replay_line(key, entry):
+        """Rebuilds the last line we got for a series."""
+        series = key[key.index('\0') + 1:]
+        metric, _, tags = series.partition(' ')
+        if tags:
+            return '%s %s %s %s' % (metric, entry.last_timestamp, entry.value, tags)
+        return '%s %s %s' % (metric, entry.last_timestamp, entry.value)
+
+    def evict_old_keys(self, cut_off, budget=0):
         """Remove old entries from the cache used to detect duplicate values.
 
         Args:
           cut_off: A UNIX timestamp.  Any value that's older than this will be
-            removed from the cache.
+            removed from the cache, give or take bucket_width seconds.
+          budget: If non-zero, remove at most that many entries.
+        Returns: whether all the old entries have been removed, as opposed
+          to having run out of budget.
         """
-        for key in list(self.values):
-            time = self.values[key][3]
-            if time < cut_off:
-                del self.values[key]
+        last_bucket = int(cut_off // self.bucket_width)
+        heap = self.bucket_heap
+        evicted = 0
+        while heap and heap[0] < last_bucket:
+            keys = self.buckets[heap[0]]
+            while keys:
+                if budget and evicted >= budget:
+                    return False
+                self._remove_entry(keys.pop())
+                evicted += 1
+            del self.buckets[heapq.heappop(heap)]
+        return True
+
+    def next_expiry(self):
+        """Returns the cut-off from which the oldest bucket can be evicted, or
+           None if we have no entries."""
+        if not self.bucket_heap:
+            return None
+        return (self.bucket_heap[0] + 1) * self.bucket_width
+
+    def _enforce_max_bytes(self):
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+            self.lru_evictions += 1
+
+    def _remove(self, key):
+        self.buckets[self.bucket(self.entries[key].timestamp)].discard(key)
+        self._remove_entry(key)
+
+    def _remove_entry(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= (self.entry_bytes + sys.getsizeof(key) + sys.getsizeof(entry.value)
+                       + sys.getsizeof(entry.last_timestamp))
+
+    def __len__(self):
+        return len(self.entries)
 
     def to_json(self):
-        """Expose collector information in JSON-serializable format."""
-        result = {}
-        for attr in ["name", "mtime", "lastspawn", "killstate", "nextkill",
-                     "lines_sent", "lines_received", "lines_invalid",
-                     "last_datapoint", "dead"]:
-            result[attr] = getattr(self, attr)
-        return result
+        """Expose the state of the store in JSON-serializable format."""
+        return {"series": len(self.entries), "bytes": self.bytes,
+                "max_bytes": self.max_bytes, "lru_evictions": self.lru_evictions,
+                "buckets": len(self.buckets)}
 
 
 class StatusRequestHandler(BaseHTTPRequestHandler):
@@ -255,7 +1096,11 @@ class StatusRequestHandler(BaseHTTPRequestHandler):
         # another thread changing them midway (it's integers and strings and
         # the like), so worst case it's a tiny bit internally inconsistent.
         # Which is fine for monitoring.
-        result = json.dumps([c.to_json() for c in self.server.collectors.values()])
+        endpoint = self.server.endpoints.get(self.path.rstrip("/"))
+        if endpoint is not None:
+            result = json.dumps(endpoint())
+        else:
+            result = json.dumps([c.to_json() for c in self.server.collectors.values()])
         self.send_response(200)
         self.send_header("content-type", "text/json")
         self.send_header("content-length", str(len(result)))
@@ -267,14 +1112,18 @@ class StatusRequestHandler(BaseHTTPRequestHandler):
 class StatusServer(HTTPServer):
     """Serves status of collectors over HTTP."""
 
-    def __init__(self, interface, port, collectors):
+    def __init__(self, interface, port, collectors, endpoints=None):
         """
         interface: the interface to listen on, e.g. "127.0.0.1".
         port: the port to listen on, e.g. 8080.
         collectors: a dictionary mapping names to Collectors, typically the
-                    global COLLECTORS.
+                    global COLLECTORS.  Their status is served on "/", as
+                    well as on any path we don't know about.
+        endpoints: a dictionary mapping extra paths, e.g. "/reader", to
+                   functions returning what to serve there as JSON.
         """
         self.collectors = collectors
+        self.endpoints = dict(endpoints or {})
         HTTPServer.__init__(self, (interface, port), StatusRequestHandler)
 
 
@@ -284,6 +1133,10 @@ class StdinCollector(Collector):
        ReaderThread, although unlike a normal collector, read()/collect()
        will be blocking."""
 
+    # read() blocks until the next line, so the ReaderThread can't wait for
+    # collect() to be done before handing the lines over to the sender.
+    flush_each_line = True
+
     def __init__(self):
         super(StdinCollector, self).__init__('stdin', 0, '<stdin>')
 
@@ -291,7 +1144,7 @@ class StdinCollector(Collector):
         # except as a test in the stdin mode.
         self.proc = True
 
-    def read(self):
+    def read(self, size=-1):
         """Read lines from STDIN and store them.  We allow this to
            be blocking because there should only ever be one
            StdinCollector and no normal collectors, so the ReaderThread
@@ -309,13 +1162,560 @@ class StdinCollector(Collector):
         pass
 
 
+class CollectorKilled(BaseException):
+    """Raised in the thread of an in-process collector to stop it.  This
+       isn't an Exception, so that collectors catching those let it through."""
+
+
+class CollectorOutput:
+    """Takes the place of sys.stdout or sys.stderr once we run collectors in
+       our own process: what the thread of a collector writes goes to its
+       CollectorThread, and everything else to the stream we replaced."""
+
+    def __init__(self, name, stream):
+        self.name = name  # 'stdout' or 'stderr'
+        self.stream = stream
+
+    def write(self, data):
+        thread = threading.current_thread()
+        if isinstance(thread, CollectorThread):
+            thread.write(self.name, data)
+            return len(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        thread = threading.current_thread()
+        if isinstance(thread, CollectorThread):
+            if self.name == 'stdout':
+                thread.flush()
+            return
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class CollectorThread(threading.Thread):
+    """Runs the main() of a Python collector in a thread of our own process,
+       for --in-process-collectors, and stands in for its subprocess: it can
+       be poll()ed, wait()ed for and sent signals, and its returncode is
+       what main() returned or passed to sys.exit(), so 0 and 13 mean the
+       same as for any other collector.
+
+       The lines the collector prints go straight to the datalines of its
+       Collector rather than through a pipe.  There's no killing a thread,
+       so a signal raises CollectorKilled in it, which only happens once it
+       runs Python code again, e.g. when it's done sleeping.  After SIGKILL,
+       as when its Collector is shut down, we don't wait for that: the
+       thread is abandoned and its output ignored from then on.  As long
+       as it's still running, the collector runs as a subprocess instead,
+       so that main() doesn't run twice in the same module."""
+
+    def __init__(self, col):
+        super(CollectorThread, self).__init__(name='collector %s' % col.name)
+        self.daemon = True  # Don't wait for the ones we abandoned on exit.
+        self.col = col
+        self.pid = os.getpid()
+        self.returncode = None
+        self.signum = None  # The last signal we were sent, if any.
+        self.abandoned = False
+        self.partial = {'stdout': '', 'stderr': ''}  # What follows the last newline.
+        self.lines = []  # Lines printed but not handed over to the reader yet.
+        # Notified when the reader took our lines, or we were abandoned.
+        self.room = threading.Condition()
+
+    def run(self):
+        try:
+            try:
+                module = load_collector_module(self.col.filename)
+                status = module.main()
+            except SystemExit as exc:
+                status = exc.code
+            finally:
+                if self.partial['stdout']:
+                    self.write('stdout', '\n')
+                self.flush()
+        except CollectorKilled:
+            status = -self.signum
+        except IN_PROCESS_REFUSED:
+            LOG.error('%s wants to drop privileges, which it cannot do in our '
+                      'process as root, running it as a subprocess from now on',
+                      self.col.name)
+            IN_PROCESS_COLLECTORS.discard(self.col.name)
+            IN_PROCESS_COLLECTORS.discard(os.path.splitext(self.col.name)[0])
+            status = 0  # So that it gets run again.
+        except Exception:
+            LOG.exception('uncaught exception in collector %s', self.col.name)
+            status = 1
+        # Like sys.exit(): None is success, and anything else that isn't
+        # a number is printed to stderr and is a failure.
+        if status is None:
+            status = 0
+        elif not isinstance(status, int):
+            LOG.warning('%s: %s', self.col.name, status)
+            status = 1
+        self.returncode = status
+
+    def write(self, name, data):
+        """Frames what the collector wrote to the given stream into lines."""
+        if self.abandoned:
+            return
+        lines = (self.partial[name] + data).split('\n')
+        self.partial[name] = lines.pop()
+        if name == 'stderr':
+            for line in lines:
+                LOG.warning('%s: %s', self.col.name, line)
+            return
+        for line in lines:
+            line = line.strip()
+            if line:
+                self.lines.append(line)
+        if len(self.lines) >= IN_PROCESS_BATCH_LINES:
+            self.flush()
+
+    def flush(self):
+        """Hands the lines printed so far over to the reader, first waiting
+           while it has too many of ours already."""
+        if not self.lines:
+            return
+        datalines = self.col.datalines
+        with self.room:
+            while len(datalines) >= IN_PROCESS_MAX_BACKLOG and ALIVE and not self.abandoned:
+                # Nobody tells us when ALIVE goes away, so check every second.
+                self.room.wait(1)
+        if not self.abandoned:
+            self.col.add_lines(self.lines)
+            if POLLER is not None:
+                POLLER.notify(self.col)
+        self.lines = []
+
+    def lines_taken(self):
+        """Called by the reader once it has taken all our lines."""
+        with self.room:
+            self.room.notify()
+
+    def poll(self):
+        if self.abandoned:
+            return -signal.SIGKILL
+        return self.returncode
+
+    def wait(self):
+        if not self.abandoned:
+            self.join()
+        return self.poll()
+
+    def send_signal(self, signum):
+        """Stops the collector, see the class docstring."""
+        if self.returncode is not None or self.abandoned:
+            return
+        self.signum = signum
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.ident),
+                                                   ctypes.py_object(CollectorKilled))
+        if signum == signal.SIGKILL:
+            self.abandoned = True
+            ABANDONED_THREADS[self.col.filename] = self
+            with self.room:
+                self.room.notify()
+
+
+class Zygote:
+    """Forks the Python interval collectors for us, see --zygote.
+
+       The zygote is a Python interpreter of its own, started before any of
+       our threads, which imports ZYGOTE_PRELOAD and then waits for us to
+       ask for collectors over a socket.  For each of them we send the
+       write ends of its stdout and stderr pipes, and the zygote forks a
+       child which starts a new session, like spawn_collector() does, and
+       runs the collector.  The zygote tells us the pid of the child, then
+       its exit status once it's done.  This is only used by the main loop.
+
+       The zygote also tells us which files it imported the modules from.
+       Once one of them changes, we restart it so that the collectors get
+       the new code, as soon as none of its children are left running."""
+
+    def __init__(self, preload=ZYGOTE_PRELOAD):
+        self.preload = preload
+        self.last_request = 0
+        self.replies = {}  # Maps a request to its answer, until we read it.
+        self.statuses = {}  # Maps a pid to its exit status, until we poll it.
+        # The ZygoteChild of each pid, as long as someone may poll it.
+        self.children = weakref.WeakValueDictionary()
+        self.start()
+
+    def start(self):
+        """Starts the zygote process."""
+        self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        bootstrap = ('import sys; sys.path.insert(0, %r); import tcollector; '
+                     'tcollector.run_zygote(%d, %r)'
+                     % (os.path.dirname(os.path.abspath(__file__)), child_sock.fileno(),
+                        self.preload))
+        self.proc = subprocess.Popen([sys.executable, '-c', bootstrap],
+                                     pass_fds=[child_sock.fileno()], close_fds=True)
+        child_sock.close()
+        self.alive = True
+        # Maps the files the zygote imported its modules from to their mtime.
+        self.preloaded = {}
+        LOG.info('started the zygote (pid=%d)', self.proc.pid)
+
+    def spawn(self, filename):
+        """Runs the given collector in a child of the zygote, and returns a
+           ZygoteChild standing in for it, or None if the zygote is gone or
+           waiting to be restarted."""
+        if not self.alive:
+            return None
+        changed = self.changed_preload()
+        if changed is not None:
+            if any(child.poll() is None for child in list(self.children.values())):
+                # They'd never hear back from a new zygote.
+                return None
+            LOG.info('restarting the zygote (pid=%d), %s changed', self.proc.pid, changed)
+            self.stop()
+            self.statuses.clear()
+            self.start()
+        # Forget the statuses of the children nobody will poll anymore, e.g.
+        # as their collector was shut down.  We're only ever asked for one
+        # child at a time, so each of those we told about has a ZygoteChild.
+        for pid in [pid for pid in self.statuses if pid not in self.children]:
+            del self.statuses[pid]
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        self.last_request += 1
+        request = self.last_request
+        try:
+            fds = array.array('i', [stdout_w, stderr_w])
+            self.sock.sendmsg([json.dumps({'id': request, 'filename': filename}).encode()],
+                              [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        except OSError as exc:
+            self.gone('failed to talk to it: %s' % exc)
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+        deadline = time.time() + ZYGOTE_TIMEOUT
+        while self.alive and request not in self.replies:
+            if time.time() >= deadline:
+                self.gone('no answer in %ds' % ZYGOTE_TIMEOUT)
+                break
+            self.read_messages(deadline - time.time())
+        reply = self.replies.pop(request, None)
+        if reply is None or 'error' in reply:
+            os.close(stdout_r)
+            os.close(stderr_r)
+            if reply is None:
+                return None
+            raise OSError(reply['error'])
+        child = ZygoteChild(self, reply['pid'], os.fdopen(stdout_r, 'rb'),
+                            os.fdopen(stderr_r, 'rb'))
+        self.children[child.pid] = child
+        return child
+
+    def changed_preload(self):
+        """Returns a file the zygote imported a module from that changed
+           since, if any."""
+        for filename, mtime in self.preloaded.items():
+            try:
+                if os.path.getmtime(filename) != mtime:
+                    return filename
+            except OSError:
+                return filename
+        return None
+
+    def read_messages(self, timeout=0):
+        """Reads what the zygote told us, waiting up to timeout seconds for
+           it to tell us something."""
+        if not self.alive:
+            return
+        self.sock.settimeout(timeout)
+        while self.alive:
+            try:
+                data = self.sock.recv(65536)
+            except (socket.timeout, BlockingIOError):
+                return
+            except OSError as exc:
+                self.gone('failed to talk to it: %s' % exc)
+                return
+            if not data:
+                self.gone('it exited')
+                return
+            message = json.loads(data.decode('utf-8'))
+            if 'status' in message:
+                self.statuses[message['pid']] = message['status']
+            elif 'preloaded' in message:
+                self.preloaded = message['preloaded']
+            else:
+                self.replies[message['id']] = message
+            self.sock.settimeout(0)
+
+    def gone(self, reason):
+        """Gives up on the zygote."""
+        LOG.error('Giving up on the zygote (pid=%d), %s', self.proc.pid, reason)
+        self.alive = False
+        self.stop()
+
+    def stop(self):
+        """Lets the zygote exit, which it does once we close our socket."""
+        self.alive = False
+        self.sock.close()
+        try:
+            self.proc.wait(ZYGOTE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+class ZygoteChild:
+    """Stands in for the subprocess.Popen of a collector forked by the
+       Zygote.  It's in a session of its own, so it can be signaled like any
+       other collector, but we only learn its exit status from the zygote:
+       once that's gone, it's UNKNOWN_EXIT_STATUS."""
+
+    def __init__(self, zygote, pid, stdout, stderr):
+        self.zygote = zygote
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        self.zygote.read_messages()
+        if self.pid in self.zygote.statuses:
+            self.returncode = self.zygote.statuses.pop(self.pid)
+        elif not self.zygote.alive:
+            # Nobody will tell us how it went, just whether it's still there.
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = UNKNOWN_EXIT_STATUS
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            if self.zygote.alive:
+                self.zygote.read_messages(1)
+            else:
+                time.sleep(0.1)
+        return self.returncode
+
+
+class CollectorPoller:
+    """Watches the stdout/stderr pipes of the running collectors with a
+       selector (epoll on Linux), so that the ReaderThread only wakes up
+       when a collector has written something.  Pipes are registered by
+       spawn_collector() and unregistered when the collector is reaped or
+       shut down.  This is used with --reader-mode=select."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        # Maps a Collector to the pipes we registered for it, by name.  We
+        # keep our own references since col.proc may be gone by the time
+        # the collector is unregistered.
+        self.pipes = {}
+        # Collectors which told us they have data for us, without a pipe.
+        self.notified = set()
+        # Self-pipe used to interrupt a select() in progress, e.g. when we
+        # are shutting down.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        set_nonblocking(self.wakeup_r)
+        set_nonblocking(self.wakeup_w)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+    def register(self, col):
+        """Starts watching the pipes of the given collector's process."""
+        with self.lock:
+            if col in self.pipes:
+                return
+            pipes = {}
+            for name in ('stdout', 'stderr'):
+                pipe = getattr(col.proc, name)
+                try:
+                    self.selector.register(pipe, selectors.EVENT_READ, col)
+                    pipes[name] = pipe
+                except (KeyError, ValueError) as exc:
+                    LOG.error('failed to watch %s of %s: %s', name, col.name, exc)
+            self.pipes[col] = pipes
+        LOG.debug('watching %d pipes of %s', len(pipes), col.name)
+
+    def unregister(self, col):
+        """Stops watching all the pipes of the given collector."""
+        with self.lock:
+            for pipe in self.pipes.pop(col, {}).values():
+                self._unregister_pipe(pipe)
+
+    def forget_closed_pipes(self, col):
+        """Stops watching the pipes on which the collector has hit EOF.
+           A pipe at EOF is always readable, so if we didn't do this the
+           ReaderThread would spin until the main loop reaps the process."""
+        with self.lock:
+            pipes = self.pipes.get(col)
+            if not pipes:
+                return
+            for name, eof in (('stdout', col.stdout_eof),
+                              ('stderr', col.stderr_eof)):
+                if eof and name in pipes:
+                    self._unregister_pipe(pipes.pop(name))
+
+    def _unregister_pipe(self, pipe):
+        try:
+            self.selector.unregister(pipe)
+        except (KeyError, ValueError):
+            pass
+
+    def wakeup(self):
+        """Interrupts the current (or next) call to poll()."""
+        try:
+            os.write(self.wakeup_w, b'x')
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def notify(self, col):
+        """Makes the current (or next) call to poll() return the given
+           collector, e.g. an in-process one which has no pipes."""
+        with self.lock:
+            self.notified.add(col)
+        self.wakeup()
+
+    def poll(self, timeout):
+        """Waits at most timeout seconds for collectors to have data.
+
+        Returns: the set of Collectors which have at least one readable pipe,
+          or which notified us.
+        """
+        ready = set()
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                try:
+                    while os.read(self.wakeup_r, 4096):
+                        pass
+                except OSError as exc:
+                    if exc.errno != errno.EAGAIN:
+                        raise
+                continue
+            ready.add(key.data)
+        with self.lock:
+            ready |= self.notified
+            self.notified = set()
+        return ready
+
+
+class DirectoryWatcher:
+    """Watches the collector directories and config modules for changes
+       with inotify(7), through ctypes since Python has no bindings for it.
+       Raises OSError when inotify isn't available, in which case main_loop
+       rescans them every HOUSEKEEPING_INTERVAL instead."""
+
+    # struct inotify_event: wd, mask, cookie and len, followed by the name.
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise self.error('inotify_init1')
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fd, selectors.EVENT_READ)
+        # Maps a watch descriptor to the directory it watches.  Watching a
+        # directory again gets us the same descriptor.
+        self.dirs = {}
+
+    @staticmethod
+    def error(what):
+        code = ctypes.get_errno()
+        return OSError(code, '%s: %s' % (what, os.strerror(code)))
+
+    def watch(self, path):
+        """Starts watching the given directory, if we don't already."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise self.error('inotify_add_watch %s' % path)
+        self.dirs[wd] = path
+
+    def wait(self, timeout):
+        """Waits at most timeout seconds for something to change.
+
+        Returns: a list of (directory, name, mask) of what did, where the
+          directory is None if the kernel had to drop some events.
+        """
+        events = []
+        if not self.selector.select(timeout):
+            return events
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                path = self.dirs.get(wd)
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                events.append((path, name, mask))
+        return events
+
+    def close(self):
+        self.selector.close()
+        os.close(self.fd)
+
+
+class DatapointParser:
+    """Splits the lines printed by collectors into their metric, timestamp,
+       value and tags, and rejects the ones that aren't valid datapoints.
+
+       Most lines are plain ASCII with single spaces between fields, which a
+       stricter expression without any backtracking can match about twice
+       as fast as LINE_RE.  Lines it doesn't match are handed over to
+       LINE_RE, which has the final say, so the result is always the same
+       as if we only used LINE_RE."""
+
+    LINE_RE = re.compile(r'^([-_./a-zA-Z0-9]+)\s+'  # Metric name.
+                         r'(\d+\.?\d+)\s+'  # Timestamp.
+                         r'(\S+?)'  # Value (int or float).
+                         r'((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$')  # Tags
+    # Only matches a subset of what LINE_RE matches, and splits it the same.
+    FAST_LINE_RE = re.compile(r'([-_./a-zA-Z0-9]+) '  # Metric name.
+                              r'([0-9]+\.?[0-9]+) '  # Timestamp.
+                              r'([!-~]+)'  # Value: printable ASCII, no spaces.
+                              r'((?: [-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)')  # Tags
+
+    def __init__(self):
+        self.fast_parsed = 0  # Lines matched by FAST_LINE_RE.
+        self.slow_parsed = 0  # Lines that went through LINE_RE.
+
+    def parse(self, line):
+        """Parses a line whose fields are separated by single spaces.
+
+        Returns: a (metric, timestamp, value, tags) tuple of strings, where
+          tags is either empty or the tags with a leading space, or None if
+          the line isn't a valid datapoint.
+        """
+        parsed = self.FAST_LINE_RE.fullmatch(line)
+        if parsed is not None:
+            self.fast_parsed += 1
+            return parsed.groups()
+        self.slow_parsed += 1
+        parsed = self.LINE_RE.match(line)
+        if parsed is None:
+            return None
+        return parsed.groups()
+
+
 class ReaderThread(threading.Thread):
     """The main ReaderThread is responsible for reading from the collectors
        and assuring that we always read from the input no matter what.
        All data read is put into the self.readerq Queue, which is
-       consumed by the SenderThread."""
+       consumed by the SenderThread.  The lines we accept are handed over
+       in one batch per iteration."""
 
-    def __init__(self, dedupinterval, evictinterval, deduponlyzero, ns_prefix=""):
+    def __init__(self, dedupinterval, evictinterval, deduponlyzero, ns_prefix="",
+                 poller=None, dedup_max_bytes=0, read_budget_lines=READ_BUDGET_LINES,
+                 read_budget_bytes=READ_BUDGET_BYTES, overload='drop'):
         """Constructor.
             Args:
               dedupinterval: If a metric sends the same value over successive
@@ -329,18 +1729,44 @@ class ReaderThread(threading.Thread):
                 Invariant: evictinterval > dedupinterval
               deduponlyzero: do the above only for 0 values.
               ns_prefix: Prefix to add to metric tags.
+              poller: An optional CollectorPoller.  If given, we wait for the
+                collectors' pipes to become readable instead of polling all
+                of them every second.
+              dedup_max_bytes: If non-zero, roughly how much memory the
+                dedup cache may use before we start evicting the series
+                that were least recently updated.
+              read_budget_lines: How many lines we read from a collector at
+                most before moving on to the next one, or 0 for no limit.
+              read_budget_bytes: The same, in bytes.
+              overload: What to do when the reader queue is full, one of
+                OVERLOAD_MODES: drop lines, or leave them in the pipes of
+                the collectors until the sender catches up.
         """
         assert evictinterval > dedupinterval, "%r <= %r" % (evictinterval,
                                                             dedupinterval)
         super(ReaderThread, self).__init__()
 
-        self.readerq = ReaderQueue(MAX_READQ_SIZE)
+        self.readerq = ReaderQueue(MAX_READQ_SIZE, overload=overload)
+        self.read_budget_lines = read_budget_lines
+        self.read_budget_bytes = read_budget_bytes
+        # Lines waiting to be put in the readerq, by priority class.
+        self.batch = dict((priority, []) for priority in PRIORITY_WEIGHTS)
         self.lines_collected = 0
         self.lines_dropped = 0
         self.dedupinterval = dedupinterval
         self.evictinterval = evictinterval
         self.deduponlyzero = deduponlyzero
         self.ns_prefix = ns_prefix
+        self.poller = poller
+        self.parser = DatapointParser()
+        self.dedup = DedupStore(dedup_max_bytes,
+                                max(1, evictinterval // EVICTION_BUCKETS))
+        self.next_evict = 0  # When we need to look for old dedup keys next.
+        self.wakeups = 0  # How many times the main loop went around.
+        self.backpressure_waits = 0  # How many times we waited for room.
+        # When we last held off reading from the collectors because the
+        # reader queue was full, which stops their output from reaching us.
+        self.held_back_at = 0
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
@@ -349,31 +1775,127 @@ class ReaderThread(threading.Thread):
 
         LOG.debug("ReaderThread up and running")
 
-        lastevict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
+        if self.poller is not None:
+            self.run_with_poller()
+            return
+
+        # Without a poller we loop every second, reading from every
+        # collector whether or not it has anything to say.  Each collector
+        # gets a budget per round, and we go round again right away if one
+        # of them had more than that.
         while ALIVE:
-            alc = all_living_collectors()
+            self.wakeups += 1
+            backlog = False
+            alc = list(all_living_collectors())
+            if self.readerq.backpressure and alc:
+                # Don't always leave the same collectors waiting.
+                start = self.wakeups % len(alc)
+                alc = alc[start:] + alc[:start]
             for col in alc:
-                for line in col.collect():
-                    self.process_line(col, line)
+                if self.queue_full():
+                    backlog = True
+                    break
+                for line in col.collect(self.read_budget_lines, self.read_budget_bytes):
+                    self.process_line(col, line, flush=col.flush_each_line)
+                backlog = backlog or col.over_budget
+            self.flush_batch()
 
-            if self.dedupinterval != 0:  # if 0 we do not use dedup
-                now = int(time.time())
-                if now - lastevict_time > self.evictinterval:
-                    lastevict_time = now
-                    now -= self.evictinterval
-                    for col in all_collectors():
-                        col.evict_old_keys(now)
+            self.maybe_evict_old_keys()
 
             # and here is the loop that we really should get rid of, this
             # just prevents us from spinning right now
-            time.sleep(1)
+            if self.queue_full():
+                self.wait_for_room()
+            elif not backlog:
+                time.sleep(1)
+
+    def run_with_poller(self):
+        """Main loop when we have a CollectorPoller: sleep until either a
+           collector has data for us or it's time to evict old dedup keys."""
+
+        # Collectors that had more to say than their budget, which we get
+        # back to before waiting for anything else.
+        backlog = set()
+        while ALIVE:
+            timeout = MAX_READER_SLEEP
+            if self.dedupinterval != 0:
+                timeout = min(timeout, max(0, self.next_evict_time() - time.time()))
+            if backlog:
+                timeout = 0
+            ready = self.poller.poll(timeout) | backlog
+            backlog = set()
+            self.wakeups += 1
+            for col in ready:
+                if self.queue_full():
+                    backlog.add(col)
+                    continue
+                for line in col.collect(self.read_budget_lines, self.read_budget_bytes):
+                    self.process_line(col, line, flush=False)
+                if col.over_budget:
+                    backlog.add(col)
+                self.poller.forget_closed_pipes(col)
+            self.flush_batch()
+
+            self.maybe_evict_old_keys()
+            if self.queue_full():
+                self.wait_for_room()
 
-    def process_line(self, col, line):
-        """Parses the given line and appends the result to the reader queue."""
+    def to_json(self):
+        """Expose reader information in JSON-serializable format."""
+        return {"lines_collected": self.lines_collected,
+                "lines_dropped": self.lines_dropped,
+                "wakeups": self.wakeups,
+                "backpressure_waits": self.backpressure_waits,
+                "priorities": self.readerq.to_json(),
+                "dedup": self.dedup.to_json()}
+
+    def next_evict_time(self):
+        """Returns the UNIX timestamp at which we'll next evict old keys."""
+        return self.next_evict
+
+    def maybe_evict_old_keys(self):
+        """Evicts old keys from the dedup cache if some are due.  This only
+           evicts up to EVICTION_BATCH_SIZE keys at a time, so that we don't
+           stop reading from collectors for long; the rest is done on the
+           next iterations."""
+        if self.dedupinterval == 0:  # if 0 we do not use dedup
+            return
+        now = time.time()
+        if now < self.next_evict:
+            return
+        if not self.dedup.evict_old_keys(now - self.evictinterval, EVICTION_BATCH_SIZE):
+            return  # More to do on the next iteration.
+        expiry = self.dedup.next_expiry()
+        if expiry is None:
+            self.next_evict = now + self.evictinterval
+        else:
+            self.next_evict = expiry + self.evictinterval
+
+    def queue_full(self):
+        """Returns whether we need to stop reading from the collectors, in
+           backpressure mode, because the reader queue is full."""
+        if not self.readerq.backpressure:
+            return False
+        return self.readerq.is_full(sum(len(lines) for lines in self.batch.values()))
+
+    def wait_for_room(self):
+        """Waits a little for the sender to make room in the reader queue,
+           while the collectors block writing to their pipes."""
+        self.backpressure_waits += 1
+        self.held_back_at = time.time()
+        self.readerq.wait_for_room(1)
+        self.held_back_at = time.time()
+
+    def flush_batch(self):
+        """Hands the lines we've accepted so far over to the reader queue."""
+        for priority, lines in self.batch.items():
+            if lines:
+                self.lines_dropped += self.readerq.put_batch(lines, priority)
+                self.batch[priority] = []
+
+    def process_line(self, col, line, flush=True):
+        """Parses the given line and appends the result to the reader queue,
+           or only to our batch for it if flush is false."""
 
         self.lines_collected += 1
         # If the line contains more than a whitespace between
@@ -388,35 +1910,26 @@ class ReaderThread(threading.Thread):
 
         line = self.ns_prefix + line
 
-        parsed = re.match(r'^([-_./a-zA-Z0-9]+)\s+'  # Metric name.
-                          r'(\d+\.?\d+)\s+'  # Timestamp.
-                          r'(\S+?)'  # Value (int or float).
-                          r'((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$',  # Tags
-                          line)
+        parsed = self.parser.parse(line)
         if parsed is None:
             LOG.warning('%s sent invalid data: %s', col.name, line)
             col.lines_invalid += 1
             return
-        metric, timestamp, value, tags = parsed.groups()
-
-        if isinstance(value, bool):
-            LOG.warning('%s sent boolean value, converted to int: %s', col.name, line)
-            value = int(value)
+        metric, timestamp, value, tags = parsed
+        # Keep what the collector sent, in case we need to replay it.
+        value_text = value
+        timestamp_text = timestamp
 
-        string_types = str
-
-        if isinstance(value, string_types) and value.lower() == 'true':
-            LOG.warning('%s sent boolean value, converted to int: %s', col.name, line)
-            value = 1
-
-        if isinstance(value, string_types) and value.lower() == 'false':
-            LOG.warning('%s sent boolean value, converted to int: %s', col.name, line)
-            value = 0
+        if value[0] in 'tTfF':
+            lowered = value.lower()
+            if lowered in BOOLEAN_VALUES:
+                LOG.warning('%s sent boolean value, converted to int: %s', col.name, line)
+                value = BOOLEAN_VALUES[lowered]
 
         try:
-            # The regex above is fairly open, and would leave values like 'True' through
-            testvalue = float(value)
-        except:
+            # The parser is fairly open, and would leave values like 'Value' through
+            floatvalue = float(value)
+        except ValueError:
             LOG.warning('%s sent invalid value: %s', col.name, line)
             col.lines_invalid += 1
             return
@@ -441,21 +1954,22 @@ class ReaderThread(threading.Thread):
         # slopes of graphs correct).
         #
         if self.dedupinterval != 0:  # if 0 we do not use dedup
-            key = (metric, tags)
-            if key in col.values:
+            key = self.dedup.make_key(col.name, metric, tags)
+            entry = self.dedup.get(key)
+            if entry is not None:
                 # if the timestamp isn't > than the previous one, ignore this value
-                if timestamp <= col.values[key][3]:
+                if timestamp <= entry.timestamp:
                     LOG.error("Timestamp out of order: metric=%s%s,"
                               " old_ts=%d >= new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              entry.timestamp, timestamp, value, col.name)
                     col.lines_invalid += 1
                     return
                 if timestamp >= max_timestamp:
                     LOG.error("Timestamp is too far out in the future: metric=%s%s"
                               " old_ts=%d, new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              entry.timestamp, timestamp, value, col.name)
                     return
 
                 # if this data point is repeated, store it but don't send.
@@ -463,47 +1977,830 @@ class ReaderThread(threading.Thread):
                 # we send the timestamp when this metric first became the current
                 # value instead of the last.  Fall through if we reach
                 # the dedup interval so we can print the value.
-                if ((not self.deduponlyzero or (self.deduponlyzero and float(value) == 0.0)) and
-                        col.values[key][0] == value and
-                        (timestamp - col.values[key][3] < local_dedupinterval)):
-                    col.values[key] = (value, True, line, col.values[key][3])
+                same_value = entry.same_value(value)
+                if ((not self.deduponlyzero or (self.deduponlyzero and floatvalue == 0.0)) and
+                        same_value and
+                        (timestamp - entry.timestamp < local_dedupinterval)):
+                    self.dedup.update(key, entry, value_text, timestamp_text)
+                    entry.repeated = True
                     return
 
                 # we might have to append two lines if the value has been the same
                 # for a while and we've skipped one or more values.  we need to
                 # replay the last value we skipped (if changed) so the jumps in
                 # our graph are accurate,
-                if ((col.values[key][1] or
-                     (timestamp - col.values[key][3] >= local_dedupinterval))
-                        and col.values[key][0] != value):
+                if ((entry.repeated or
+                     (timestamp - entry.timestamp >= local_dedupinterval))
+                        and not same_value):
                     col.lines_sent += 1
-                    if not self.readerq.nput(col.values[key][2]):
-                        self.lines_dropped += 1
+                    self.batch[col.priority].append(self.dedup.replay_line(key, entry))
 
             # now we can reset for the next pass and send the line we actually
             # want to send
-            # col.values is a dict of tuples, with the key being the metric and
-            # tags (essentially the same as wthat TSD uses for the row key).
-            # The array consists of:
-            # [ the metric's value, if this value was repeated, the line of data,
-            #   the value's timestamp that it last changed ]
-            col.values[key] = (value, False, line, timestamp)
+            self.dedup.put(key, value_text, timestamp, timestamp_text)
 
         col.lines_sent += 1
-        if not self.readerq.nput(line):
-            self.lines_dropped += 1
+        self.batch[col.priority].append(line)
+        if flush:
+            self.flush_batch()
+
+
+class DiskSpool:
+    """Keeps the datapoints we couldn't send to the TSD on disk, so that we
+       can send them once it's reachable again instead of dropping them.
+
+       Lines are appended, in batches, to segment files of up to
+       segment_bytes in the spool directory, and read back oldest first.  A
+       segment is deleted once it has been read completely.  If the spool
+       grows over max_bytes, the oldest segments are discarded.
+
+       fsync controls how hard we try to keep the data if the machine
+       crashes: 'always' syncs after every batch, 'segment' when a segment
+       is complete, and 'never' leaves it to the OS.  The data is always
+       handed to the OS before append() returns, so it survives tcollector
+       itself crashing.
+
+       We don't remember how far we've read into a segment across restarts,
+       so some lines may be sent twice if tcollector restarts while the spool
+       is being replayed.  The TSD just overwrites the duplicates."""
+
+    SUFFIX = '.spool'
+
+    def __init__(self, directory, max_bytes, fsync='segment',
+                 segment_bytes=SPOOL_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        # Keep a few segments around so we don't discard too much at once.
+        self.segment_bytes = max(1, min(segment_bytes, max_bytes // 4))
+        self.segments = deque()  # Sequence numbers of the segments, oldest first.
+        self.sizes = {}  # Maps a sequence number to the size of its segment.
+        self.writer = None  # The newest segment, if we're appending to it.
+        self.read_offset = 0  # How much of the oldest segment we've read.
+        self.lines_spooled = 0
+        self.lines_replayed = 0
+        self.bytes_discarded = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # Pick up whatever a previous run couldn't send.
+        for name in sorted(os.listdir(directory)):
+            seq = name[:-len(self.SUFFIX)]
+            if name.endswith(self.SUFFIX) and seq.isdigit():
+                self.segments.append(int(seq))
+                self.sizes[int(seq)] = os.path.getsize(self.path(int(seq)))
+        self.bytes = sum(self.sizes.values())  # Size of the spool on disk.
+        if self.segments:
+            LOG.info('Found %d bytes of spooled data in %s', self.bytes, directory)
+
+    def path(self, seq):
+        """Returns the path of a segment given its sequence number."""
+        return os.path.join(self.directory, '%016d%s' % (seq, self.SUFFIX))
+
+    def append(self, lines):
+        """Appends a batch of lines to the spool."""
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        if not data:
+            return
+        if self.writer is None or self.sizes[self.segments[-1]] >= self.segment_bytes:
+            self._rotate()
+        self.writer.write(data)
+        self.writer.flush()
+        if self.fsync == 'always':
+            os.fsync(self.writer.fileno())
+        self.sizes[self.segments[-1]] += len(data)
+        self.bytes += len(data)
+        self.lines_spooled += len(lines)
+        while self.bytes > self.max_bytes:
+            self._discard_oldest()
+
+    def read(self, max_lines):
+        """Removes up to max_lines lines from the spool, oldest first, and
+           returns them."""
+        lines = []
+        while self.segments and len(lines) < max_lines:
+            seq = self.segments[0]
+            with open(self.path(seq), 'rb') as f:
+                f.seek(self.read_offset)
+                while len(lines) < max_lines:
+                    line = f.readline()
+                    # A line without its newline was being written when we
+                    # crashed.  We only write whole lines, so it's garbage.
+                    if not line.endswith(b'\n'):
+                        break
+                    self.read_offset += len(line)
+                    lines.append(line[:-1].decode('utf-8', 'replace'))
+            if len(lines) < max_lines:  # We've read the whole segment.
+                self._remove_oldest()
+        self.lines_replayed += len(lines)
+        return lines
+
+    def close(self):
+        """Closes the segment we're appending to, if any."""
+        if self.writer is not None:
+            if self.fsync != 'never':
+                os.fsync(self.writer.fileno())
+            self.writer.close()
+            self.writer = None
+
+    def _rotate(self):
+        """Starts a new segment to append to."""
+        self.close()
+        seq = self.segments[-1] + 1 if self.segments else 0
+        self.writer = open(self.path(seq), 'ab')
+        self.segments.append(seq)
+        self.sizes[seq] = 0
+
+    def _remove_oldest(self):
+        """Deletes the oldest segment."""
+        seq = self.segments.popleft()
+        if not self.segments:  # It's the one we're appending to.
+            self.close()
+        os.remove(self.path(seq))
+        self.bytes -= self.sizes.pop(seq)
+        self.read_offset = 0
+
+    def _discard_oldest(self):
+        """Deletes the oldest segment whether we've sent it or not."""
+        if len(self.segments) == 1:
+            self._rotate()
+        seq = self.segments[0]
+        LOG.warning('Spool is over %d bytes, discarding %s', self.max_bytes, self.path(seq))
+        self.bytes_discarded += self.sizes[seq] - self.read_offset
+        self._remove_oldest()
+
+    def __len__(self):
+        return len(self.segments)
+
+    def to_json(self):
+        """Expose the state of the spool in JSON-serializable format."""
+        return {"bytes": self.bytes, "max_bytes": self.max_bytes,
+                "segments": len(self.segments), "lines_spooled": self.lines_spooled,
+                "lines_replayed": self.lines_replayed,
+                "bytes_discarded": self.bytes_discarded}
+
+
+class DNSCache:
+    """Caches what host names resolve to, so that we don't wait on DNS every
+       time we reconnect to a TSD.  Failures are cached too, for a shorter
+       while, and we keep using the addresses we had when DNS goes down."""
+
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Maps a (host, port) to when its entry expires, and either the
+        # addresses it resolved to or the (errno, message) of the failure.
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        """Returns the addresses of a host, as socket.getaddrinfo() does, or
+           raises socket.gaierror."""
+        now = time.time()
+        expires, result = self.entries.get((host, port), (0, None))
+        if expires > now:
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                               socket.SOCK_STREAM, 0)
+                self.entries[(host, port)] = (now + self.ttl, addresses)
+                return addresses
+            except socket.gaierror as e:
+                if isinstance(result, list):
+                    LOG.warning('Failed to resolve %s (%s), using the addresses we had',
+                                host, e)
+                else:
+                    result = (e.errno, e.strerror)
+                self.entries[(host, port)] = (now + self.negative_ttl, result)
+        if isinstance(result, list):
+            return result
+        raise socket.gaierror(*result)
+
+    def expire(self, host, port):
+        """Makes us resolve a host again next time, e.g. because we couldn't
+           connect to any of its addresses."""
+        if (host, port) in self.entries:
+            self.entries[(host, port)] = (0, self.entries[(host, port)][1])
+
+
+def interleave_families(addresses):
+    """Reorders the addresses of a host so they alternate between address
+       families, starting with the preferred one, as RFC 8305 suggests."""
+    by_family = OrderedDict()
+    for address in addresses:
+        by_family.setdefault(address[0], []).append(address)
+    result = []
+    for i in range(max(len(family) for family in by_family.values()) if addresses else 0):
+        result.extend(family[i] for family in by_family.values() if i < len(family))
+    return result
+
+
+def connect_race(addresses, timeout=CONNECT_TIMEOUT, delay=CONNECT_RACE_DELAY):
+    """Connects to whichever of the addresses answers first, "happy
+       eyeballs" style: a new attempt starts every delay seconds, or as soon
+       as one fails, without waiting for the others.  Each attempt gives up
+       after timeout seconds.  Returns the connected socket and its address,
+       or raises the error of the last attempt that failed."""
+    addresses = interleave_families(addresses)
+    selector = selectors.DefaultSelector()
+    pending = {}  # Maps a socket we're connecting to its address and deadline.
+    error = socket.error(errno.EADDRNOTAVAIL, 'No address to connect to')
+    next_start = 0
+    try:
+        while addresses or pending:
+            now = time.time()
+            if addresses and (now >= next_start or not pending):
+                family, socktype, proto, _, sockaddr = addresses.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if err == 0:
+                    return sock, sockaddr
+                if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    pending[sock] = (sockaddr, now + timeout)
+                    next_start = now + delay
+                else:
+                    LOG.debug('Connection attempt failed to %s: %s', sockaddr, os.strerror(err))
+                    error = socket.error(err, os.strerror(err))
+                    sock.close()
+                continue
+
+            wakeup = min(deadline for _, deadline in pending.values())
+            if addresses:
+                wakeup = min(wakeup, next_start)
+            for key, _ in selector.select(max(0, wakeup - now)):
+                sock = key.fileobj
+                sockaddr, _ = pending.pop(sock)
+                selector.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    return sock, sockaddr
+                LOG.debug('Connection attempt failed to %s: %s', sockaddr, os.strerror(err))
+                error = socket.error(err, os.strerror(err))
+                sock.close()
+                next_start = 0  # Try the next address right away.
+            now = time.time()
+            for sock, (sockaddr, deadline) in list(pending.items()):
+                if deadline <= now:
+                    LOG.debug('Connection attempt to %s timed out', sockaddr)
+                    error = socket.timeout('timed out connecting to %s' % (sockaddr,))
+                    del pending[sock]
+                    selector.unregister(sock)
+                    sock.close()
+        raise error
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+
+class RacingHTTPConnection(http.client.HTTPConnection):
+    """An HTTPConnection that resolves its host through a DNSCache and
+       connects to whichever of its addresses answers first."""
+
+    def __init__(self, host, port, dns_cache, timeout=HTTP_TIMEOUT):
+        super(RacingHTTPConnection, self).__init__(host, port, timeout=timeout)
+        self.dns_cache = dns_cache
+
+    def connect(self):
+        try:
+            self.sock, _ = connect_race(self.dns_cache.resolve(self.host, self.port))
+        except socket.gaierror:
+            raise
+        except socket.error:
+            self.dns_cache.expire(self.host, self.port)
+            raise
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            if e.errno != errno.ENOPROTOOPT:
+                raise
+
+
+class RacingHTTPSConnection(RacingHTTPConnection):
+    """The same over TLS."""
+
+    default_port = http.client.HTTPS_PORT
+
+    def __init__(self, host, port, dns_cache, timeout=HTTP_TIMEOUT, context=None):
+        super(RacingHTTPSConnection, self).__init__(host, port, dns_cache, timeout)
+        if context is None:
+            context = ssl.create_default_context()
+        self.context = context
+
+    def connect(self):
+        super(RacingHTTPSConnection, self).connect()
+        self.sock = self.context.wrap_socket(self.sock, server_hostname=self.host)
+
+
+class HTTPConnectionPool:
+    """Keeps a keep-alive HTTP(S) connection open to each TSD we send to, so
+       we don't pay for a new TCP connection and TLS handshake on every
+       batch.  There's one connection per (host, port): the SenderThread
+       only ever sends one request at a time, and pick_connection() goes
+       round the hosts, so each of them keeps its own connection.
+
+       Given a DNSCache, host names are resolved through it and connections
+       race across their addresses."""
+
+    def __init__(self, ssl=False, timeout=HTTP_TIMEOUT, dns_cache=None):
+        self.ssl = ssl
+        self.timeout = timeout
+        self.dns_cache = dns_cache
+        self.connections = {}  # Maps a (host, port) to its HTTPConnection.
+        self.requests = 0
+        self.connects = 0
+
+    def connect(self, host, port):
+        """Opens a new connection to the given TSD."""
+        if self.dns_cache is not None:
+            if self.ssl:
+                conn = RacingHTTPSConnection(host, port, self.dns_cache, self.timeout)
+            else:
+                conn = RacingHTTPConnection(host, port, self.dns_cache, self.timeout)
+        elif self.ssl:
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        self.connections[(host, port)] = conn
+        self.connects += 1
+        return conn
+
+    def close(self, host, port):
+        """Closes our connection to the given TSD, if we have one."""
+        conn = self.connections.pop((host, port), None)
+        if conn is not None:
+            conn.close()
+
+    def close_all(self):
+        for host, port in list(self.connections):
+            self.close(host, port)
+
+    def request(self, host, port, method, path, body, headers):
+        """Sends a request to the given TSD and returns the status, reason
+           and body of the response.  Raises http.client.HTTPException or
+           OSError if we couldn't get a response."""
+        conn = self.connections.get((host, port))
+        if conn is not None:
+            try:
+                return self._request(conn, method, path, body, headers)
+            except (http.client.HTTPException, OSError) as e:
+                # The TSD, or a load balancer in front of it, may well have
+                # closed a connection that was idle, so try again on a new
+                # one.  Resending datapoints is harmless.
+                LOG.debug('Reconnecting to %s:%s: %s', host, port, e)
+                self.close(host, port)
+        conn = self.connect(host, port)
+        try:
+            return self._request(conn, method, path, body, headers)
+        except (http.client.HTTPException, OSError):
+            self.close(host, port)
+            raise
+
+    def _request(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        self.requests += 1
+        if response.will_close:
+            self.close(conn.host, conn.port)
+        return response.status, response.reason, data
+
+
+def join_tags(*tags):
+    """Joins strings of tags, some of which may be empty, with spaces."""
+    return ' '.join(tag for tag in tags if tag)
+
+
+def encode_json_float(value):
+    """Returns the JSON for a float, as json.dumps() would."""
+    if math.isfinite(value):
+        return float.__repr__(value)
+    return json.dumps(value)
+
+
+class PutEncoder:
+    """Encodes datapoints into the JSON body of an /api/put request, adding
+       the global tags to each of them.
+
+       The JSON is written out directly rather than built from a dict per
+       datapoint and dumped with json.dumps().  The global tags are encoded
+       once and for all, and the tags of a line that only uses the
+       characters the ReaderThread lets through are turned into JSON with a
+       couple of string replacements."""
+
+    # A line we can encode without escaping anything.
+    SIMPLE_LINE_RE = re.compile(r'([-_./a-zA-Z0-9]+) +'  # Metric name.
+                                r'([0-9]+) +'  # Timestamp.
+                                r'(\S+)'  # Value.
+                                r'((?: +[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*) *')  # Tags
+
+    def __init__(self, tags, maxtags):
+        """tags: a list of (name, value) pairs to add to every datapoint.
+           maxtags: the maximum number of tags the TSD will accept."""
+        self.tags = tags
+        self.maxtags = maxtags
+        self.global_tags = ','.join('%s:%s' % (encode_basestring_ascii(name),
+                                               encode_basestring_ascii(value))
+                                    for name, value in tags)
+        # Matches lines that have one of the tags we'd otherwise add.
+        self.global_tag_re = None
+        if tags:
+            self.global_tag_re = re.compile('|'.join(' %s=' % re.escape(name)
+                                                     for name, _ in tags))
+
+    def encode(self, lines):
+        """Returns the JSON array of the datapoints in lines, as bytes.
+           Lines that can't be encoded are logged and skipped."""
+        datapoints = []
+        for line in lines:
+            try:
+                datapoints.append(self.encode_line(line))
+            except ValueError:
+                LOG.error('Not sending invalid line: %r', line)
+        return ('[%s]' % ','.join(datapoints)).encode('utf-8')
+
+    def encode_line(self, line):
+        """Returns the JSON object of the datapoint in line."""
+        match = self.SIMPLE_LINE_RE.fullmatch(line)
+        if match is None:
+            return self.encode_line_slowly(line)
+        metric, timestamp, value, raw_tags = match.groups()
+        tags = raw_tags.split()
+        if tags:
+            if (len(tags) + len(self.tags) > self.maxtags
+                    or self.global_tag_re and self.global_tag_re.search(raw_tags)
+                    or len(set(tag[:tag.index('=')] for tag in tags)) < len(tags)):
+                # The slow path also keeps only the last of repeated tags.
+                return self.encode_line_slowly(line)
+            tags = '"%s"' % '","'.join(tags).replace('=', '":"')
+            if self.global_tags:
+                tags = self.global_tags + ',' + tags
+        else:
+            tags = self.global_tags
+        return '{"metric":"%s","timestamp":%d,"value":%s,"tags":{%s}}' % (
+            metric, int(timestamp), encode_json_float(float(value)), tags)
+
+    def encode_line_slowly(self, line):
+        """Same as encode_line(), for lines that need escaping, have too
+           many tags, repeat a tag, or override a global tag."""
+        parts = line.split(None, 3)
+        if len(parts) < 3:
+            raise ValueError('not enough fields')
+        metric, timestamp, value = parts[:3]
+        tags = dict(self.tags)
+        extra_tags = {}
+        for tag in parts[3].split() if len(parts) == 4 else ():
+            name, tag_value = tag.split('=', 1)
+            if name in tags:
+                tags[name] = tag_value  # The line overrides our global tags.
+            else:
+                extra_tags[name] = tag_value
+        allowed = max(0, self.maxtags - len(tags))
+        if len(extra_tags) > allowed:
+            removed = list(extra_tags)[allowed:]
+            LOG.error("Exceeding maximum permitted metric tags - removing %s for metric %s",
+                      removed, metric)
+            for name in removed:
+                del extra_tags[name]
+        tags.update(extra_tags)
+        return '{"metric":%s,"timestamp":%d,"value":%s,"tags":{%s}}' % (
+            encode_basestring_ascii(metric), int(timestamp), encode_json_float(float(value)),
+            ','.join('%s:%s' % (encode_basestring_ascii(name), encode_basestring_ascii(tag_value))
+                     for name, tag_value in tags.items()))
+
+
+class FlushPolicy:
+    """Decides when the SenderThread should send the datapoints it has
+       queued up.
+
+       A batch is sent as soon as it has max_points datapoints or max_bytes
+       bytes.  A smaller batch lingers for more datapoints to show up, for
+       LINGER_RTT_RATIO times as long as it takes to send a batch to the
+       TSD, within [min_linger, max_linger] seconds: when sending is cheap
+       we send often, when it's expensive we make the most of it."""
+
+    def __init__(self, max_points=MAX_SENDQ_SIZE, max_bytes=1024 * 1024,
+                 min_linger=1, max_linger=5):
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.min_linger = min_linger
+        self.max_linger = max_linger
+        self.rtt = None  # Moving average of how long a send takes.
+        # How long the last batches we sent waited, in seconds, from the
+        # time their first datapoint was queued.
+        self.latencies = deque(maxlen=FLUSH_LATENCY_SAMPLES)
+
+    def linger(self):
+        """Returns how long a batch that isn't full may wait, in seconds."""
+        if self.rtt is None:
+            return self.min_linger
+        return min(self.max_linger, max(self.min_linger, self.rtt * LINGER_RTT_RATIO))
+
+    def record_send(self, first_queued, start, end):
+        """Records a batch that was sent successfully: when its first
+           datapoint was queued, and when we started and finished sending
+           it."""
+        rtt = end - start
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += (rtt - self.rtt) * RTT_EWMA_WEIGHT
+        self.latencies.append(end - first_queued)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99, 100)):
+        """Returns a dict mapping each percentile to the latency of the
+           last batches we sent, in seconds."""
+        if not self.latencies:
+            return {}
+        latencies = sorted(self.latencies)
+        return dict((pct, latencies[min(len(latencies) - 1, len(latencies) * pct // 100)])
+                    for pct in percentiles)
+
+
+class TokenBucket:
+    """Lets through rate units per second on average, in bursts of up to
+       burst units.  Taking more than is available puts the bucket in debt,
+       which it has to pay back before it lets anything else through, so a
+       batch never has to be split up."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate * RATE_LIMIT_BURST
+        self.tokens = self.burst
+        self.last_refill = time.time()
+
+    def available(self):
+        """Returns how many units we can take right now."""
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        return self.tokens
+
+    def delay(self):
+        """Returns how long, in seconds, until we're out of debt."""
+        return max(0, -self.available() / self.rate)
+
+    def take(self, amount):
+        self.tokens = self.available() - amount
+
+    def to_json(self):
+        return {'rate': self.rate, 'burst': self.burst, 'tokens': self.available()}
+
+
+class TSDResponseReader(threading.Thread):
+    """Reads whatever a TSD sends back on a telnet connection, so that it
+       doesn't pile up in the kernel's queues and so that we can tell the
+       connection is alive without waiting for an answer.
+
+       The TSD only answers puts when they fail.  We count the errors by
+       metric, when the error message tells us which one it was about."""
+
+    # Where a metric name shows up in the errors of the TSD, e.g.:
+    # put: unknown metric: No such name for 'metrics': 'foo.bar'
+    # put: illegal argument: Invalid metric name ("foo bar"): illegal character:
+    ERROR_METRIC_RES = [re.compile(r"'metrics': '([-_./a-zA-Z0-9]+)'"),
+                        re.compile(r'metric name \("([-_./a-zA-Z0-9]+)"\)')]
+
+    def __init__(self, sock, errors):
+        """sock: the socket connected to the TSD.
+           errors: a dictionary mapping metrics to the number of errors we
+             got for them, which we update."""
+        super(TSDResponseReader, self).__init__()
+        self.daemon = True
+        self.sock = sock
+        self.errors = errors
+        self.last_received = 0  # When we last heard from the TSD.
+        self.last_answer = 0  # When it last answered something other than a put.
+        self.buffer = b''
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            if not data:
+                break
+            self.last_received = time.time()
+            lines = (self.buffer + data).split(b'\n')
+            self.buffer = lines.pop()
+            for line in lines:
+                self.handle_response(line.decode('utf-8', 'replace'))
+        LOG.debug('TSD connection closed, done reading responses')
+
+    def handle_response(self, line):
+        """Counts the errors among the responses of the TSD."""
+        if not line.startswith('put: '):
+            # e.g. the answer to a version command.
+            self.last_answer = self.last_received
+            return
+        metric = 'unknown'
+        for regexp in self.ERROR_METRIC_RES:
+            match = regexp.search(line)
+            if match is not None:
+                metric = match.group(1)
+                break
+        if metric not in self.errors and len(self.errors) >= MAX_TSD_ERROR_METRICS:
+            metric = 'other'
+        if metric in self.errors:
+            self.errors[metric] += 1
+            LOG.debug('TSD error for %s: %s', metric, line)
+        else:
+            # Only log the first one, the self-stats keep count of the rest.
+            self.errors[metric] = 1
+            LOG.warning('TSD error for %s: %s', metric, line)
+
+
+class HostHealth:
+    """Keeps track of how well a TSD host is doing, for the SenderThread
+       to pick the best one.  The lower its score, the better."""
+
+    def __init__(self):
+        self.latency = None  # Moving average of our round trips, in seconds.
+        self.error_rate = 0.0  # Moving average of our failures, from 0 to 1.
+        self.successes = 0
+        self.failures = 0
+        self.blacklisted = 0  # When we last blacklisted the host.
+        self.readmitted = 0  # When the host last came back from the blacklist.
+
+    def record_latency(self, latency):
+        """Records the time some exchange with the host took, in seconds,
+           which also counts as a success."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * HEALTH_EWMA_WEIGHT
+        self.successes += 1
+        self.error_rate *= 1 - HEALTH_EWMA_WEIGHT
+
+    def record_error(self):
+        self.failures += 1
+        self.error_rate += (1 - self.error_rate) * HEALTH_EWMA_WEIGHT
+
+    def slow_start(self, now):
+        """Returns how many times slower than it really is the host looks,
+           as it's recovering from being blacklisted."""
+        elapsed = now - self.readmitted
+        if not self.readmitted or elapsed >= SLOW_START_TIME:
+            return 1
+        return SLOW_START_PENALTY - (SLOW_START_PENALTY - 1) * elapsed / SLOW_START_TIME
+
+    def score(self, now, default_latency):
+        """Returns the score of the host, using default_latency if we don't
+           know its latency yet."""
+        latency = default_latency if self.latency is None else self.latency
+        return (latency * (1 + (HOST_ERROR_PENALTY - 1) * self.error_rate)
+                * self.slow_start(now))
+
+    def to_json(self, now, default_latency, blacklisted):
+        return {
+            'score': self.score(now, default_latency),
+            'latency_ms': None if self.latency is None else self.latency * 1000,
+            'error_rate': self.error_rate,
+            'successes': self.successes,
+            'failures': self.failures,
+            'blacklisted': blacklisted,
+            'slow_start': self.slow_start(now),
+        }
+
+
+class HashRing:
+    """A consistent hash ring: maps keys to members so that adding or
+       removing a member only moves the keys that map to it."""
+
+    def __init__(self, members, vnodes=SHARD_VNODES):
+        points = sorted((self.hash('%s-%d' % (member, i)), member)
+                        for member in members for i in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.members = [member for _, member in points]
+
+    @staticmethod
+    def hash(key):
+        """Returns where a string falls on the ring.  Points and keys have to
+           be hashed the same way for them to be spread alike."""
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:4], 'big')
+
+    def get(self, key):
+        """Returns the member a key maps to."""
+        i = bisect.bisect(self.points, self.hash(key))
+        return self.members[i % len(self.members)]
+
+
+class ShardRouter(threading.Thread):
+    """Spreads the lines of the ReaderThread over several SenderThreads,
+       each with its own connection to a TSD and its own queue.  Lines are
+       routed by a consistent hash of their metric and tags, so the
+       datapoints of a series all go, in order, over the same connection.
+
+       A shard that's been disconnected for SHARD_FAILOVER_DELAY seconds is
+       taken out of the ring, and what's queued for it is routed to the
+       others, until it's connected again.  In backpressure mode, we stop
+       taking lines from the reader while the queue of a shard is full."""
+
+    def __init__(self, reader, shards):
+        """reader: the ReaderThread.
+           shards: a list of SenderThreads, each with its own queue."""
+        super(ShardRouter, self).__init__()
+        self.reader = reader
+        self.shards = shards
+        self.healthy = set(range(len(shards)))
+        self.down_since = {}  # Maps a shard to when it was last seen connected.
+        self.ring = HashRing(self.healthy)
+        self.rebalances = 0
+
+    def run(self):
+        while ALIVE:
+            full = [shard.queue for i, shard in enumerate(self.shards)
+                    if i in self.healthy and shard.queue.backpressure and shard.queue.is_full()]
+            if full:
+                # Leave the lines in the reader queue until the shard catches
+                # up, so that the reader stops reading too.
+                full[0].wait_for_room(1)
+                self.check_shards()
+                continue
+            batches = self.reader.readerq.get_batches(MAX_SENDQ_SIZE, 1)
+            self.check_shards()
+            for priority, lines in batches.items():
+                self.route(lines, priority)
+
+    def check_shards(self):
+        """Takes the shards that have been down for too long out of the
+           ring, and puts back those that recovered."""
+        now = time.time()
+        changed = False
+        failed = []
+        for i, shard in enumerate(self.shards):
+            if shard.is_connected():
+                self.down_since.pop(i, None)
+                if i not in self.healthy:
+                    LOG.info('Shard %d is back, rebalancing', i)
+                    self.healthy.add(i)
+                    changed = True
+            elif (now - self.down_since.setdefault(i, now) >= SHARD_FAILOVER_DELAY
+                  and i in self.healthy and len(self.healthy) > 1):
+                LOG.warning('Shard %d is down, rebalancing', i)
+                self.healthy.remove(i)
+                failed.append(i)
+                changed = True
+        if changed:
+            self.ring = HashRing(self.healthy)
+            self.rebalances += 1
+        for i in failed:
+            for priority, lines in self.shards[i].queue.get_batches(timeout=0).items():
+                self.route(lines, priority)
+
+    def route(self, lines, priority=DEFAULT_PRIORITY):
+        """Hands each line over to the queue of its shard."""
+        batches = {}
+        for line in lines:
+            parts = line.split(None, 3)
+            key = parts[0] if len(parts) < 4 else parts[0] + ' ' + parts[3]
+            shard = self.ring.get(key)
+            if shard in batches:
+                batches[shard].append(line)
+            else:
+                batches[shard] = [line]
+        for i, batch in batches.items():
+            shard = self.shards[i]
+            dropped = shard.queue.put_batch(batch, priority)
+            shard.lines_routed += len(batch) - dropped
+            shard.lines_dropped += dropped
+
+    def to_json(self):
+        """Expose the state of the shards in JSON-serializable format."""
+        result = []
+        for i, shard in enumerate(self.shards):
+            info = {"shard": i, "host": "%s:%d" % shard.hosts[0],
+                    "healthy": i in self.healthy, "connected": shard.is_connected(),
+                    "queued": shard.queue.qsize(), "lines_routed": shard.lines_routed,
+                    "lines_dropped": shard.lines_dropped}
+            if shard.spool is not None:
+                info["spool"] = shard.spool.to_json()
+            result.append(info)
+        return {"rebalances": self.rebalances, "shards": result}
 
 
 class SenderThread(threading.Thread):
     """The SenderThread is responsible for maintaining a connection
        to the TSD and sending the data we're getting over to it.  This
        thread is also responsible for doing any sort of emergency
-       buffering we might need to do if we can't establish a connection
-       and we need to spool to disk.  That isn't implemented yet."""
+       buffering we might need to do if we can't establish a connection:
+       given a DiskSpool, it spools the data to disk rather than letting
+       the queues fill up, and replays it once the TSD is back."""
 
     def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
                  reconnectinterval=0, http=False, http_username=None,
-                 http_password=None, http_api_path=None, ssl=False, maxtags=8):
+                 http_password=None, http_api_path=None, ssl=False, maxtags=8,
+                 spool=None, spool_replay_rate=0, http_gzip_level=0,
+                 http_gzip_min_bytes=0, flush_policy=None, queue=None, shard=None,
+                 send_rate_points=0, send_rate_bytes=0, reconnect_jitter=0):
         """Constructor.
 
         Args:
@@ -517,11 +2814,31 @@ class SenderThread(threading.Thread):
           http: A boolean that controls whether or not the http endpoint is used.
           ssl: A boolean that controls whether or not the http endpoint uses ssl.
           tags: A dictionary of tags to append for every data point.
+          spool: A DiskSpool to keep the data we can't send in, if any.
+          spool_replay_rate: How many spooled lines per second to send once
+            the TSD is reachable again.  Zero means as fast as we can.
+          http_gzip_level: The gzip compression level of the HTTP requests,
+            or 0 not to compress them.
+          http_gzip_min_bytes: Don't compress HTTP requests smaller than this.
+          flush_policy: The FlushPolicy deciding when to send data.
+          queue: The ReaderQueue to take data from, if not the reader's.
+          shard: Our number, if we're one of the shards of a ShardRouter.
+          send_rate_points: How many datapoints per second we may send at
+            most, or 0 for no limit.
+          send_rate_bytes: The same, in bytes.
+          reconnect_jitter: How long to wait at most, picked at random,
+            before sending again once the TSD is back.
         """
         super(SenderThread, self).__init__()
 
         self.dryrun = dryrun
         self.reader = reader
+        if queue is None and reader is not None:
+            queue = reader.readerq
+        self.queue = queue
+        self.shard = shard
+        self.lines_routed = 0  # Lines the ShardRouter gave us.
+        self.lines_dropped = 0  # Lines the ShardRouter couldn't give us.
         self.tags = sorted(tags.items())  # dictionary transformed to list
         self.http = http
         self.http_api_path = http_api_path
@@ -532,76 +2849,139 @@ class SenderThread(threading.Thread):
         # Randomize hosts to help even out the load.
         random.shuffle(self.hosts)
         self.blacklisted_hosts = set()  # The 'bad' (host, port) pairs.
+        self.health = dict((hostport, HostHealth()) for hostport in self.hosts)
+        self.version_measured = True  # Whether we timed the last version command.
         self.current_tsd = -1  # Index in self.hosts where we're at.
         self.host = None  # The current TSD host we've selected.
         self.port = None  # The port of the current TSD.
         self.tsd = None  # The socket connected to the aforementioned TSD.
+        self.response_reader = None  # The TSDResponseReader of that socket.
+        self.tsd_errors = {}  # How many errors the TSDs returned, by metric.
+        self.version_sent = 0  # When we last asked the TSD for its version.
         self.last_verify = 0
         self.reconnectinterval = reconnectinterval  # in seconds.
         self.time_reconnect = 0  # if reconnectinterval > 0, used to track the time.
         self.sendq = []
         self.self_report_stats = self_report_stats
         self.maxtags = maxtags  # The maximum number of tags TSD will accept.
+        self.spool = spool
+        self.spool_replay_rate = spool_replay_rate
+        self.last_replay = 0
+        self.send_failed = False  # Whether the last send_data() failed.
+        self.dns_cache = DNSCache()
+        self.http_pool = HTTPConnectionPool(ssl, dns_cache=self.dns_cache)
+        self.put_encoder = PutEncoder(self.tags, maxtags)
+        self.flush_policy = flush_policy or FlushPolicy()
+        self.first_queued = None  # When the oldest line in the sendq was queued.
+        self.http_gzip_level = http_gzip_level
+        self.http_gzip_min_bytes = http_gzip_min_bytes
+        self.http_body_bytes = 0  # Size of the JSON we sent over HTTP.
+        self.http_sent_bytes = 0  # The same, once compressed.
+        self.gzip_cpu_time = 0  # CPU seconds spent compressing it.
+        self.rate_limits = {}  # Maps 'points' and 'bytes' to a TokenBucket.
+        if send_rate_points:
+            self.rate_limits['points'] = TokenBucket(send_rate_points)
+        if send_rate_bytes:
+            self.rate_limits['bytes'] = TokenBucket(send_rate_bytes)
+        self.throttle_time = 0  # How long we waited on the rate limits.
+        self.reconnect_jitter = reconnect_jitter
+
+    def default_latency(self):
+        """Returns the latency we assume for hosts we haven't talked to yet:
+           the best one we know of, so that they get a chance."""
+        latencies = [health.latency for health in self.health.values()
+                     if health.latency is not None]
+        return min(latencies) if latencies else 1
 
     def pick_connection(self):
-        """Picks up a random host/port connection."""
-        # Try to get the next host from the list, until we find a host that
-        # isn't in the blacklist, or until we run out of hosts (i.e. they
-        # are all blacklisted, which typically happens when we lost our
-        # connectivity to the outside world).
-        for self.current_tsd in range(self.current_tsd + 1, len(self.hosts)):
-            hostport = self.hosts[self.current_tsd]
-            if hostport not in self.blacklisted_hosts:
-                break
-        else:
+        """Picks the next host/port connection among the healthiest ones."""
+        now = time.time()
+        for hostport in list(self.blacklisted_hosts):
+            if now - self.health[hostport].blacklisted >= BLACKLIST_TIME:
+                self.readmit(hostport, now)
+        # Walk the list from where we're at, skipping the blacklisted hosts,
+        # unless they are all blacklisted, which typically happens when we
+        # lost our connectivity to the outside world.
+        candidates = [(self.current_tsd + i) % len(self.hosts)
+                      for i in range(1, len(self.hosts) + 1)]
+        candidates = [i for i in candidates if self.hosts[i] not in self.blacklisted_hosts]
+        if not candidates:
             LOG.info('No more healthy hosts, retry with previously blacklisted')
             random.shuffle(self.hosts)
-            self.blacklisted_hosts.clear()
-            self.current_tsd = 0
-            hostport = self.hosts[self.current_tsd]
-        self.host, self.port = hostport
-        LOG.info('Selected connection: %s:%d', self.host, self.port)
+            for hostport in list(self.blacklisted_hosts):
+                self.readmit(hostport, now)
+            candidates = list(range(len(self.hosts)))
+        # Of those, take the first one that isn't much worse than the best.
+        default_latency = self.default_latency()
+        scores = dict((i, self.health[self.hosts[i]].score(now, default_latency))
+                      for i in candidates)
+        best = min(scores.values())
+        for self.current_tsd in candidates:
+            if scores[self.current_tsd] <= best * HOST_SCORE_TOLERANCE:
+                break
+        self.host, self.port = self.hosts[self.current_tsd]
+        LOG.info('Selected connection: %s:%d (score %.3f)', self.host, self.port,
+                 scores[self.current_tsd])
+
+    def readmit(self, hostport, now):
+        """Takes a host off the blacklist, in slow start."""
+        self.blacklisted_hosts.discard(hostport)
+        self.health[hostport].readmitted = now
 
     def blacklist_connection(self):
         """Marks the current TSD host we're trying to use as blacklisted.
 
-           Blacklisted hosts will get another chance to be elected once there
-           will be no more healthy hosts."""
-        # FIXME: Enhance this naive strategy.
+           Blacklisted hosts will get another chance to be elected after
+           BLACKLIST_TIME, or once there will be no more healthy hosts."""
         LOG.info('Blacklisting %s:%s for a while', self.host, self.port)
-        self.blacklisted_hosts.add((self.host, self.port))
+        hostport = (self.host, self.port)
+        self.blacklisted_hosts.add(hostport)
+        self.health[hostport].record_error()
+        self.health[hostport].blacklisted = time.time()
+
+    def hosts_to_json(self):
+        """Returns the health of each of our TSD hosts, for the StatusServer."""
+        now = time.time()
+        default_latency = self.default_latency()
+        return dict(('%s:%d' % hostport,
+                     health.to_json(now, default_latency, hostport in self.blacklisted_hosts))
+                    for hostport, health in self.health.items())
 
     def run(self):
         """Main loop.  A simple scheduler.  Loop waiting for 5
            seconds for data on the queue.  If there's no data, just
            loop and make sure our connection is still open.  If there
-           is data, wait 5 more seconds and grab all of the pending data and
-           send it.  A little better than sending every line as its
-           own packet."""
+           is data, grab more of it until the flush policy says the batch
+           is full or has waited long enough, and send it.  A little better
+           than sending every line as its own packet."""
 
         errors = 0  # How many uncaught exceptions in a row we got.
         while ALIVE:
             try:
                 self.maintain_conn()
-                try:
-                    line = self.reader.readerq.get(True, 5)
-                except Empty:
+                self.replay_spool()
+                if not self.fill_sendq():
                     continue
-                self.sendq.append(line)
-                time.sleep(5)  # Wait for more data
-                while True:
-                    # prevents self.sendq fast growing in case of sending fails
-                    # in send_data()
-                    if len(self.sendq) > MAX_SENDQ_SIZE:
-                        break
-                    try:
-                        line = self.reader.readerq.get(False)
-                    except Empty:
-                        break
-                    self.sendq.append(line)
 
                 if ALIVE:
+                    self.throttle()
+                    start = time.time()
                     self.send_data()
+                    # Whatever is left couldn't be sent.
+                    self.send_failed = bool(self.sendq)
+                    if not self.send_failed:
+                        self.flush_policy.record_send(self.first_queued, start, time.time())
+                        self.first_queued = None
+                    else:
+                        self.spill_to_spool()
+                        if self.sendq:
+                            # Don't hammer the TSD, give it some time.  Over
+                            # HTTP there's no reconnection to spread out, so
+                            # that's where the jitter goes.
+                            delay = self.flush_policy.max_linger
+                            if self.http:
+                                delay += random.uniform(0, self.reconnect_jitter)
+                            time.sleep(delay)
 
                 errors = 0  # We managed to do a successful iteration.
             except (ArithmeticError, EOFError, EnvironmentError, LookupError,
@@ -618,88 +2998,272 @@ class SenderThread(threading.Thread):
                 shutdown()
                 raise
 
+        # Keep what we haven't sent for the next time we start.
+        if self.spool is not None:
+            self.spill_to_spool()
+            self.spool.close()
+        self.http_pool.close_all()
+        self.close_tsd()
+
+    def fill_sendq(self):
+        """Moves lines from the reader queue to the sendq until the flush
+           policy says it's time to send them.  Returns False if there's
+           nothing to send after waiting 5 seconds for data."""
+        policy = self.flush_policy
+        nbytes = sum(len(line) for line in self.sendq)
+        if self.sendq and self.first_queued is None:
+            self.first_queued = time.time()
+        # Don't send more at once than the rate limits allow in a burst.
+        max_points, max_bytes = policy.max_points, policy.max_bytes
+        if 'points' in self.rate_limits:
+            max_points = max(1, min(max_points, int(self.rate_limits['points'].burst)))
+        if 'bytes' in self.rate_limits:
+            max_bytes = max(1, min(max_bytes, int(self.rate_limits['bytes'].burst)))
+        while len(self.sendq) < max_points and nbytes < max_bytes:
+            if self.sendq:
+                timeout = self.first_queued + policy.linger() - time.time()
+                if timeout <= 0:
+                    break
+            else:
+                timeout = 5
+            lines = self.queue.get_batch(max_points - len(self.sendq), timeout,
+                                         max_bytes - nbytes)
+            if not lines:
+                if not self.sendq:
+                    return False
+                break
+            if not self.sendq:
+                self.first_queued = time.time()
+            self.sendq.extend(lines)
+            nbytes += sum(len(line) for line in lines)
+        return True
+
+    def throttle(self):
+        """Waits until the rate limits let us send, and takes what's in the
+           sendq out of them."""
+        delay = max([bucket.delay() for bucket in self.rate_limits.values()] or [0])
+        if delay > 0:
+            LOG.debug('Rate limited, waiting %0.2f seconds', delay)
+            self.throttle_time += delay
+            time.sleep(delay)
+        if 'points' in self.rate_limits:
+            self.rate_limits['points'].take(len(self.sendq))
+        if 'bytes' in self.rate_limits:
+            self.rate_limits['bytes'].take(sum(len(line) for line in self.sendq))
+
+    def rate_limits_to_json(self):
+        """Returns the state of our rate limits, for the StatusServer."""
+        result = dict((name, bucket.to_json()) for name, bucket in self.rate_limits.items())
+        result['throttled_seconds'] = self.throttle_time
+        return result
+
+    def is_connected(self):
+        """Returns whether we seem to be able to send data to the TSD."""
+        if self.dryrun:
+            return True
+        if self.http:
+            return not self.send_failed
+        return self.tsd is not None
+
+    def spill_to_spool(self):
+        """Moves the sendq and whatever is waiting in the reader queue to the
+           spool, if we have one, so the reader doesn't have to drop data
+           while we can't send it."""
+        if self.spool is None:
+            return
+        lines = self.sendq
+        self.sendq = []
+        lines.extend(self.queue.get_batch(timeout=0))
+        if lines:
+            LOG.debug('Spooling %d lines', len(lines))
+            self.spool.append(lines)
+
+    def replay_spool(self):
+        """Moves spooled lines back to the sendq, at no more than
+           spool_replay_rate lines per second, unless the last send failed.
+           Live data goes first: when we're rate limited, we only replay
+           what the limit leaves room for once the reader queue is sent."""
+        now = time.time()
+        if self.spool is None or not self.spool:
+            self.last_replay = now
+            return
+        # maintain_conn() also returns when we're shutting down.
+        if self.send_failed or not ALIVE:
+            return
+        if self.spool_replay_rate:
+            budget = int((now - self.last_replay) * self.spool_replay_rate)
+        else:
+            budget = MAX_SENDQ_SIZE
+        budget = min(budget, MAX_SENDQ_SIZE)
+        if 'points' in self.rate_limits:
+            budget = min(budget, int(self.rate_limits['points'].available())
+                         - self.queue.qsize() - len(self.sendq))
+        if budget <= 0:
+            return
+        self.last_replay = now
+        lines = self.spool.read(budget)
+        LOG.debug('Replaying %d spooled lines', len(lines))
+        self.sendq.extend(lines)
+
     def verify_conn(self):
         """Periodically verify that our connection to the TSD is OK
            and that the TSD is alive/working."""
-        # http connections don't need this
+        # http connections don't need this, but we still report our stats
         if self.http:
+            if self.last_verify <= time.time() - 60:
+                self.report_stats()
+                self.last_verify = time.time()
             return True
 
         if self.tsd is None:
             return False
 
+        # We don't wait for the TSD to answer our version commands, but we
+        # give up on it if it hasn't said anything at all for a while since.
+        now = time.time()
+        if not self.response_reader.is_alive():
+            LOG.warning('TSD %s:%s closed the connection', self.host, self.port)
+            self.close_tsd()
+            self.blacklist_connection()
+            return False
+        if self.response_reader.last_received < self.version_sent:
+            if now - self.version_sent < TSD_RESPONSE_TIMEOUT:
+                return True
+            LOG.warning('TSD %s:%s did not answer for %d seconds',
+                        self.host, self.port, now - self.version_sent)
+            self.close_tsd()
+            self.blacklist_connection()
+            return False
+        if not self.version_measured and self.response_reader.last_answer >= self.version_sent:
+            self.health[(self.host, self.port)].record_latency(
+                self.response_reader.last_answer - self.version_sent)
+            self.version_measured = True
+
         # if the last verification was less than a minute ago, don't re-verify
-        if self.last_verify > time.time() - 60:
+        if self.last_verify > now - 60:
             return True
 
         # in case reconnect is activated, check if it's time to reconnect
-        if self.reconnectinterval > 0 and self.time_reconnect < time.time() - self.reconnectinterval:
+        if self.reconnectinterval > 0 and self.time_reconnect < now - self.reconnectinterval:
             # closing the connection and indicating that we need to reconnect.
-            try:
-                self.tsd.close()
-            except socket.error as msg:
-                pass  # not handling that
-            self.time_reconnect = time.time()
+            self.close_tsd()
+            self.time_reconnect = now
             return False
 
         # we use the version command as it is very low effort for the TSD
-        # to respond
+        # to respond.  The TSDResponseReader will tell us when it does.
         LOG.debug('verifying our TSD connection is alive')
         try:
             self.tsd.sendall(bytearray('version\n', 'utf-8'))
         except socket.error as msg:
-            self.tsd = None
+            self.close_tsd()
             self.blacklist_connection()
             return False
+        self.version_sent = now
+        self.version_measured = False
 
-        bufsize = 4096
-        while ALIVE:
-            # try to read as much data as we can.  at some point this is going
-            # to block, but we have set the timeout low when we made the
-            # connection
-            try:
-                buf = self.tsd.recv(bufsize)
-            except socket.error as msg:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
+        # Send out our meta stats.  This helps to see what is going on
+        # with the tcollector.
+        self.report_stats()
 
-            # If we don't get a response to the 'version' request, the TSD
-            # must be dead or overloaded.
-            if not buf:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
+        self.last_verify = now
+        return True
 
-            # Woah, the TSD has a lot of things to tell us...  Let's make
-            # sure we read everything it sent us by looping once more.
-            if len(buf) == bufsize:
-                continue
+    def close_tsd(self):
+        """Closes our telnet connection to the TSD, if any, which also stops
+           the thread reading its responses."""
+        if self.tsd is None:
+            return
+        try:
+            # Wakes up the TSDResponseReader, unlike close().
+            self.tsd.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        try:
+            self.tsd.close()
+        except socket.error:
+            pass
+        self.tsd = None
+        self.response_reader = None
 
-            # If everything is good, send out our meta stats.  This
-            # helps to see what is going on with the tcollector.
-            # TODO need to fix this for http
-            if self.self_report_stats:
-                strs = [
-                    ('reader.lines_collected', '', self.reader.lines_collected),
-                    ('reader.lines_dropped', '', self.reader.lines_dropped)
-                ]
-
-                for col in all_living_collectors():
-                    strs.append(('collector.lines_sent', 'collector=' + col.name, col.lines_sent))
-                    strs.append(('collector.lines_received', 'collector=' + col.name, col.lines_received))
-                    strs.append(('collector.lines_invalid', 'collector=' + col.name, col.lines_invalid))
-
-                ts = int(time.time())
-                strout = ["tcollector.%s %d %d %s" % (x[0], ts, x[2], x[1]) for x in strs]
-                for string in strout:
-                    self.sendq.append(string)
-
-            break  # TSD is alive.
-
-        # if we get here, we assume the connection is good
-        self.last_verify = time.time()
-        return True
+    def report_stats(self):
+        """Queues up our own stats, if we're supposed to report them."""
+        if not self.self_report_stats:
+            return
+        # With shards, the first one reports the stats of the reader and
+        # collectors, and they all report their own.
+        tags = ''
+        strs = []
+        if self.shard is not None:
+            tags = 'shard=%d' % self.shard
+            strs.extend([
+                ('sender.lines_routed', tags, self.lines_routed),
+                ('sender.lines_dropped', tags, self.lines_dropped)
+            ])
+            for priority, dropped in self.queue.dropped().items():
+                strs.append(('sender.priority_lines_dropped',
+                             join_tags('priority=' + priority, tags), dropped))
+        if not self.shard:
+            strs.extend([
+                ('reader.lines_collected', '', self.reader.lines_collected),
+                ('reader.lines_dropped', '', self.reader.lines_dropped),
+                ('reader.wakeups', '', self.reader.wakeups),
+                ('reader.backpressure_waits', '', self.reader.backpressure_waits),
+                ('reader.dedup_series', '', len(self.reader.dedup)),
+                ('reader.dedup_bytes', '', self.reader.dedup.bytes)
+            ])
+            for priority, dropped in self.reader.readerq.dropped().items():
+                strs.append(('reader.priority_lines_dropped', 'priority=' + priority, dropped))
+        if self.flush_policy.rtt is not None:
+            strs.append(('sender.rtt_ms', tags, self.flush_policy.rtt * 1000))
+        for pct, latency in sorted(self.flush_policy.latency_percentiles().items()):
+            strs.append(('sender.batch_latency_ms', join_tags('quantile=%d' % pct, tags),
+                         latency * 1000))
+        # The TSDResponseReader adds to tsd_errors in its own thread, so take
+        # a copy in one go before looking at it.
+        for metric, count in sorted(list(self.tsd_errors.items())):
+            strs.append(('sender.tsd_errors', join_tags('metric=' + metric, tags), count))
+        if self.http:
+            strs.extend([
+                ('sender.http_body_bytes', tags, self.http_body_bytes),
+                ('sender.http_sent_bytes', tags, self.http_sent_bytes),
+                ('sender.gzip_cpu_ms', tags, self.gzip_cpu_time * 1000)
+            ])
+        if self.rate_limits:
+            strs.append(('sender.throttled_ms', tags, self.throttle_time * 1000))
+        if self.spool is not None:
+            strs.extend([
+                ('spool.bytes', tags, self.spool.bytes),
+                ('spool.lines_spooled', tags, self.spool.lines_spooled),
+                ('spool.lines_replayed', tags, self.spool.lines_replayed),
+                ('spool.bytes_discarded', tags, self.spool.bytes_discarded)
+            ])
+
+        if not self.shard:
+            for col in all_collectors():
+                if col.lastspawn:
+                    strs.append(('collector.spawn_latency_ms', 'collector=' + col.name,
+                                 int(col.spawn_latency * 1000)))
+                if col.lastspawn and col.interval:
+                    strs.append(('collector.schedule_lag_ms', 'collector=' + col.name,
+                                 int(col.schedule_lag * 1000)))
+            for col in all_living_collectors():
+                strs.append(('collector.lines_sent', 'collector=' + col.name, col.lines_sent))
+                strs.append(('collector.pipe_backlog_bytes', 'collector=' + col.name,
+                             col.pipe_backlog()))
+                strs.append(('collector.lines_backlog', 'collector=' + col.name,
+                             len(col.datalines)))
+                strs.append(('collector.read_budget_exhausted', 'collector=' + col.name,
+                             col.budget_exhausted))
+                strs.append(('collector.lines_received', 'collector=' + col.name,
+                             col.lines_received))
+                strs.append(('collector.lines_invalid', 'collector=' + col.name,
+                             col.lines_invalid))
+
+        ts = int(time.time())
+        strout = ["tcollector.%s %d %d %s" % (x[0], ts, x[2], x[1]) for x in strs]
+        for string in strout:
+            self.sendq.append(string)
 
     def maintain_conn(self):
         """Safely connect to the TSD and ensure that it's up and
@@ -707,7 +3271,10 @@ class SenderThread(threading.Thread):
            (no response)."""
 
         # dry runs and http are always good
-        if self.dryrun or self.http:
+        if self.dryrun:
+            return
+        if self.http:
+            self.verify_conn()  # Only to report our stats.
             return
 
         # connection didn't verify, so create a new one.  we might be in
@@ -724,37 +3291,58 @@ class SenderThread(threading.Thread):
             if try_delay > 600:
                 try_delay *= 0.5
             LOG.debug('SenderThread blocking %0.2f seconds', try_delay)
-            time.sleep(try_delay)
+            if self.spool is None:
+                time.sleep(try_delay)
+            else:
+                self.spill_while_waiting(try_delay)
 
             # Now actually try the connection.
             self.pick_connection()
             try:
-                addresses = socket.getaddrinfo(self.host, self.port,
-                                               socket.AF_UNSPEC,
-                                               socket.SOCK_STREAM, 0)
+                addresses = self.dns_cache.resolve(self.host, self.port)
             except socket.gaierror as e:
                 # Don't croak on transient DNS resolution issues.
-                if e[0] in (socket.EAI_AGAIN, socket.EAI_NONAME,
-                            socket.EAI_NODATA):
+                if e.errno in (socket.EAI_AGAIN, socket.EAI_NONAME,
+                               socket.EAI_NODATA):
                     LOG.debug('DNS resolution failure: %s: %s', self.host, e)
+                    self.blacklist_connection()
                     continue
                 raise
-            for family, socktype, proto, canonname, sockaddr in addresses:
-                try:
-                    self.tsd = socket.socket(family, socktype, proto)
-                    self.tsd.settimeout(15)
-                    self.tsd.connect(sockaddr)
-                    # if we get here it connected
-                    LOG.debug('Connection to %s was successful' % (str(sockaddr)))
-                    break
-                except socket.error as msg:
-                    LOG.warning('Connection attempt failed to %s:%d: %s',
-                                self.host, self.port, msg)
-                self.tsd.close()
-                self.tsd = None
-            if not self.tsd:
-                LOG.error('Failed to connect to %s:%d', self.host, self.port)
+            start = time.time()
+            try:
+                self.tsd, sockaddr = connect_race(addresses)
+            except socket.error as msg:
+                LOG.error('Failed to connect to %s:%d: %s', self.host, self.port, msg)
+                # The host may have moved, look it up again next time.
+                self.dns_cache.expire(self.host, self.port)
                 self.blacklist_connection()
+                continue
+            self.health[(self.host, self.port)].record_latency(time.time() - start)
+            LOG.debug('Connection to %s was successful', sockaddr)
+            self.tsd.settimeout(15)
+            self.response_reader = TSDResponseReader(self.tsd, self.tsd_errors)
+            self.response_reader.start()
+            self.version_sent = 0
+            self.version_measured = True
+            if self.reconnect_jitter:
+                # Don't all come back at the same time after an outage.
+                delay = random.uniform(0, self.reconnect_jitter)
+                LOG.info('Connected, waiting %0.2f seconds before sending', delay)
+                if self.spool is None:
+                    time.sleep(delay)
+                else:
+                    self.spill_while_waiting(delay)
+
+    def spill_while_waiting(self, delay):
+        """Sleeps for delay seconds, spilling the reader queue to the spool
+           every few seconds so it never fills up."""
+        deadline = time.time() + delay
+        while ALIVE:
+            self.spill_to_spool()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 5))
 
     def add_tags_to_line(self, line):
         for tag, value in self.tags:
@@ -793,97 +3381,78 @@ class SenderThread(threading.Thread):
             self.sendq = []
         except socket.error as msg:
             LOG.error('failed to send data: %s', msg)
-            try:
-                self.tsd.close()
-            except socket.error:
-                pass
-            self.tsd = None
+            self.close_tsd()
             self.blacklist_connection()
 
-        # FIXME: we should be reading the result at some point to drain
-        # the packets out of the kernel's queue
+    def build_http_path(self):
+        details = ""
+        if LOG.level == logging.DEBUG:
+            details = "?details"
+        return "/%s%s" % (self.http_api_path, details)
 
     def build_http_url(self):
         if self.ssl:
             protocol = "https"
         else:
             protocol = "http"
-        details = ""
-        if LOG.level == logging.DEBUG:
-            details = "?details"
-        return "%s://%s:%s/%s%s" % (protocol, self.host, self.port, self.http_api_path, details)
+        return "%s://%s:%s%s" % (protocol, self.host, self.port, self.build_http_path())
+
+    def encode_http_body(self, body, headers):
+        """Compresses the body of an HTTP request if it's worth it, in
+           which case the Content-Encoding is added to the headers."""
+        self.http_body_bytes += len(body)
+        if self.http_gzip_level and len(body) >= self.http_gzip_min_bytes:
+            start = time.thread_time()
+            body = gzip.compress(body, self.http_gzip_level)
+            self.gzip_cpu_time += time.thread_time() - start
+            headers["Content-Encoding"] = "gzip"
+        self.http_sent_bytes += len(body)
+        return body
 
     def send_data_via_http(self):
         """Sends outstanding data in self.sendq to TSD in one HTTP API call."""
-        metrics = []
-        for line in self.sendq:
-            # print " %s" % line
-            parts = line.split(None, 3)
-            # not all metrics have metric-specific tags
-            if len(parts) == 4:
-                (metric, timestamp, value, raw_tags) = parts
-            else:
-                (metric, timestamp, value) = parts
-                raw_tags = ""
-            # process the tags
-            metric_tags = {}
-            for tag in raw_tags.strip().split():
-                (tag_key, tag_value) = tag.split("=", 1)
-                metric_tags[tag_key] = tag_value
-            metric_entry = {}
-            metric_entry["metric"] = metric
-            metric_entry["timestamp"] = int(timestamp)
-            metric_entry["value"] = float(value)
-            metric_entry["tags"] = dict(self.tags).copy()
-            if len(metric_tags) + len(metric_entry["tags"]) > self.maxtags:
-                metric_tags_orig = set(metric_tags)
-                subset_metric_keys = frozenset(
-                    metric_tags[:len(metric_tags[:self.maxtags - len(metric_entry["tags"])])])
-                metric_tags = dict((k, v) for k, v in metric_tags.items() if k in subset_metric_keys)
-                LOG.error("Exceeding maximum permitted metric tags - removing %s for metric %s",
-                          str(metric_tags_orig - set(metric_tags)), metric)
-            metric_entry["tags"].update(metric_tags)
-            metrics.append(metric_entry)
+        body = self.put_encoder.encode(self.sendq)
 
         if self.dryrun:
-            print("Would have sent:\n%s" % json.dumps(metrics, sort_keys=True, indent=4))
+            print("Would have sent:\n%s" % json.dumps(json.loads(body), sort_keys=True, indent=4))
             return
 
         if ((self.current_tsd == -1) or (len(self.hosts) > 1)):
             self.pick_connection()
 
-        url = self.build_http_url()
-        LOG.debug("Sending metrics to url: %s", url)
-        req = Request(url)
+        LOG.debug("Sending metrics to url: %s", self.build_http_url())
+        headers = {"Content-Type": "application/json"}
         if self.http_username and self.http_password:
-            req.add_header("Authorization", "Basic %s"
-                           % base64.b64encode("%s:%s" % (self.http_username, self.http_password)))
-        req.add_header("Content-Type", "application/json")
+            credentials = "%s:%s" % (self.http_username, self.http_password)
+            headers["Authorization"] = "Basic %s" % (
+                base64.b64encode(credentials.encode("utf-8")).decode("ascii"))
+        body = self.encode_http_body(body, headers)
+        start = time.time()
         try:
-            body = json.dumps(metrics)
-            if not isinstance(body, bytes):
-                body = body.encode("utf-8")
-            response = urlopen(req, body)
-            LOG.debug("Received response %s %s", response.getcode(), response.read().rstrip(b'\n'))
+            status, reason, data = self.http_pool.request(
+                self.host, self.port, "POST", self.build_http_path(), body, headers)
+        except (http.client.HTTPException, OSError) as e:
+            LOG.error("Got error URL %s", e)
+            self.blacklist_connection()
+            return
+        if status < 500:
+            self.health[(self.host, self.port)].record_latency(time.time() - start)
+        else:
+            self.health[(self.host, self.port)].record_error()
 
+        if 200 <= status < 300:
+            LOG.debug("Received response %s %s", status, data.rstrip(b'\n'))
             # clear out the sendq
             self.sendq = []
-            # print "Got response code: %s" % response.getcode()
-            # print "Content:"
-            # for line in response:
-            #     print line,
-            #     print
-        except HTTPError as e:
-            if e.code == 400:
-                LOG.error("Some data was bad, so not going to resend it.")
-                # This means one or more of the data points were bad
-                # (http://opentsdb.net/docs/build/html/api_http/put.html#response).
-                # As such, there's no point resending them.
-                self.sendq = []
-
-            LOG.error("Got error %s %s", e, e.read())
-        except URLError as e:
-            LOG.error("Got error URL %s", e)
+            return
+        if status == 400:
+            LOG.error("Some data was bad, so not going to resend it.")
+            # This means one or more of the data points were bad
+            # (http://opentsdb.net/docs/build/html/api_http/put.html#response).
+            # As such, there's no point resending them.
+            self.sendq = []
+
+        LOG.error("Got error HTTP Error %s: %s %s", status, reason, data)
 
 
 def setup_logging(logfile=DEFAULT_LOG, logstdout=False):
@@ -937,6 +3506,29 @@ def parse_cmdline(argv):
             "monitoring_interface": None,
             "monitoring_port": 13280,
             "namespace_prefix": "",
+            "reader_mode": "poll",
+            "dedup_max_bytes": 0,
+            "spool_dir": None,
+            "spool_max_bytes": 1024 * 1024 * 1024,
+            "spool_fsync": "segment",
+            "spool_replay_rate": 10000,
+            "http_gzip_level": 0,
+            "http_gzip_min_bytes": 1024,
+            "flush_max_points": MAX_SENDQ_SIZE,
+            "flush_max_bytes": 1024 * 1024,
+            "flush_min_linger": 1.0,
+            "flush_max_linger": 5.0,
+            "shards": 0,
+            "send_rate_points": 0,
+            "send_rate_bytes": 0,
+            "reconnect_jitter": 0,
+            "collector_priorities": DEFAULT_COLLECTOR_PRIORITIES,
+            "overload": "drop",
+            "pipe_size": 0,
+            "in_process_collectors": "",
+            "zygote": False,
+            "rescan_interval": 300,
+            "startup_concurrency": 0,
         }
     except Exception as e:
         sys.stderr.write("Unexpected error: %s\n" % e)
@@ -997,6 +3589,12 @@ def parse_cmdline(argv):
     parser.add_option('--dedup-only-zero', dest='deduponlyzero', action='store_true',
                       default=defaults['deduponlyzero'],
                       help='Only dedup 0 values.')
+    parser.add_option('--dedup-max-bytes', dest='dedup_max_bytes', type='int',
+                      default=defaults.get('dedup_max_bytes', 0), metavar='BYTES',
+                      help='Approximate memory limit for the cache of last values '
+                           'used to dedup datapoints.  The least recently updated '
+                           'series are evicted first.  Use zero for no limit. '
+                           'default=%default')
     parser.add_option('--evict-interval', dest='evictinterval', type='int',
                       default=defaults['evictinterval'], metavar='EVICTINTERVAL',
                       help='Number of seconds after which to remove cached '
@@ -1030,6 +3628,15 @@ def parse_cmdline(argv):
                       help='Username to use for HTTP Basic Auth when sending the data via HTTP')
     parser.add_option('--http-password', dest='http_password', default=defaults['http_password'],
                       help='Password to use for HTTP Basic Auth when sending the data via HTTP')
+    parser.add_option('--http-gzip-level', dest='http_gzip_level', type='int',
+                      default=defaults.get('http_gzip_level', 0), metavar='LEVEL',
+                      help='Compress the data sent via the http interface with gzip '
+                           'at this level, from 1 (fastest) to 9 (smallest).  Use '
+                           'zero not to compress it.  default=%default')
+    parser.add_option('--http-gzip-min-bytes', dest='http_gzip_min_bytes', type='int',
+                      default=defaults.get('http_gzip_min_bytes', 1024), metavar='BYTES',
+                      help='Only compress requests at least this large. '
+                           'default=%default')
     parser.add_option('--ssl', dest='ssl', action='store_true', default=defaults['ssl'],
                       help='Enable SSL - used in conjunction with http')
     parser.add_option('--namespace-prefix', dest='namespace_prefix', default=defaults["namespace_prefix"],
@@ -1043,6 +3650,136 @@ def parse_cmdline(argv):
     parser.add_option('--monitoring-port', dest='monitoring_port', action='store',
                       default=defaults.get("monitoring_port", 13280), type='int',
                       help="Port for status API to listen on.")
+    parser.add_option('--reader-mode', dest='reader_mode', type='choice',
+                      choices=['poll', 'select'],
+                      default=defaults.get("reader_mode", "poll"),
+                      help="How the reader waits for collector output: 'poll' "
+                           "reads every collector once per second, 'select' "
+                           "sleeps until a collector has written something. "
+                           "default=%default")
+
+    parser.add_option('--collector-priorities', dest='collector_priorities',
+                      default=defaults.get('collector_priorities', DEFAULT_COLLECTOR_PRIORITIES),
+                      metavar='NAME=CLASS,...',
+                      help='Priority class (%s) of collectors, by name, with or '
+                           'without extension.  When the reader queue backs up, '
+                           'the most important collectors get more of what is '
+                           'sent, and the least important are dropped first. '
+                           'Collectors not listed are %s.  default=%%default'
+                      % ('|'.join(PRIORITY_WEIGHTS), DEFAULT_PRIORITY))
+    parser.add_option('--overload', dest='overload', type='choice',
+                      choices=list(OVERLOAD_MODES),
+                      default=defaults.get('overload', 'drop'),
+                      help="What to do when the reader queue is full: 'drop' "
+                           "lines, or apply 'backpressure' by not reading the "
+                           "collectors' pipes until there's room, so that they "
+                           "block writing to them.  default=%default")
+    parser.add_option('--pipe-size', dest='pipe_size', type='int',
+                      default=defaults.get('pipe_size', 0), metavar='BYTES',
+                      help='Size of the pipes the collectors write to (Linux '
+                           'only), or 0 for the system default, usually 64KB. '
+                           'Larger pipes let collectors get further ahead of us '
+                           'before they block.  default=%default')
+    parser.add_option('--in-process-collectors', dest='in_process_collectors',
+                      default=defaults.get('in_process_collectors', ''),
+                      metavar='NAME,...',
+                      help='Python collectors, by name with or without '
+                           'extension, to run in threads of the tcollector '
+                           'process rather than as subprocesses, which saves '
+                           'the memory and startup time of an interpreter each. '
+                           'They run with the privileges of tcollector, except '
+                           'that those which drop privileges when tcollector '
+                           'runs as root are run as subprocesses instead.  They '
+                           'must not install signal handlers or use threads of '
+                           'their own.  default=%default')
+    parser.add_option('--zygote', dest='zygote', action='store_true',
+                      default=defaults.get('zygote', False),
+                      help='Fork the Python interval collectors from a process '
+                           'that has already started Python and imported the '
+                           'modules collectors commonly use, rather than '
+                           'starting each run from scratch.  They run with our '
+                           'Python interpreter, whatever their #! line says.  '
+                           'The process is restarted when one of those modules '
+                           'changes.  Linux only.')
+    parser.add_option('--rescan-interval', dest='rescan_interval', type='int',
+                      default=defaults.get('rescan_interval', 300), metavar='SECONDS',
+                      help='Where inotify is available, we pick up changes to '
+                           'the collectors and config modules as they happen, '
+                           'and only rescan their directories this often in '
+                           'case we missed some, e.g. on NFS.  Otherwise, we '
+                           'rescan them every %d seconds.  default=%%default'
+                           % HOUSEKEEPING_INTERVAL)
+    parser.add_option('--startup-concurrency', dest='startup_concurrency', type='int',
+                      default=defaults.get('startup_concurrency', 0), metavar='N',
+                      help='Start the collectors that have never run in waves '
+                           'of at most N at once, long-lived ones first and '
+                           'then by priority class, each done starting once it '
+                           'has sent a datapoint, exited, or after %d seconds.  '
+                           'With 0, long-lived ones start right away and '
+                           'interval ones are spread over up to %d seconds.  '
+                           'default=%%default'
+                           % (STARTUP_TIMEOUT, SCHEDULE_SPREAD))
+    parser.add_option('--shards', dest='shards', type='int',
+                      default=defaults.get('shards', 0), metavar='N',
+                      help='Send to N TSD connections at once, going round the '
+                           'hosts of --hosts-list, and spread the series over '
+                           'them by a consistent hash of their metric and tags. '
+                           'Zero means one connection, failing over to the '
+                           'next host when it breaks.  default=%default')
+    parser.add_option('--flush-max-points', dest='flush_max_points', type='int',
+                      default=defaults.get('flush_max_points', MAX_SENDQ_SIZE),
+                      metavar='POINTS',
+                      help='Send datapoints to the TSD as soon as we have this many. '
+                           'default=%default')
+    parser.add_option('--flush-max-bytes', dest='flush_max_bytes', type='int',
+                      default=defaults.get('flush_max_bytes', 1024 * 1024), metavar='BYTES',
+                      help='Send datapoints to the TSD as soon as they add up to '
+                           'this many bytes.  default=%default')
+    parser.add_option('--flush-min-linger', dest='flush_min_linger', type='float',
+                      default=defaults.get('flush_min_linger', 1.0), metavar='SECONDS',
+                      help='How long datapoints wait for more before being sent, '
+                           'at least.  They wait longer if the TSD is slow to '
+                           'respond.  default=%default')
+    parser.add_option('--flush-max-linger', dest='flush_max_linger', type='float',
+                      default=defaults.get('flush_max_linger', 5.0), metavar='SECONDS',
+                      help='How long datapoints wait for more before being sent, '
+                           'at most.  default=%default')
+    parser.add_option('--send-rate-points', dest='send_rate_points', type='int',
+                      default=defaults.get('send_rate_points', 0), metavar='POINTS',
+                      help='Send at most this many datapoints per second to the '
+                           'TSDs, so that a backlog drains slowly once they come '
+                           'back.  Zero means no limit.  default=%default')
+    parser.add_option('--send-rate-bytes', dest='send_rate_bytes', type='int',
+                      default=defaults.get('send_rate_bytes', 0), metavar='BYTES',
+                      help='Send at most this many bytes of datapoints per second '
+                           'to the TSDs.  Zero means no limit.  default=%default')
+    parser.add_option('--reconnect-jitter', dest='reconnect_jitter', type='float',
+                      default=defaults.get('reconnect_jitter', 0), metavar='SECONDS',
+                      help='Once a TSD is back, wait for a random time of up to '
+                           'this many seconds before sending to it, so that a '
+                           'fleet of tcollectors does not all come back at once. '
+                           'default=%default')
+    parser.add_option('--spool-dir', dest='spool_dir', metavar='DIR',
+                      default=defaults.get("spool_dir", None),
+                      help="Directory where datapoints are spooled while the "
+                           "TSD can't be reached, and replayed from once it "
+                           "can.  Disabled by default.")
+    parser.add_option('--spool-max-bytes', dest='spool_max_bytes', type='int',
+                      default=defaults.get("spool_max_bytes", 1024 * 1024 * 1024),
+                      metavar='BYTES',
+                      help='Maximum size of the spool.  The oldest datapoints '
+                           'are discarded first.  default=%default')
+    parser.add_option('--spool-fsync', dest='spool_fsync', type='choice',
+                      choices=['always', 'segment', 'never'],
+                      default=defaults.get("spool_fsync", "segment"),
+                      help="When to fsync the spool: 'always' after every batch, "
+                           "'segment' once each file is complete, or 'never'. "
+                           "default=%default")
+    parser.add_option('--spool-replay-rate', dest='spool_replay_rate', type='int',
+                      default=defaults.get("spool_replay_rate", 10000), metavar='LINES',
+                      help='How many spooled datapoints per second to send once '
+                           'the TSD is reachable again.  Use zero for no limit. '
+                           'default=%default')
 
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
@@ -1050,8 +3787,43 @@ def parse_cmdline(argv):
     if options.evictinterval <= options.dedupinterval:
         parser.error('--evict-interval must be strictly greater than '
                      '--dedup-interval')
+    if options.dedup_max_bytes < 0:
+        parser.error('--dedup-max-bytes must be at least 0')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    if not 0 <= options.http_gzip_level <= 9:
+        parser.error('--http-gzip-level must be between 0 and 9')
+    if options.http_gzip_min_bytes < 0:
+        parser.error('--http-gzip-min-bytes must be at least 0')
+    if options.shards < 0:
+        parser.error('--shards must be at least 0')
+    if options.pipe_size < 0:
+        parser.error('--pipe-size must be at least 0')
+    if options.pipe_size and not sys.platform.startswith('linux'):
+        parser.error('--pipe-size is only supported on Linux')
+    if options.zygote and not sys.platform.startswith('linux'):
+        parser.error('--zygote is only supported on Linux')
+    if options.rescan_interval <= 0:
+        parser.error('--rescan-interval must be greater than 0')
+    if options.startup_concurrency < 0:
+        parser.error('--startup-concurrency must be at least 0')
+    try:
+        parse_collector_priorities(options.collector_priorities)
+    except ValueError as e:
+        parser.error('--collector-priorities: %s' % e)
+    if options.flush_max_points <= 0 or options.flush_max_bytes <= 0:
+        parser.error('--flush-max-points and --flush-max-bytes must be greater than 0')
+    if not 0 < options.flush_min_linger <= options.flush_max_linger:
+        parser.error('--flush-min-linger must be greater than 0 and at most '
+                     '--flush-max-linger')
+    if options.send_rate_points < 0 or options.send_rate_bytes < 0:
+        parser.error('--send-rate-points and --send-rate-bytes must be at least 0')
+    if options.reconnect_jitter < 0:
+        parser.error('--reconnect-jitter must be at least 0 seconds')
+    if options.spool_max_bytes <= 0:
+        parser.error('--spool-max-bytes must be greater than 0')
+    if options.spool_replay_rate < 0:
+        parser.error('--spool-replay-rate must be at least 0')
     # We cannot write to stdout when we're a daemon.
     if options.daemonize and options.logstdout:
         options.logstdout = False
@@ -1154,22 +3926,29 @@ def main(argv):
     modules = load_etc_dir(options, tags)
 
     setup_python_path(options.cdir)
+    # The onload() of the etc modules may have changed it.
+    setup_collector_priorities(options)
+    setup_in_process_collectors([name.strip() for name in options.in_process_collectors.split(',')
+                                 if name.strip()], options.cdir)
 
     # gracefully handle death for normal termination paths and abnormal
     atexit.register(shutdown)
     for sig in (signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, shutdown_signal)
 
-    # Status server, if it's configured:
-    if options.monitoring_interface is not None:
-        status_server = StatusServer(options.monitoring_interface, options.monitoring_port, COLLECTORS)
-        thread = threading.Thread(target=status_server.serve_forever)
-        thread.setDaemon(True)  # keep thread from preventing shutdown
-        thread.start()
-
     # at this point we're ready to start processing, so start the ReaderThread
-    # so we can have it running and pulling in data for us
-    reader = ReaderThread(options.dedupinterval, options.evictinterval, options.deduponlyzero, options.namespace_prefix)
+    # so we can have it running and pulling in data for us.  The stdin
+    # collector has no pipes to watch, so it always uses the polling loop.
+    global POLLER, PIPE_SIZE, ZYGOTE
+    if options.reader_mode == 'select' and not options.stdin:
+        POLLER = CollectorPoller()
+    PIPE_SIZE = options.pipe_size
+    # It gets the PYTHONPATH set by setup_python_path() for the collectors.
+    if options.zygote and not options.stdin:
+        ZYGOTE = Zygote()
+    reader = ReaderThread(options.dedupinterval, options.evictinterval, options.deduponlyzero,
+                          options.namespace_prefix, POLLER, options.dedup_max_bytes,
+                          overload=options.overload)
     reader.start()
 
     # prepare list of (host, port) of TSDs given on CLI
@@ -1191,30 +3970,81 @@ def main(argv):
         if options.host != "localhost" or options.port != DEFAULT_PORT:
             options.hosts.append((options.host, options.port))
 
+    def make_sender(hosts, spool_dir, queue=None, shard=None):
+        spool = None
+        if spool_dir:
+            spool = DiskSpool(spool_dir, options.spool_max_bytes, options.spool_fsync)
+        return SenderThread(reader, options.dryrun, hosts,
+                            not options.no_tcollector_stats, tags, options.reconnectinterval,
+                            options.http, options.http_username,
+                            options.http_password, options.http_api_path, options.ssl,
+                            options.maxtags, spool, options.spool_replay_rate,
+                            options.http_gzip_level, options.http_gzip_min_bytes,
+                            FlushPolicy(options.flush_max_points, options.flush_max_bytes,
+                                        options.flush_min_linger, options.flush_max_linger),
+                            queue, shard,
+                            # The rate limits are shared out between shards.
+                            options.send_rate_points / max(1, options.shards),
+                            options.send_rate_bytes / max(1, options.shards),
+                            options.reconnect_jitter)
+
     # and setup the sender to start writing out to the tsd
-    sender = SenderThread(reader, options.dryrun, options.hosts,
-                          not options.no_tcollector_stats, tags, options.reconnectinterval,
-                          options.http, options.http_username,
-                          options.http_password, options.http_api_path, options.ssl, options.maxtags)
-    sender.start()
+    router = None
+    if options.shards:
+        senders = []
+        for i in range(options.shards):
+            spool_dir = options.spool_dir and os.path.join(options.spool_dir, 'shard%d' % i)
+            senders.append(make_sender([options.hosts[i % len(options.hosts)]], spool_dir,
+                                       ReaderQueue(MAX_READQ_SIZE, overload=options.overload),
+                                       i))
+        router = ShardRouter(reader, senders)
+        router.start()
+    else:
+        senders = [make_sender(options.hosts, options.spool_dir)]
+    for sender in senders:
+        sender.start()
     LOG.info('SenderThread startup complete')
 
+    # Status server, if it's configured:
+    if options.monitoring_interface is not None:
+        status_server = StatusServer(options.monitoring_interface, options.monitoring_port,
+                                     COLLECTORS, {"/reader": reader.to_json})
+
+        def sender_endpoint(to_json):
+            if router is None:
+                return lambda: to_json(senders[0])
+            return lambda: dict(('shard%d' % sender.shard, to_json(sender))
+                                for sender in senders)
+        status_server.endpoints["/hosts"] = sender_endpoint(SenderThread.hosts_to_json)
+        status_server.endpoints["/ratelimit"] = sender_endpoint(SenderThread.rate_limits_to_json)
+        if router is not None:
+            status_server.endpoints["/shards"] = router.to_json
+        if router is None and senders[0].spool is not None:
+            status_server.endpoints["/spool"] = senders[0].spool.to_json
+        thread = threading.Thread(target=status_server.serve_forever)
+        thread.setDaemon(True)  # keep thread from preventing shutdown
+        thread.start()
+
     # if we're in stdin mode, build a stdin collector and just join on the
     # reader thread since there's nothing else for us to do here
     if options.stdin:
         register_collector(StdinCollector())
-        stdin_loop(options, modules, sender, tags)
+        stdin_loop(options, modules, senders[0], tags)
     else:
         sys.stdin.close()
-        main_loop(options, modules, sender, tags)
+        main_loop(options, modules, senders[0], tags)
 
     # We're exiting, make sure we don't leave any collector behind.
     for col in all_living_collectors():
         col.shutdown()
     LOG.debug('Shutting down -- joining the reader thread.')
     reader.join()
+    if router is not None:
+        LOG.debug('Shutting down -- joining the shard router thread.')
+        router.join()
     LOG.debug('Shutting down -- joining the sender thread.')
-    sender.join()
+    for sender in senders:
+        sender.join()
 
 
 def stdin_loop(options, modules, sender, tags):
@@ -1236,18 +4066,109 @@ def main_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we're not in stdin mode."""
 
     next_heartbeat = int(time.time() + 600)
+    setup_scheduler(options, tags)
+    try:
+        watcher = DirectoryWatcher()
+    except OSError as e:
+        LOG.info('Not watching for changes to the collectors, %s', e)
+        watcher = None
+    next_rescan = 0
     while ALIVE:
-        populate_collectors(options.cdir)
-        reload_changed_config_modules(modules, options, sender, tags)
-        reap_children()
-        check_children(options)
+        if time.time() >= next_rescan:
+            if watcher is not None:
+                # Before looking, so that we don't miss what changes meanwhile.
+                try:
+                    watch_collector_dirs(watcher, options.cdir)
+                except OSError as e:
+                    LOG.error('Not watching for changes to the collectors anymore, %s', e)
+                    watcher.close()
+                    watcher = None
+            populate_collectors(options.cdir)
+            reload_changed_config_modules(modules, options, sender, tags)
+            if watcher is None:
+                next_rescan = time.time() + HOUSEKEEPING_INTERVAL
+            else:
+                next_rescan = time.time() + options.rescan_interval
+        reader = sender.reader if sender is not None else None
+        reap_children(reader)
+        check_children(options, reader)
         spawn_children()
-        time.sleep(15)
+        if not ALIVE:
+            break
+        # Sleep until the next collector is due rather than a whole
+        # HOUSEKEEPING_INTERVAL, so that they run on time.
+        wakeup = min(next_rescan, time.time() + HOUSEKEEPING_INTERVAL)
+        next_due = SCHEDULER.next_due()
+        if next_due is not None:
+            wakeup = min(wakeup, next_due)
+        timeout = max(0, wakeup - time.time())
+        if watcher is None:
+            time.sleep(timeout)
+        elif apply_watch_events(watcher.wait(timeout), options, modules, sender, tags):
+            next_rescan = 0
         now = int(time.time())
         if now >= next_heartbeat:
             LOG.info('Heartbeat (%d collectors running)'
                      % sum(1 for col in all_living_collectors()))
             next_heartbeat = now + 600
+    if watcher is not None:
+        watcher.close()
+
+
+def setup_scheduler(options, tags):
+    """Sets up the SCHEDULER for the main_loop, which may be run without
+       going through main(), e.g. by the EOS agent, and schedules the
+       collectors registered so far."""
+
+    global SCHEDULER
+    SCHEDULER = Scheduler(tags.get('host'), options.startup_concurrency)
+    for col in all_collectors():
+        SCHEDULER.add(col)
+
+
+def watch_collector_dirs(watcher, coldir):
+    """Has the DirectoryWatcher watch the collector directory, its interval
+       directories and its 'etc' directory."""
+
+    watcher.watch(coldir)
+    for name in os.listdir(coldir):
+        path = os.path.join(coldir, name)
+        if (name.isdigit() or name == 'etc') and os.path.isdir(path):
+            watcher.watch(path)
+
+
+def apply_watch_events(events, options, modules, sender, tags):
+    """Updates the collectors and config modules that the DirectoryWatcher
+       saw change.
+
+    Returns: whether we need to rescan everything to catch up, e.g. because
+      a directory was added or removed, or the kernel dropped events.
+    """
+
+    etcdir = os.path.join(options.cdir, 'etc')
+    changed = set()
+    for path, name, mask in events:
+        if path is None or mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+            return True
+        if path == options.cdir:
+            if name.isdigit() or name == 'etc':
+                return True
+            continue
+        # A new file is only complete once it's closed, except for the
+        # symlinks collectors are usually enabled with.
+        if mask & IN_CREATE and not os.path.islink(os.path.join(path, name)):
+            continue
+        changed.add((path, name))
+
+    reload_config = False
+    for path, name in changed:
+        if path == etcdir:
+            reload_config = reload_config or name.endswith('.py')
+        else:
+            update_collector(options.cdir, int(os.path.basename(path)), name)
+    if reload_config:
+        reload_changed_config_modules(modules, options, sender, tags)
+    return False
 
 
 def list_config_modules(etcdir):
@@ -1369,7 +4290,7 @@ def all_valid_collectors():
 
     now = int(time.time())
     for col in all_collectors():
-        if not col.dead or (now - col.lastspawn > 3600):
+        if not col.dead or (now - col.lastspawn > DEAD_COLLECTOR_RETRY):
             yield col
 
 
@@ -1390,6 +4311,9 @@ def shutdown_signal(signum, frame):
 
 
 def kill(proc, signum=signal.SIGTERM):
+    if isinstance(proc, CollectorThread):
+        proc.send_signal(signum)
+        return
     try:
         os.killpg(proc.pid, signum)
     except:  # pylint: disable=bare-except
@@ -1406,20 +4330,26 @@ def shutdown():
         return
     # notify threads of program termination
     ALIVE = False
+    if POLLER is not None:
+        POLLER.wakeup()
 
     LOG.info('shutting down children')
 
     # tell everyone to die
     for col in all_living_collectors():
         col.shutdown()
+    if ZYGOTE is not None:
+        ZYGOTE.stop()
 
     LOG.info('exiting')
     sys.exit(1)
 
 
-def reap_children():
+def reap_children(reader=None):
     """When a child process dies, we have to determine why it died and whether
-       or not we need to restart it.  This method manages that logic."""
+       or not we need to restart it.  This method manages that logic.  While
+       the ReaderThread `reader` is held back by a full reader queue, the
+       collectors that exited with output left to read wait for it."""
 
     for col in all_living_collectors():
         now = int(time.time())
@@ -1429,36 +4359,63 @@ def reap_children():
         status = col.proc.poll()
         if status is None:
             continue
+        if col.has_unread_output():
+            if not col.exited:
+                col.exited = now
+            waiting_since = col.exited
+            if reader is not None and (col.datalines or col.pipe_backlog()):
+                waiting_since = max(waiting_since, reader.held_back_at)
+            if now - waiting_since < REAP_GRACE:
+                continue
+        if POLLER is not None:
+            POLLER.unregister(col)
         col.proc = None
 
         # behavior based on status.  a code 0 is normal termination, code 13
         # is used to indicate that we don't want to restart this collector.
-        # any other status code is an error and is logged.
+        # any other status code is an error and is logged.  When we don't
+        # know, it's neither: the collector runs again as usual.
+        if status == UNKNOWN_EXIT_STATUS:
+            LOG.warning('collector %s terminated after %d seconds with an '
+                        'unknown status, as the zygote that forked it is gone',
+                        col.name, now - col.lastspawn)
         if status == 13:
             LOG.info('removing %s from the list of collectors (by request)',
                      col.name)
             col.dead = True
-        elif status != 0:
+        elif status not in (0, UNKNOWN_EXIT_STATUS):
             LOG.warning('collector %s terminated after %d seconds with '
                         'status code %d, marking dead',
                         col.name, now - col.lastspawn, status)
             col.dead = True
         else:
-            register_collector(Collector(col.name, col.interval, col.filename,
-                                         col.mtime, col.lastspawn))
-
-
-def check_children(options):
+            new_col = Collector(col.name, col.interval, col.filename, col.mtime, col.lastspawn)
+            new_col.spawn_latency = col.spawn_latency
+            new_col.schedule_lag = col.schedule_lag
+            new_col.firstspawn = col.firstspawn
+            new_col.first_datapoint = col.first_datapoint
+            register_collector(new_col)
+        if col.dead and SCHEDULER is not None:
+            # Allow temporarily broken collectors a chance at redemption.
+            SCHEDULER.schedule(col, col.lastspawn + DEAD_COLLECTOR_RETRY)
+
+
+def check_children(options, reader=None):
     """When a child process hasn't received a datapoint in a while,
-       assume it's died in some fashion and restart it."""
+       assume it's died in some fashion and restart it.  The time the
+       ReaderThread `reader` was held back by a full reader queue, and so
+       didn't read the datapoints, doesn't count."""
 
     for col in all_living_collectors():
         now = int(time.time())
+        last_datapoint = col.last_datapoint
+        if reader is not None:
+            last_datapoint = max(last_datapoint, reader.held_back_at)
 
-        if (col.interval == 0) and (col.last_datapoint < (now - options.allowed_inactivity_time)):
+        if (col.interval == 0) and (last_datapoint < (now - options.allowed_inactivity_time)):
             # It's too old, kill it
             LOG.warning('Terminating collector %s after %d seconds of inactivity',
-                        col.name, now - col.last_datapoint)
+                        col.name, now - last_datapoint)
             col.shutdown()
             if not options.remove_inactive_collectors:
                 register_collector(Collector(col.name, col.interval, col.filename,
@@ -1471,14 +4428,213 @@ def set_nonblocking(fd):
     fcntl.fcntl(fd, fcntl.F_SETFL, fl)
 
 
+def set_pipe_size(col, size):
+    """Sets the size of the stdout pipe of the collector, so that it can
+       get that far ahead of us before it blocks writing."""
+    try:
+        fcntl.fcntl(col.proc.stdout.fileno(), F_SETPIPE_SZ, size)
+    except OSError as e:
+        # EPERM when it's more than /proc/sys/fs/pipe-max-size.
+        LOG.warning('Failed to set the pipe size of %s to %d: %s', col.name, size, e)
+
+
+def runs_in_process(col):
+    """Returns whether we run the given collector in a thread of our own
+       process rather than as a subprocess."""
+    if not col.filename.endswith('.py'):
+        return False
+    if (col.name not in IN_PROCESS_COLLECTORS
+            and os.path.splitext(col.name)[0] not in IN_PROCESS_COLLECTORS):
+        return False
+    return not abandoned_thread_running(col)
+
+
+def abandoned_thread_running(col):
+    """Returns whether the last thread of the given in-process collector
+       that we gave up waiting for is still running its main()."""
+    thread = ABANDONED_THREADS.get(col.filename)
+    return thread is not None and thread.is_alive()
+
+
+def load_collector_module(filename):
+    """Imports the Python collector in the given file, unless we already
+       did and it hasn't changed since, and returns its module."""
+    mtime = os.path.getmtime(filename)
+    with IN_PROCESS_LOCK:
+        if filename in IN_PROCESS_MODULES and IN_PROCESS_MODULES[filename][0] == mtime:
+            return IN_PROCESS_MODULES[filename][1]
+        # Like when it's run as a script, the collector can import the
+        # modules next to it.
+        directory = os.path.dirname(os.path.realpath(filename))
+        if directory not in sys.path:
+            sys.path.append(directory)
+        name = 'tcollector_' + os.path.splitext(os.path.basename(filename))[0]
+        spec = importlib.util.spec_from_file_location(name, filename)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        IN_PROCESS_MODULES[filename] = (mtime, module)
+        return module
+
+
+def setup_in_process_collectors(names, collector_dir):
+    """Gets ready to run the given collectors in our own process."""
+    IN_PROCESS_COLLECTORS.update(names)
+    if not IN_PROCESS_COLLECTORS:
+        return
+    # So that they can import collectors.lib, like the others do through
+    # the PYTHONPATH set by setup_python_path().
+    root = os.path.dirname(os.path.dirname(collector_dir))
+    if root not in sys.path:
+        sys.path.append(root)
+    global IN_PROCESS_REFUSED
+    try:
+        # They'd drop our privileges, not just theirs.
+        utils = importlib.import_module('collectors.lib.utils')
+        utils.IN_PROCESS = True
+        IN_PROCESS_REFUSED = utils.NeedsOwnProcess
+    except ImportError:
+        LOG.debug('No collectors.lib.utils in %r', root)
+    if not isinstance(sys.stdout, CollectorOutput):
+        sys.stdout = CollectorOutput('stdout', sys.stdout)
+        sys.stderr = CollectorOutput('stderr', sys.stderr)
+
+
+def run_zygote(fd, preload):
+    """Main loop of the zygote process, see Zygote.  Returns once tcollector
+       closes its end of the socket."""
+    preloaded = {}
+    for name in preload:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        filename = getattr(module, '__file__', None)
+        if filename:
+            preloaded[filename] = os.path.getmtime(filename)
+    sock = socket.socket(fileno=fd)
+    sock.send(json.dumps({'preloaded': preloaded}).encode())
+    # We wake up on SIGCHLD to tell tcollector about the children that exited.
+    wakeup_r, wakeup_w = os.pipe()
+    set_nonblocking(wakeup_r)
+    set_nonblocking(wakeup_w)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    # tcollector tells us when to exit, even on ^C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    selector.register(wakeup_r, selectors.EVENT_READ)
+    fds_size = socket.CMSG_SPACE(2 * array.array('i').itemsize)
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is not sock:
+                try:
+                    while os.read(wakeup_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            try:
+                data, ancdata, _, _ = sock.recvmsg(4096, fds_size)
+            except ConnectionResetError:
+                return  # tcollector closed it without reading everything.
+            if not data:
+                return
+            fds = array.array('i')
+            for level, kind, cmsg in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % fds.itemsize])
+            request = json.loads(data.decode('utf-8'))
+            # The child closes its end of this pipe once it's in a session of
+            # its own, which is when it can be signaled like any collector.
+            ready_r, ready_w = os.pipe()
+            try:
+                pid = os.fork()
+            except OSError as exc:
+                sock.send(json.dumps({'id': request['id'], 'error': str(exc)}).encode())
+                pid = None
+            if pid == 0:
+                sock.close()
+                selector.close()
+                for fd in (wakeup_r, wakeup_w, ready_r):
+                    os.close(fd)
+                run_zygote_child(request['filename'], fds, ready_w)
+            for fd in list(fds) + [ready_w]:
+                os.close(fd)
+            if pid is not None:
+                os.read(ready_r, 1)
+                sock.send(json.dumps({'id': request['id'], 'pid': pid}).encode())
+            os.close(ready_r)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            # The same as the returncode of a subprocess.Popen.
+            if os.WIFSIGNALED(status):
+                status = -os.WTERMSIG(status)
+            else:
+                status = os.WEXITSTATUS(status)
+            sock.send(json.dumps({'pid': pid, 'status': status}).encode())
+
+
+def run_zygote_child(filename, fds, ready):
+    """Runs the given collector in a child just forked by the zygote, with
+       the given fds for its stdout and stderr, and never returns.  Closes
+       the ready fd once it's set up like spawn_collector() would."""
+    status = 1
+    try:
+        os.setsid()
+        os.close(ready)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for target, fd in zip((1, 2), fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        # As if it was run as a script.
+        sys.argv = [filename]
+        sys.path.insert(0, os.path.dirname(os.path.realpath(filename)))
+        runpy.run_path(filename, run_name='__main__')
+        status = 0
+    except SystemExit as exc:
+        if exc.code is None:
+            status = 0
+        elif isinstance(exc.code, int):
+            status = exc.code
+        else:
+            sys.stderr.write('%s\n' % exc.code)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
 def spawn_collector(col):
     """Takes a Collector object and creates a process for it."""
 
     LOG.info('%s (interval=%d) needs to be spawned', col.name, col.interval)
+    if not col.firstspawn:
+        col.firstspawn = time.time()
+
+    if runs_in_process(col):
+        col.proc = CollectorThread(col)
+        col.proc.start()
+        col.lastspawn = int(time.time())
+        col.last_datapoint = col.lastspawn
+        col.dead = False
+        LOG.info('started %s in process', col.name)
+        return
+    if abandoned_thread_running(col):
+        LOG.warning('%s is still running in a thread we gave up on, '
+                    'running it as a subprocess', col.name)
 
-    # FIXME: do custom integration of Python scripts into memory/threads
-    # if re.search('\.py$', col.name) is not None:
-    #     ... load the py module directly instead of using a subprocess ...
     kwargs = {
         "stdout": subprocess.PIPE,
         "stderr": subprocess.PIPE,
@@ -1486,12 +4642,17 @@ def spawn_collector(col):
         "preexec_fn": os.setsid,
     }
 
-    kwargs["encoding"] = "utf-8"
+    start = time.time()
     try:
-        col.proc = subprocess.Popen(col.filename, **kwargs)
+        col.proc = None
+        if ZYGOTE is not None and col.interval and col.filename.endswith('.py'):
+            col.proc = ZYGOTE.spawn(col.filename)
+        if col.proc is None:
+            col.proc = subprocess.Popen(col.filename, **kwargs)
     except OSError as e:
         LOG.error('Failed to spawn collector %s: %s' % (col.filename, e))
         return
+    col.spawn_latency = time.time() - start
     # The following line needs to move below this line because it is used in
     # other logic and it makes no sense to update the last spawn time if the
     # collector didn't actually start.
@@ -1501,6 +4662,10 @@ def spawn_collector(col):
     col.last_datapoint = col.lastspawn
     set_nonblocking(col.proc.stdout.fileno())
     set_nonblocking(col.proc.stderr.fileno())
+    if PIPE_SIZE:
+        set_pipe_size(col, PIPE_SIZE)
+    if POLLER is not None:
+        POLLER.register(col)
     if col.proc.pid > 0:
         col.dead = False
         LOG.info('spawned %s (pid=%d)', col.name, col.proc.pid)
@@ -1510,29 +4675,39 @@ def spawn_collector(col):
 
 
 def spawn_children():
-    """Iterates over our defined collectors and performs the logic to
-       determine if we need to spawn, kill, or otherwise take some
+    """Goes over the collectors the Scheduler says are due and performs the
+       logic to determine if we need to spawn, kill, or otherwise take some
        action on them."""
 
     if not ALIVE:
         return
 
-    for col in all_valid_collectors():
-        now = int(time.time())
+    SCHEDULER.start_next_wave(time.time())
+    for when, col in SCHEDULER.pop_due(time.time() + SCHEDULE_JITTER):
+        now = time.time()
         if col.interval == 0:
             if col.proc is None:
                 spawn_collector(col)
-        elif col.interval <= now - col.lastspawn:
             if col.proc is None:
-                spawn_collector(col)
-                continue
-
+                SCHEDULER.schedule(col, now + HOUSEKEEPING_INTERVAL)
+        elif col.proc is None:
+            col.schedule_lag = max(0, now - when)
+            if col.schedule_lag > SCHEDULE_JITTER:
+                LOG.debug('%s started %.3fs late', col.name, col.schedule_lag)
+            spawn_collector(col)
+            # Look at it again when its next run is due: either it's been
+            # reaped by then, and replaced by a new Collector with the same
+            # slot, or it overstayed its welcome.
+            SCHEDULER.schedule(col, SCHEDULER.next_slot(col, max(when, now) + col.interval / 2))
+        elif col.proc.poll() is not None:
+            # It's done, we're only waiting for the ReaderThread to read
+            # the rest of its output before reaping it.
+            SCHEDULER.schedule(col, now + 1)
+        else:
             # I'm not very satisfied with this path.  It seems fragile and
             # overly complex, maybe we should just reply on the asyncproc
             # terminate method, but that would make the main tcollector
             # block until it dies... :|
-            if col.nextkill > now:
-                continue
             if col.killstate == 0:
                 LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
                             'its welcome, SIGTERM sent',
@@ -1552,6 +4727,7 @@ def spawn_children():
                           'intervention to kill it',
                           col.name, col.interval, col.proc.pid)
                 col.nextkill = now + 300
+            SCHEDULER.schedule(col, col.nextkill)
 
 
 def populate_collectors(coldir):
@@ -1572,54 +4748,77 @@ def populate_collectors(coldir):
         interval = int(interval)
 
         for colname in os.listdir('%s/%d' % (coldir, interval)):
-            if colname.startswith('.'):
-                continue
-
-            filename = '%s/%d/%s' % (coldir, interval, colname)
-            if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                mtime = int(os.path.getmtime(filename))
-
-                # if this collector is already 'known', then check if it's
-                # been updated (new mtime) so we can kill off the old one
-                # (but only if it's interval 0, else we'll just get
-                # it next time it runs)
-                if colname in COLLECTORS:
-                    col = COLLECTORS[colname]
-
-                    # if we get a dupe, then ignore the one we're trying to
-                    # add now.  there is probably a more robust way of doing
-                    # this...
-                    if col.interval != interval:
-                        LOG.error('two collectors with the same name %s and '
-                                  'different intervals %d and %d',
-                                  colname, interval, col.interval)
-                        continue
-
-                    # we have to increase the generation or we will kill
-                    # this script again
-                    col.generation = GENERATION
-                    if col.mtime < mtime:
-                        LOG.info('%s has been updated on disk', col.name)
-                        col.mtime = mtime
-                        if not col.interval:
-                            col.shutdown()
-                            LOG.info('Respawning %s', col.name)
-                            register_collector(Collector(colname, interval,
-                                                         filename, mtime))
-                else:
-                    register_collector(Collector(colname, interval, filename,
-                                                 mtime))
+            update_collector(coldir, interval, colname)
 
     # now iterate over everybody and look for old generations
     to_delete = []
     for col in all_collectors():
         if col.generation < GENERATION:
-            LOG.info('collector %s removed from the filesystem, forgetting',
-                     col.name)
-            col.shutdown()
-            to_delete.append(col.name)
-    for name in to_delete:
-        del COLLECTORS[name]
+            to_delete.append(col)
+    for col in to_delete:
+        forget_collector(col)
+
+
+def update_collector(coldir, interval, colname):
+    """Brings what we know of the given collector in line with the file it's
+       run from: registers it if it's new, restarts it if it was updated
+       and forgets it if it's gone."""
+
+    if colname.startswith('.'):
+        return
+
+    filename = '%s/%d/%s' % (coldir, interval, colname)
+    try:
+        mtime = 0
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            mtime = int(os.path.getmtime(filename))
+    except OSError:  # It's already gone again.
+        mtime = 0
+    if not mtime:
+        col = COLLECTORS.get(colname)
+        if col is not None and col.filename == filename:
+            forget_collector(col)
+        return
+
+    # if this collector is already 'known', then check if it's
+    # been updated (new mtime) so we can kill off the old one
+    # (but only if it's interval 0, else we'll just get
+    # it next time it runs)
+    if colname in COLLECTORS:
+        col = COLLECTORS[colname]
+
+        # if we get a dupe, then ignore the one we're trying to
+        # add now.  there is probably a more robust way of doing
+        # this...
+        if col.interval != interval:
+            LOG.error('two collectors with the same name %s and '
+                      'different intervals %d and %d',
+                      colname, interval, col.interval)
+            return
+
+        # we have to increase the generation or we will kill
+        # this script again
+        col.generation = GENERATION
+        if col.mtime < mtime:
+            LOG.info('%s has been updated on disk', col.name)
+            col.mtime = mtime
+            if not col.interval:
+                col.shutdown()
+                LOG.info('Respawning %s', col.name)
+                register_collector(Collector(colname, interval,
+                                             filename, mtime))
+    else:
+        register_collector(Collector(colname, interval, filename,
+                                     mtime))
+
+
+def forget_collector(col):
+    """Stops and forgets a collector that was removed from the filesystem."""
+
+    LOG.info('collector %s removed from the filesystem, forgetting',
+             col.name)
+    col.shutdown()
+    del COLLECTORS[col.name]
 
 
 if __name__ == '__main__':
@@ -12,14 +12,27 @@
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 
+import fcntl
+import importlib
 import os
+import random
+import shutil
+import signal
+import socket
+import ssl
 import sys
+import tempfile
 import time
 from stat import S_ISDIR, S_ISREG, ST_MODE
 import unittest
+from unittest import mock
 import subprocess
 import json
+import math
+import gzip
 import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
 try:
     import flask
 except ImportError:
@@ -83,6 +96,994 @@ class ReaderThreadTests(unittest.TestCase):
         self.assertEqual(collector.lines_received, 3)
         self.assertEqual(collector.lines_invalid, 0)
 
+    def test_dedup_survives_new_collector(self):
+        """Interval collectors get a new Collector every run, but their
+        duplicate values are still suppressed."""
+        thread = tcollector.ReaderThread(300, 600, False)  # pylint:disable=no-member
+        collector = tcollector.Collector("c", 15, "c")  # pylint:disable=no-member
+        thread.process_line(collector, "mymetric 100 12 a=b")
+        thread.process_line(collector, "mymetric 115 12 a=b")
+        collector = tcollector.Collector("c", 15, "c")  # pylint:disable=no-member
+        thread.process_line(collector, "mymetric 130 12 a=b")
+        thread.process_line(collector, "mymetric 145 13 a=b")
+        self.assertEqual([thread.readerq.get() for _ in range(thread.readerq.qsize())],
+                         ["mymetric 100 12 a=b", "mymetric 130 12 a=b", "mymetric 145 13 a=b"])
+
+    def test_dedup_evicts_old_keys(self):
+        """Old values are evicted, along with collectors that went away."""
+        thread = tcollector.ReaderThread(300, 600, False)  # pylint:disable=no-member
+        thread.process_line(tcollector.Collector("c", 15, "c"), "mymetric 100 12 a=b")  # pylint:disable=no-member
+        thread.process_line(tcollector.Collector("d", 15, "d"), "mymetric 200 12 a=b")  # pylint:disable=no-member
+        thread.dedup.evict_old_keys(150)
+        self.assertEqual(list(thread.dedup.entries), ["d\0mymetric a=b"])
+        self.assertEqual(len(thread.dedup), 1)
+
+    def test_dedup_replays_last_repeated_value(self):
+        """When a repeated value changes, the last repeat is sent first."""
+        thread = tcollector.ReaderThread(300, 600, False, "ns.")  # pylint:disable=no-member
+        collector = tcollector.Collector("c", 0, "c")  # pylint:disable=no-member
+        for line in ["mymetric 100 True a=b", "mymetric 115 true a=b",
+                     "mymetric 130 0 a=b"]:
+            thread.process_line(collector, line)
+        self.assertEqual([thread.readerq.get() for _ in range(thread.readerq.qsize())],
+                         ["ns.mymetric 100 True a=b", "ns.mymetric 115 true a=b",
+                          "ns.mymetric 130 0 a=b"])
+
+    def test_dedup_max_bytes(self):
+        """The least recently updated series go first when memory is capped."""
+        store = tcollector.DedupStore(max_bytes=1)  # pylint:disable=no-member
+        store.put(store.make_key("c", "m", " a=1"), "1", 100, "100")
+        store.put(store.make_key("c", "m", " a=2"), "1", 100, "100")
+        self.assertEqual(list(store.entries), ["c\0m a=2"])
+        self.assertEqual(store.lru_evictions, 1)
+        store.evict_old_keys(200)
+        self.assertEqual((len(store), store.bytes), (0, 0))
+
+    def test_dedup_evicts_incrementally(self):
+        """Eviction only touches expired buckets, a budget at a time."""
+        now = 1700000000
+        store = tcollector.DedupStore(bucket_width=10)  # pylint:disable=no-member
+        for i in range(5):
+            store.put(store.make_key("c", "m", " a=%d" % i), "1", now + i, str(now + i))
+        # Milliseconds timestamps are bucketed in seconds.
+        store.put(store.make_key("c", "m", " a=ms"), "1", (now + 5) * 1000.0, str((now + 5) * 1000))
+        # A value that changed moves to a newer bucket.
+        store.put(store.make_key("c", "m", " a=0"), "2", now + 100, str(now + 100))
+        self.assertEqual(store.next_expiry(), now + 10)
+        self.assertFalse(store.evict_old_keys(now + 50, budget=3))
+        self.assertEqual(len(store), 3)
+        self.assertTrue(store.evict_old_keys(now + 50, budget=3))
+        self.assertEqual(list(store.entries), ["c\0m a=0"])
+        self.assertEqual(store.next_expiry(), now + 110)
+
+    def test_dedup_replay_line(self):
+        """Replayed lines are rebuilt exactly as the collector sent them."""
+        store = tcollector.DedupStore()  # pylint:disable=no-member
+        for metric, tags, timestamp in [("m", " a=b c=d", "100"), ("m", "", "0100"),
+                                        ("m", "", "100.5")]:
+            key = store.make_key("c", metric, tags)
+            store.put(key, "1.0", float(timestamp), timestamp)
+            self.assertEqual(store.replay_line(key, store.get(key)),
+                             "%s %s 1.0%s" % (metric, timestamp, tags))
+
+
+class ReaderQueueTests(unittest.TestCase):
+    """Tests for the queue between the reader and the sender."""
+
+    def test_capacity(self):
+        """Lines that don't fit, in points or bytes, are dropped."""
+        queue = tcollector.ReaderQueue(5, max_bytes=40)  # pylint:disable=no-member
+        self.assertEqual(queue.put_batch(["m 100 1"] * 3), 0)
+        self.assertEqual(queue.put_batch(["m 100 1"] * 3), 1)
+        self.assertFalse(queue.nput("m 100 1"))
+        self.assertEqual((queue.qsize(), queue.bytes), (5, 35))
+        self.assertEqual(queue.get_batch(2), ["m 100 1"] * 2)
+        self.assertEqual(queue.put_batch(["m 100 1234567890", "m 100 1"]), 1)
+        self.assertEqual((queue.qsize(), queue.bytes), (4, 37))
+
+    def test_get_batch(self):
+        queue = tcollector.ReaderQueue(100)  # pylint:disable=no-member
+        queue.put_batch(["a", "b", "c"])
+        queue.put_batch(["d", "e"])
+        self.assertEqual(queue.get_batch(2), ["a", "b"])
+        self.assertEqual(queue.get_batch(max_bytes=2), ["c", "d"])
+        self.assertEqual(queue.get(), "e")
+        self.assertEqual(queue.get_batch(timeout=0), [])
+        self.assertRaises(tcollector.Empty, queue.get, False)  # pylint:disable=no-member
+        self.assertEqual((queue.qsize(), queue.bytes), (0, 0))
+
+    def test_reader_counts_drops(self):
+        """The reader hands over a batch per iteration and counts every line
+        the queue couldn't take."""
+        thread = tcollector.ReaderThread(0, 10, False)  # pylint:disable=no-member
+        thread.readerq = tcollector.ReaderQueue(3)  # pylint:disable=no-member
+        collector = tcollector.Collector("c", 1, "c")  # pylint:disable=no-member
+        for i in range(5):
+            thread.process_line(collector, "mymetric %d 1" % (100 + i), flush=False)
+        self.assertEqual(thread.readerq.qsize(), 0)
+        thread.flush_batch()
+        self.assertEqual((thread.readerq.qsize(), thread.lines_dropped), (3, 2))
+        self.assertEqual(collector.lines_sent, 5)
+
+    def test_low_priority_dropped_first(self):
+        queue = tcollector.ReaderQueue(5)  # pylint:disable=no-member
+        self.assertEqual(queue.put_batch(["low %d 1" % i for i in range(4)], "low"), 0)
+        # High priority lines push out the oldest low priority ones.
+        self.assertEqual(queue.put_batch(["high %d 1" % i for i in range(3)], "high"), 2)
+        self.assertEqual(queue.qsize(), 5)
+        # Lines of the same priority don't push anything out.
+        self.assertEqual(queue.put_batch(["low 9 1"], "low"), 1)
+        # There's only room for two more once the low priority lines are gone.
+        self.assertEqual(queue.put_batch(["normal 0 1", "normal 1 1", "normal 2 1"]), 3)
+        self.assertEqual(queue.dropped(), {"high": 0, "normal": 1, "low": 5})
+        self.assertEqual(queue.get_batch(), ["high 0 1", "high 1 1", "high 2 1",
+                                             "normal 0 1", "normal 1 1"])
+        self.assertEqual((queue.qsize(), queue.bytes), (0, 0))
+
+    def test_weighted_batches(self):
+        """A backed up queue gives each class a share of every batch."""
+        queue = tcollector.ReaderQueue(100)  # pylint:disable=no-member
+        for priority in ("low", "normal", "high"):
+            queue.put_batch(["%s %d 1" % (priority, i) for i in range(10)], priority)
+        batches = queue.get_batches(7)
+        self.assertEqual(list(batches), ["high", "normal", "low"])
+        self.assertEqual([len(lines) for lines in batches.values()], [4, 2, 1])
+        # What's left of a share goes to the most important classes.
+        batches = queue.get_batches(14)
+        self.assertEqual([len(lines) for lines in batches.values()], [6, 6, 2])
+        self.assertEqual(batches["normal"], ["normal %d 1" % i for i in range(2, 8)])
+        self.assertEqual(queue.qsize(), 30 - 7 - 14)
+
+    def test_backpressure(self):
+        """In backpressure mode nothing is dropped, and whoever fills the
+        queue waits for room."""
+        queue = tcollector.ReaderQueue(3, overload="backpressure")  # pylint:disable=no-member
+        self.assertEqual(queue.put_batch(["low %d 1" % i for i in range(2)], "low"), 0)
+        self.assertEqual(queue.put_batch(["high %d 1" % i for i in range(3)], "high"), 0)
+        self.assertEqual(queue.qsize(), 5)
+        self.assertTrue(queue.is_full())
+        self.assertFalse(queue.wait_for_room(0.01))
+        threading.Timer(0.1, queue.get_batch, [3]).start()
+        self.assertTrue(queue.wait_for_room(5))
+        self.assertFalse(queue.is_full())
+        self.assertTrue(queue.is_full(pending=1))
+
+    def test_drops_logged_in_summary(self):
+        queue = tcollector.ReaderQueue(1)  # pylint:disable=no-member
+        with self.assertLogs("tcollector", "ERROR") as logs:
+            for i in range(10):
+                queue.put_batch(["m %d 1" % i, "m %d 2" % i])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("dropped 1 lines", logs.output[0])
+        self.assertEqual(queue.unlogged_drops, 18)
+
+    def test_collector_priorities(self):
+        priorities = tcollector.parse_collector_priorities(  # pylint:disable=no-member
+            "procstats=high, prometheus.py=low,")
+        self.assertEqual(priorities, {"procstats": "high", "prometheus.py": "low"})
+        for value in ("procstats", "procstats=urgent", "=high"):
+            with self.assertRaises(ValueError):
+                tcollector.parse_collector_priorities(value)  # pylint:disable=no-member
+
+        self.addCleanup(tcollector.COLLECTOR_PRIORITIES.clear)  # pylint:disable=no-member
+        options = tcollector.parse_cmdline(["tcollector.py", "--collector-priorities",  # pylint:disable=no-member
+                                            "procstats=high, prometheus.py=low,"])[0]
+        tcollector.setup_collector_priorities(options)  # pylint:disable=no-member
+        self.assertEqual(tcollector.COLLECTOR_PRIORITIES, priorities)  # pylint:disable=no-member
+        thread = tcollector.ReaderThread(0, 10, False)  # pylint:disable=no-member
+        thread.readerq = tcollector.ReaderQueue(2)  # pylint:disable=no-member
+        bulk = tcollector.Collector("prometheus.py", 0, "prometheus.py")  # pylint:disable=no-member
+        core = tcollector.Collector("procstats.py", 0, "procstats.py")  # pylint:disable=no-member
+        other = tcollector.Collector("mysql.py", 0, "mysql.py")  # pylint:disable=no-member
+        self.assertEqual((bulk.priority, core.priority, other.priority),
+                         ("low", "high", "normal"))
+        thread.process_line(bulk, "bulk.metric 100 1", flush=False)
+        thread.process_line(bulk, "bulk.metric 101 1", flush=False)
+        thread.process_line(core, "core.metric 100 1", flush=False)
+        thread.flush_batch()
+        self.assertEqual(thread.readerq.dropped(), {"high": 0, "normal": 0, "low": 1})
+        self.assertEqual(thread.lines_dropped, 1)
+        self.assertEqual(thread.to_json()["priorities"]["low"]["queued"], 1)
+
+    def test_stdin_lines_not_held_back(self):
+        """Reading from stdin blocks, so its lines are queued as they come."""
+        lines = ["mymetric 100 1\n", "mymetric 101 1\n"]
+        more = threading.Event()
+
+        class Stdin:
+            def readline(self):
+                if lines:
+                    return lines.pop(0)
+                more.wait()
+                return ""
+
+        real_stdin = sys.stdin
+        sys.stdin = Stdin()
+        thread = tcollector.ReaderThread(0, 10, False)  # pylint:disable=no-member
+        thread.daemon = True
+        tcollector.register_collector(tcollector.StdinCollector())  # pylint:disable=no-member
+
+        def cleanup():
+            more.set()
+            thread.join(5)
+            sys.stdin = real_stdin
+            del tcollector.COLLECTORS["stdin"]  # pylint:disable=no-member
+            tcollector.ALIVE = True  # pylint:disable=no-member
+        self.addCleanup(cleanup)
+        thread.start()
+        deadline = time.time() + 5
+        while thread.readerq.qsize() < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(thread.readerq.qsize(), 2)
+
+
+class DatapointParserTests(unittest.TestCase):
+    """Tests for DatapointParser."""
+
+    def test_fast_path_agrees_with_regex(self):
+        """The fast path never accepts a line the regex rejects, and parses
+        the lines it accepts the same way."""
+        parser = tcollector.DatapointParser()  # pylint:disable=no-member
+        tokens = ["mymetric", "my.metric-1_x/y", "m@tric", "", "12", "1", "1.5", "1.",
+                  ".5", "1.2.3", "123456789012", "\u0661\u0662", "12", "True", "nan",
+                  "1e5", "-0.5", "x\ty", "\x01", "a=b", "a=b=c", "=b", "a=", "k\u00e9=v",
+                  "host=web01", "a.b/c-d_e=f.g/h-i_j"]
+        rand = random.Random(42)
+        fast = 0
+        for _ in range(20000):
+            line = " ".join(rand.choice(tokens) for _ in range(rand.randint(1, 6)))
+            expected = parser.LINE_RE.match(line)
+            expected = expected.groups() if expected else None
+            fast_parsed = parser.fast_parsed
+            self.assertEqual(parser.parse(line), expected, line)
+            if parser.fast_parsed > fast_parsed:
+                fast += 1
+        self.assertGreater(fast, 0)
+
+    def test_counts_fast_and_slow_lines(self):
+        parser = tcollector.DatapointParser()  # pylint:disable=no-member
+        self.assertEqual(parser.parse("mymetric 123 12 a=b"),
+                         ("mymetric", "123", "12", " a=b"))
+        self.assertIsNone(parser.parse("mymetric 1 12"))
+        self.assertEqual((parser.fast_parsed, parser.slow_parsed), (1, 1))
+
+
+class CollectorPollerTests(unittest.TestCase):
+    """Tests for the selector-based CollectorPoller."""
+
+    def setUp(self):
+        self.poller = tcollector.CollectorPoller()  # pylint:disable=no-member
+        tcollector.POLLER = self.poller  # pylint:disable=no-member
+        self.addCleanup(setattr, tcollector, "POLLER", None)
+
+    def spawn(self, script):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, "col.sh")
+        with open(filename, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(filename, 0o755)
+        collector = tcollector.Collector("col.sh", 0, filename)  # pylint:disable=no-member
+        tcollector.spawn_collector(collector)  # pylint:disable=no-member
+        self.addCleanup(collector.shutdown)
+        return collector
+
+    def test_wakes_up_on_data(self):
+        """poll() returns the collectors which have written something."""
+        collector = self.spawn("echo mymetric 123 12 a=b; sleep 30\n")
+        self.assertEqual(self.poller.poll(5), {collector})
+        self.assertEqual(list(collector.collect()), ["mymetric 123 12 a=b"])
+        self.assertEqual(self.poller.poll(0), set())
+
+    def test_closed_pipes_are_forgotten(self):
+        """Once a collector hit EOF its pipes are no longer watched."""
+        collector = self.spawn("echo mymetric 123 12 a=b\n")
+        collector.proc.wait()
+        self.assertEqual(self.poller.poll(5), {collector})
+        self.assertEqual(list(collector.collect()), ["mymetric 123 12 a=b"])
+        self.assertTrue(collector.stdout_eof)
+        self.poller.forget_closed_pipes(collector)
+        self.assertEqual(self.poller.poll(0), set())
+
+    def wait_for_backlog(self, collector, nbytes):
+        deadline = time.time() + 5
+        while collector.pipe_backlog() < nbytes and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(collector.pipe_backlog(), nbytes)
+
+    def test_read_budget(self):
+        """collect() stops at its budget and leaves the rest for later."""
+        collector = self.spawn("seq 1000 1049 | sed 's/.*/mymetric & 1/'; sleep 30\n")
+        self.wait_for_backlog(collector, 50 * len("mymetric 1000 1\n"))
+        lines = list(collector.collect(max_lines=20))
+        self.assertEqual(lines, ["mymetric %d 1" % i for i in range(1000, 1020)])
+        self.assertTrue(collector.over_budget)
+        self.assertEqual(collector.pipe_backlog(), 0)
+        self.assertEqual(collector.to_json()["lines_backlog"], 30)
+        # With nothing left to read, it isn't over budget, and that doesn't
+        # count as exhausting the budget again.
+        collector.datalines.clear()
+        self.assertEqual(list(collector.collect()), [])
+        self.assertFalse(collector.over_budget)
+        self.assertEqual(collector.budget_exhausted, 1)
+
+    def test_bytes_budget(self):
+        collector = self.spawn("seq 1000 1049 | sed 's/.*/mymetric & 1/'; sleep 30\n")
+        line_bytes = len("mymetric 1000 1\n")
+        self.wait_for_backlog(collector, 50 * line_bytes)
+        lines = list(collector.collect(max_bytes=10 * line_bytes + 5))
+        self.assertEqual(len(lines), 10)
+        self.assertTrue(collector.over_budget)
+        self.assertEqual(collector.bytes_read, 10 * line_bytes + 5)
+        # Ending on part of a line still counts as going over the budget.
+        self.assertEqual(list(collector.collect(max_bytes=5)), [])
+        self.assertTrue(collector.over_budget)
+        self.assertEqual(len(list(collector.collect())), 40)
+        self.assertFalse(collector.over_budget)
+
+    def test_reader_round_robin(self):
+        """A chatty collector doesn't keep the reader from the others."""
+        chatty = self.spawn("seq 100000 104999 | sed 's/.*/chatty & 1/'; sleep 30\n")
+        quiet = self.spawn("echo quiet 100000 1; sleep 30\n")
+        self.wait_for_backlog(chatty, 1)
+        self.wait_for_backlog(quiet, 1)
+        reader = tcollector.ReaderThread(  # pylint:disable=no-member
+            0, 10, False, poller=self.poller, read_budget_lines=100)
+        reader.daemon = True
+
+        def stop():
+            tcollector.ALIVE = False  # pylint:disable=no-member
+            self.poller.wakeup()
+            reader.join(5)
+            tcollector.ALIVE = True  # pylint:disable=no-member
+        self.addCleanup(stop)
+        reader.start()
+        deadline = time.time() + 10
+        while reader.readerq.qsize() < 5001 and time.time() < deadline:
+            time.sleep(0.01)
+        lines = reader.readerq.get_batch()
+        self.assertEqual(len(lines), 5001)
+        self.assertLessEqual(lines.index("quiet 100000 1"), 100)
+        self.assertGreaterEqual(chatty.budget_exhausted, 49)
+
+    def test_reader_backpressure(self):
+        """With a full queue, the reader leaves lines in the collectors'
+        pipes rather than dropping them."""
+        chatty = self.spawn("seq 100000 104999 | sed 's/.*/chatty & 1/'; sleep 30\n")
+        reader = tcollector.ReaderThread(  # pylint:disable=no-member
+            0, 10, False, poller=self.poller, read_budget_lines=100, overload="backpressure")
+        reader.readerq = tcollector.ReaderQueue(  # pylint:disable=no-member
+            200, overload="backpressure")
+        reader.daemon = True
+
+        def stop():
+            tcollector.ALIVE = False  # pylint:disable=no-member
+            self.poller.wakeup()
+            reader.join(5)
+            tcollector.ALIVE = True  # pylint:disable=no-member
+        self.addCleanup(stop)
+        reader.start()
+        deadline = time.time() + 5
+        while not reader.backpressure_waits and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertGreater(reader.backpressure_waits, 0)
+        self.assertLessEqual(reader.readerq.qsize(), 300)
+        self.assertGreater(chatty.pipe_backlog() + len(chatty.datalines), 0)
+        lines = []
+        deadline = time.time() + 10
+        while len(lines) < 5000 and time.time() < deadline:
+            lines.extend(reader.readerq.get_batch(150, 0.1))
+        self.assertEqual(lines, ["chatty %d 1" % i for i in range(100000, 105000)])
+        self.assertEqual(reader.lines_dropped, 0)
+
+    def test_backpressure_not_inactivity(self):
+        """Collectors aren't killed or reaped for what the reader didn't read
+        while the queue was full."""
+        options = tcollector.parse_cmdline(  # pylint:disable=no-member
+            ["tcollector.py", "--allowed-inactivity-time", "1"])[0]
+        self.addCleanup(tcollector.COLLECTORS.clear)  # pylint:disable=no-member
+        chatty = self.spawn("seq 100000 104999 | sed 's/.*/chatty & 1/'; sleep 30\n")
+        tcollector.register_collector(chatty)  # pylint:disable=no-member
+        interval = self.spawn("seq 100000 100999 | sed 's/.*/interval & 1/'\n")
+        interval.name = interval.filename
+        interval.interval = 60
+        tcollector.register_collector(interval)  # pylint:disable=no-member
+        reader = tcollector.ReaderThread(  # pylint:disable=no-member
+            0, 10, False, poller=self.poller, overload="backpressure")
+        reader.readerq = tcollector.ReaderQueue(  # pylint:disable=no-member
+            200, overload="backpressure")
+        reader.daemon = True
+
+        def stop():
+            tcollector.ALIVE = False  # pylint:disable=no-member
+            self.poller.wakeup()
+            reader.join(5)
+            tcollector.ALIVE = True  # pylint:disable=no-member
+        self.addCleanup(stop)
+        reader.start()
+        interval.proc.wait()
+        deadline = time.time() + 3
+        with mock.patch.object(tcollector, "REAP_GRACE", 1):
+            while time.time() < deadline:
+                tcollector.reap_children(reader)  # pylint:disable=no-member
+                tcollector.check_children(options, reader)  # pylint:disable=no-member
+                time.sleep(0.1)
+        self.assertGreater(reader.backpressure_waits, 0)
+        self.assertIs(tcollector.COLLECTORS["col.sh"], chatty)  # pylint:disable=no-member
+        self.assertIsNotNone(chatty.proc)
+        self.assertIsNotNone(interval.proc)
+        lines = []
+        deadline = time.time() + 10
+        while len(lines) < 6000 and time.time() < deadline:
+            lines.extend(reader.readerq.get_batch(150, 0.1))
+        self.assertEqual(sorted(line for line in lines if line.startswith("chatty")),
+                         ["chatty %d 1" % i for i in range(100000, 105000)])
+        self.assertEqual(sorted(line for line in lines if line.startswith("interval")),
+                         ["interval %d 1" % i for i in range(100000, 101000)])
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "F_SETPIPE_SZ is Linux only")
+    def test_pipe_size(self):
+        tcollector.PIPE_SIZE = 1024 * 1024  # pylint:disable=no-member
+        self.addCleanup(setattr, tcollector, "PIPE_SIZE", 0)
+        collector = self.spawn("sleep 30\n")
+        size = fcntl.fcntl(collector.proc.stdout.fileno(), 1032)  # F_GETPIPE_SZ
+        self.assertEqual(size, 1024 * 1024)
+
+    def test_wakeup(self):
+        """wakeup() interrupts a poll() that would otherwise block."""
+        self.poller.wakeup()
+        start = time.time()
+        self.assertEqual(self.poller.poll(5), set())
+        self.assertLess(time.time() - start, 1)
+
+
+class InProcessCollectorTests(unittest.TestCase):
+    """Tests for the collectors we run in threads of our own process."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        tcollector.IN_PROCESS_COLLECTORS.add("col")  # pylint:disable=no-member
+        self.addCleanup(tcollector.IN_PROCESS_COLLECTORS.clear)  # pylint:disable=no-member
+        for name in ("stdout", "stderr"):
+            self.addCleanup(setattr, sys, name, getattr(sys, name))
+            setattr(sys, name, tcollector.CollectorOutput(  # pylint:disable=no-member
+                name, getattr(sys, name)))
+
+    def spawn(self, body):
+        filename = os.path.join(self.tmpdir, "col.py")
+        with open(filename, "w") as f:
+            f.write("#!%s\nimport sys, time\n%s" % (sys.executable, body))
+        os.chmod(filename, 0o755)
+        # Make each version of the file look modified, as they're written
+        # within the same second.
+        os.utime(filename, (time.time(), time.time() + len(body)))
+        collector = tcollector.Collector("col.py", 0, filename)  # pylint:disable=no-member
+        tcollector.spawn_collector(collector)  # pylint:disable=no-member
+        self.addCleanup(collector.shutdown)
+        return collector
+
+    def test_exit_codes(self):
+        """What main() returns or passes to sys.exit() is the exit code."""
+        for body, status in (("def main():\n    print('m 1 1')\n", 0),
+                             ("def main():\n    return 13\n", 13),
+                             ("def main():\n    sys.exit(2)\n", 2),
+                             ("def main():\n    sys.exit('oops')\n", 1),
+                             ("def main():\n    raise ValueError()\n", 1),
+                             ("raise ImportError()\n", 1)):
+            collector = self.spawn(body)
+            self.assertIsInstance(collector.proc, tcollector.CollectorThread)  # pylint:disable=no-member
+            self.assertEqual(collector.proc.wait(), status, body)
+
+    def test_output(self):
+        """Lines go to the collector and stderr to the log, and the
+        module is imported once for all the runs."""
+        body = ("RUNS = []\n"
+                "def main():\n"
+                "    RUNS.append(1)\n"
+                "    print('m 1 %d' % len(RUNS))\n"
+                "    print('warning', file=sys.stderr)\n"
+                "    sys.stdout.write('\\n  m 2 %d  \\nm 3' % len(RUNS))\n")
+        with self.assertLogs("tcollector", "WARNING") as logs:
+            collector = self.spawn(body)
+            collector.proc.wait()
+        self.assertEqual(logs.output, ["WARNING:tcollector:col.py: warning"])
+        self.assertEqual(list(collector.collect()), ["m 1 1", "m 2 1", "m 3"])
+        tcollector.spawn_collector(collector)  # pylint:disable=no-member
+        collector.proc.wait()
+        self.assertEqual(list(collector.collect()), ["m 1 2", "m 2 2", "m 3"])
+        self.assertTrue(collector.to_json()["in_process"])
+
+    @unittest.skipUnless(os.getuid() == 0, "only root has privileges to drop")
+    def test_drop_privileges(self):
+        """Collectors that drop privileges run as subprocesses when we're root."""
+        utils = importlib.import_module("collectors.lib.utils")
+        self.addCleanup(setattr, utils, "IN_PROCESS", False)
+        self.addCleanup(setattr, tcollector, "IN_PROCESS_REFUSED", ())
+        tcollector.setup_in_process_collectors(  # pylint:disable=no-member
+            [], os.path.join(os.path.dirname(os.path.abspath(__file__)), "collectors", "0"))
+        with self.assertLogs("tcollector", "ERROR") as logs:
+            collector = self.spawn("from collectors.lib import utils\n"
+                                   "def main():\n    utils.drop_privileges()\n")
+            self.assertEqual(collector.proc.wait(), 0)
+        self.assertIn("col.py wants to drop privileges", logs.output[0])
+        self.assertEqual(os.getuid(), 0)
+        self.assertFalse(tcollector.runs_in_process(collector))  # pylint:disable=no-member
+
+    def test_last_datapoint(self):
+        """Their lines keep long-lived collectors from looking inactive."""
+        collector = self.spawn("def main():\n    time.sleep(0.5)\n    print('m 1 1')\n")
+        collector.last_datapoint = 0
+        collector.proc.wait()
+        self.assertGreater(collector.last_datapoint, 0)
+
+    def test_kill(self):
+        """A signal stops the collector, even if it catches Exception."""
+        collector = self.spawn("def main():\n"
+                               "    while True:\n"
+                               "        try:\n"
+                               "            time.sleep(0.01)\n"
+                               "        except Exception:\n"
+                               "            pass\n")
+        self.assertIsNone(collector.proc.poll())
+        tcollector.kill(collector.proc)  # pylint:disable=no-member
+        self.assertEqual(collector.proc.wait(), -signal.SIGTERM)
+
+    def test_abandon(self):
+        """After SIGKILL, we stop waiting for the thread."""
+        collector = self.spawn("def main():\n"
+                               "    time.sleep(0.5)\n"
+                               "    print('m 1 1')\n")
+        tcollector.kill(collector.proc, signal.SIGKILL)  # pylint:disable=no-member
+        self.assertEqual(collector.proc.wait(), -signal.SIGKILL)
+        collector.proc.join()
+        self.assertEqual(list(collector.datalines), [])
+
+    def test_abandoned_not_duplicated(self):
+        """A collector stuck in a blocking call runs as a subprocess once
+        restarted, rather than in a second thread sharing its module."""
+        collector = self.spawn("import threading\n"
+                               "RUNS = []\n"
+                               "STUCK = threading.Event()\n"
+                               "def main():\n"
+                               "    RUNS.append(1)\n"
+                               "    print('m 1 %d' % len(RUNS))\n"
+                               "    sys.stdout.flush()\n"
+                               "    STUCK.wait()\n"
+                               "if __name__ == '__main__':\n"
+                               "    main()\n")
+        self.addCleanup(tcollector.ABANDONED_THREADS.clear)  # pylint:disable=no-member
+        thread = collector.proc
+        deadline = time.time() + 5
+        while not collector.datalines and time.time() < deadline:
+            time.sleep(0.01)
+        module = tcollector.IN_PROCESS_MODULES[collector.filename][1]  # pylint:disable=no-member
+        self.addCleanup(module.STUCK.set)
+        collector.shutdown()
+        self.assertTrue(thread.is_alive())
+        with self.assertLogs("tcollector", "WARNING"):
+            tcollector.spawn_collector(collector)  # pylint:disable=no-member
+        self.assertIsInstance(collector.proc, subprocess.Popen)
+        deadline = time.time() + 5
+        lines = []
+        while not lines and time.time() < deadline:
+            lines = list(collector.collect())
+            time.sleep(0.01)
+        self.assertEqual(lines, ["m 1 1"])
+        self.assertEqual(module.RUNS, [1])
+        collector.shutdown()
+        module.STUCK.set()
+        thread.join(5)
+        self.assertTrue(tcollector.runs_in_process(collector))  # pylint:disable=no-member
+
+    def test_backlog(self):
+        """The thread waits for the reader to take its lines."""
+        self.addCleanup(setattr, tcollector, "IN_PROCESS_MAX_BACKLOG",
+                        tcollector.IN_PROCESS_MAX_BACKLOG)  # pylint:disable=no-member
+        tcollector.IN_PROCESS_MAX_BACKLOG = 3  # pylint:disable=no-member
+        collector = self.spawn("def main():\n"
+                               "    for i in range(10):\n"
+                               "        print('m 1 %d' % i)\n"
+                               "        sys.stdout.flush()\n")
+        deadline = time.time() + 5
+        while len(collector.datalines) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(len(collector.datalines), 3)
+        lines = []
+        while len(lines) < 10 and time.time() < deadline:
+            lines.extend(collector.collect())
+        self.assertEqual(lines, ["m 1 %d" % i for i in range(10)])
+        self.assertEqual(collector.proc.wait(), 0)
+
+    def test_poller_notified(self):
+        poller = tcollector.CollectorPoller()  # pylint:disable=no-member
+        tcollector.POLLER = poller  # pylint:disable=no-member
+        self.addCleanup(setattr, tcollector, "POLLER", None)
+        collector = self.spawn("def main():\n"
+                               "    print('m 1 1')\n"
+                               "    sys.stdout.flush()\n"
+                               "    while True:\n"
+                               "        time.sleep(0.01)\n")
+        self.assertEqual(poller.poll(5), {collector})
+        self.assertEqual(list(collector.collect()), ["m 1 1"])
+
+    def test_whitelist(self):
+        for name, filename, expected in (("col.py", "col.py", True),
+                                         ("col", "col", False),
+                                         ("col.sh", "col.sh", False),
+                                         ("other.py", "other.py", False)):
+            collector = tcollector.Collector(name, 0, filename)  # pylint:disable=no-member
+            self.assertEqual(tcollector.runs_in_process(collector), expected, name)  # pylint:disable=no-member
+
+
+class ZygoteTests(unittest.TestCase):
+    """Tests for forking the interval collectors from a zygote."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.zygote = tcollector.Zygote()  # pylint:disable=no-member
+        self.addCleanup(self.zygote.stop)
+        tcollector.ZYGOTE = self.zygote  # pylint:disable=no-member
+        self.addCleanup(setattr, tcollector, "ZYGOTE", None)
+
+    def spawn(self, body, interval=300):
+        filename = os.path.join(self.tmpdir, "col.py")
+        with open(filename, "w") as f:
+            f.write("#!%s\nimport os, sys, time\n%s" % (sys.executable, body))
+        os.chmod(filename, 0o755)
+        collector = tcollector.Collector("col.py", interval, filename)  # pylint:disable=no-member
+        tcollector.spawn_collector(collector)  # pylint:disable=no-member
+        self.addCleanup(collector.shutdown)
+        return collector
+
+    def test_spawn(self):
+        """The child is set up like a subprocess would be."""
+        collector = self.spawn("from collectors.lib import utils\n"
+                               "print('m 1 1 sid=%d' % os.getsid(0))\n"
+                               "print('oops', file=sys.stderr)\n"
+                               "sys.exit(13)\n")
+        self.assertIsInstance(collector.proc, tcollector.ZygoteChild)  # pylint:disable=no-member
+        pid = collector.proc.pid
+        self.assertNotEqual(pid, self.zygote.proc.pid)
+        self.assertEqual(collector.proc.wait(), 13)
+        with self.assertLogs("tcollector", "WARNING") as logs:
+            self.assertEqual(list(collector.collect()), ["m 1 1 sid=%d" % pid])
+        self.assertEqual(logs.output, ["WARNING:tcollector:col.py: oops"])
+        self.assertGreater(collector.to_json()["spawn_latency_ms"], 0)
+
+    def test_kill(self):
+        collector = self.spawn("time.sleep(30)\n")
+        tcollector.kill(collector.proc)  # pylint:disable=no-member
+        self.assertEqual(collector.proc.wait(), -signal.SIGTERM)
+
+    def test_exceptions(self):
+        collector = self.spawn("raise ValueError('oops')\n")
+        self.assertEqual(collector.proc.wait(), 1)
+        self.assertIn(b"ValueError: oops", collector.proc.stderr.read())
+
+    def test_long_lived_collectors_not_forked(self):
+        collector = self.spawn("print('m 1 1')\n", interval=0)
+        self.assertIsInstance(collector.proc, subprocess.Popen)
+
+    def test_zygote_gone(self):
+        """Without a zygote, collectors are spawned the usual way."""
+        self.zygote.proc.kill()
+        self.zygote.proc.wait()
+        with self.assertLogs("tcollector", "ERROR"):
+            collector = self.spawn("print('m 1 1')\n")
+        self.assertIsInstance(collector.proc, subprocess.Popen)
+        self.assertEqual(collector.proc.wait(), 0)
+        self.assertFalse(self.zygote.alive)
+
+    def test_restarted_on_change(self):
+        """Collectors get the new code of the modules the zygote preloaded."""
+        libdir = os.path.join(self.tmpdir, "lib")
+        os.mkdir(libdir)
+        module = os.path.join(libdir, "zygote_lib.py")
+        with open(module, "w") as f:
+            f.write("VALUE = 1\n")
+        environ = mock.patch.dict(os.environ, {"PYTHONPATH": libdir})
+        environ.start()
+        self.addCleanup(environ.stop)
+        zygote = tcollector.Zygote(("zygote_lib",))  # pylint:disable=no-member
+        self.addCleanup(zygote.stop)
+        tcollector.ZYGOTE = zygote  # pylint:disable=no-member
+        pid = zygote.proc.pid
+        body = "import zygote_lib\nprint('m 1 %d' % zygote_lib.VALUE)\n"
+        collector = self.spawn(body)
+        collector.proc.wait()
+        self.assertEqual(list(collector.collect()), ["m 1 1"])
+        self.assertEqual(list(zygote.preloaded), [module])
+        with open(module, "w") as f:
+            f.write("VALUE = 2\n")
+        os.utime(module, (time.time(), time.time() + 10))
+        with self.assertLogs("tcollector", "INFO"):
+            collector = self.spawn(body)
+        self.assertNotEqual(zygote.proc.pid, pid)
+        self.assertIsInstance(collector.proc, tcollector.ZygoteChild)  # pylint:disable=no-member
+        collector.proc.wait()
+        self.assertEqual(list(collector.collect()), ["m 1 2"])
+
+    def test_status_unknown(self):
+        """Children that exit after the zygote don't pass for successful."""
+        self.addCleanup(tcollector.COLLECTORS.clear)  # pylint:disable=no-member
+        collector = self.spawn("time.sleep(0.5)\nsys.exit(3)\n")
+        tcollector.register_collector(collector)  # pylint:disable=no-member
+        self.zygote.proc.kill()
+        with self.assertLogs("tcollector", "ERROR"):
+            self.assertEqual(collector.proc.wait(), tcollector.UNKNOWN_EXIT_STATUS)  # pylint:disable=no-member
+        list(collector.collect())
+        with self.assertLogs("tcollector", "WARNING") as logs:
+            tcollector.reap_children()  # pylint:disable=no-member
+        self.assertIn("unknown status", logs.output[0])
+        self.assertFalse(collector.dead)
+        self.assertIsNot(tcollector.COLLECTORS["col.py"], collector)  # pylint:disable=no-member
+
+    def test_statuses_forgotten(self):
+        """We don't keep the statuses of children nobody polls."""
+        collector = self.spawn("sys.exit(0)\n")
+        pid = collector.proc.pid
+        collector.proc.stdout.close()
+        collector.proc.stderr.close()
+        collector.proc = None
+        deadline = time.time() + 5
+        while pid not in self.zygote.statuses and time.time() < deadline:
+            self.zygote.read_messages(0.1)
+        self.assertIn(pid, self.zygote.statuses)
+        self.spawn("sys.exit(0)\n")
+        self.assertNotIn(pid, self.zygote.statuses)
+
+
+class SchedulerTests(unittest.TestCase):
+    """Tests for the Scheduler of the collectors."""
+
+    def setUp(self):
+        self.scheduler = tcollector.Scheduler("myhost")  # pylint:disable=no-member
+        tcollector.SCHEDULER = self.scheduler  # pylint:disable=no-member
+        self.addCleanup(setattr, tcollector, "SCHEDULER", None)
+        self.addCleanup(tcollector.COLLECTORS.clear)  # pylint:disable=no-member
+
+    def collector(self, name, interval=60, lastspawn=0):
+        collector = tcollector.Collector(name, interval, name, lastspawn=lastspawn)  # pylint:disable=no-member
+        tcollector.register_collector(collector)  # pylint:disable=no-member
+        return collector
+
+    def test_phase(self):
+        """Collectors are spread over their interval, the same way every time."""
+        phases = [self.scheduler.phase(self.collector("c%d" % i)) for i in range(100)]
+        self.assertTrue(all(0 <= phase < 60 for phase in phases))
+        self.assertGreater(len(set(int(phase / 10) for phase in phases)), 5)
+        other = tcollector.Scheduler("otherhost")  # pylint:disable=no-member
+        collector = tcollector.COLLECTORS["c0"]  # pylint:disable=no-member
+        self.assertEqual(tcollector.Scheduler("myhost").phase(collector), phases[0])  # pylint:disable=no-member
+        self.assertNotEqual(other.phase(collector), phases[0])
+
+    def test_add(self):
+        """New collectors start soon, later runs stick to their slot."""
+        now = time.time()
+        collector = self.collector("c", interval=600)
+        self.assertLessEqual(now, collector.nextdue)
+        self.assertLess(collector.nextdue, now + tcollector.SCHEDULE_SPREAD + 1)  # pylint:disable=no-member
+
+        slot = self.scheduler.next_slot(collector, 1000000)
+        self.assertEqual(self.scheduler.phase(collector), slot % 600)
+        collector.lastspawn = int(slot)
+        self.scheduler.add(collector, now=slot + 2)
+        self.assertAlmostEqual(collector.nextdue, slot + 600)
+        # Even when the last run ended after its slot.
+        self.scheduler.add(collector, now=slot + 900)
+        self.assertAlmostEqual(collector.nextdue, slot + 1200)
+
+        self.assertAlmostEqual(self.collector("l", interval=0).nextdue, time.time(), places=1)
+        # Long-lived collectors that exited aren't restarted right away.
+        collector = tcollector.Collector("l", 0, "l", lastspawn=int(now))  # pylint:disable=no-member
+        self.scheduler.add(collector, now=now + 1)
+        self.assertEqual(collector.nextdue, int(now) + tcollector.HOUSEKEEPING_INTERVAL)  # pylint:disable=no-member
+        self.scheduler.add(collector, now=now + 100)
+        self.assertEqual(collector.nextdue, now + 100)
+
+    def test_pop_due(self):
+        """Only the latest entry of a registered collector counts."""
+        first = self.collector("a")
+        second = self.collector("b")
+        self.scheduler.schedule(first, 10)
+        self.scheduler.schedule(first, 20)
+        self.scheduler.schedule(second, 15)
+        replaced = self.collector("c")
+        self.scheduler.schedule(replaced, 5)
+        third = self.collector("c")
+        self.scheduler.schedule(third, 25)
+        self.assertEqual(self.scheduler.next_due(), 15)
+        self.assertEqual(self.scheduler.pop_due(20), [(15, second), (20, first)])
+        self.assertEqual(self.scheduler.pop_due(20), [])
+        self.assertEqual(self.scheduler.next_due(), 25)
+
+    def test_spawn_children(self):
+        """Due collectors are spawned, then killed if still running next time."""
+        collector = self.collector("sleep", interval=1)
+        collector.filename = "/bin/sleep"
+        self.addCleanup(collector.shutdown)
+        self.scheduler.schedule(collector, time.time())
+        with self.assertLogs("tcollector", "INFO"):
+            tcollector.spawn_children()  # pylint:disable=no-member
+        # /bin/sleep with no arguments exits right away.
+        self.assertIsNotNone(collector.proc)
+        self.assertEqual(collector.proc.wait(), 1)
+        self.assertLessEqual(collector.schedule_lag, 1)
+        self.assertGreater(collector.nextdue, time.time())
+
+        collector.proc = subprocess.Popen(["sleep", "30"], preexec_fn=os.setsid)
+        self.scheduler.schedule(collector, time.time())
+        with self.assertLogs("tcollector", "WARNING"):
+            tcollector.spawn_children()  # pylint:disable=no-member
+        self.assertEqual(collector.killstate, 1)
+        self.assertEqual(collector.nextdue, collector.nextkill)
+        self.assertEqual(collector.proc.wait(), -signal.SIGTERM)
+
+    def test_reap_after_output_read(self):
+        """Collectors aren't reaped before we've read what they printed."""
+        collector = self.collector("pwd", interval=0)
+        collector.filename = "/bin/pwd"
+        with self.assertLogs("tcollector", "INFO"):
+            tcollector.spawn_children()  # pylint:disable=no-member
+        collector.proc.wait()
+        tcollector.reap_children()  # pylint:disable=no-member
+        self.assertIs(tcollector.COLLECTORS["pwd"], collector)  # pylint:disable=no-member
+        self.assertEqual(list(collector.collect()), [os.getcwd()])
+        tcollector.reap_children()  # pylint:disable=no-member
+        self.assertIsNot(tcollector.COLLECTORS["pwd"], collector)  # pylint:disable=no-member
+
+    def test_startup_waves(self):
+        """Long-lived collectors start first, then by priority, a few at a time."""
+        self.scheduler.concurrency = 2
+        collectors = {}
+        for name, interval, priority in (("a", 60, "low"), ("b", 60, "normal"),
+                                         ("c", 0, "normal"), ("d", 60, "high"),
+                                         ("e", 0, "low")):
+            collector = tcollector.Collector(name, interval, name)  # pylint:disable=no-member
+            collector.priority = priority
+            tcollector.register_collector(collector)  # pylint:disable=no-member
+            collectors[name] = collector
+        self.assertIsNone(self.scheduler.pop_due(time.time()) or None)
+
+        def wave(now):
+            self.scheduler.start_next_wave(now)
+            return sorted(col.name for _, col in self.scheduler.pop_due(now))
+
+        now = time.time()
+        self.assertEqual(wave(now), ["c", "e"])
+        self.assertEqual(wave(now), [])
+        collectors["c"].frame_lines(b"m 1 1\n")
+        self.assertGreater(collectors["c"].first_datapoint, 0)
+        self.assertEqual(wave(now), ["d"])
+        collectors["d"].dead = True
+        self.assertEqual(wave(now), ["b"])
+        self.assertEqual(wave(now + tcollector.STARTUP_TIMEOUT), ["a"])  # pylint:disable=no-member
+        self.assertEqual(self.scheduler.waiting, [])
+
+    def test_time_to_first_datapoint(self):
+        collector = self.collector("pwd", interval=0)
+        collector.filename = "/bin/pwd"
+        with self.assertLogs("tcollector", "INFO"):
+            tcollector.spawn_children()  # pylint:disable=no-member
+        self.assertIsNone(collector.to_json()["time_to_first_datapoint_ms"])
+        collector.proc.wait()
+        list(collector.collect())
+        ttfd = collector.to_json()["time_to_first_datapoint_ms"]
+        self.assertGreater(ttfd, 0)
+        tcollector.reap_children()  # pylint:disable=no-member
+        self.assertEqual(tcollector.COLLECTORS["pwd"].to_json()["time_to_first_datapoint_ms"],  # pylint:disable=no-member
+                         ttfd)
+
+    def test_dead_collectors_retried(self):
+        collector = self.collector("false", interval=0)
+        collector.filename = "/bin/false"
+        with self.assertLogs("tcollector", "INFO"):
+            tcollector.spawn_children()  # pylint:disable=no-member
+        collector.proc.wait()
+        list(collector.collect())
+        with self.assertLogs("tcollector", "WARNING"):
+            tcollector.reap_children()  # pylint:disable=no-member
+        self.assertTrue(collector.dead)
+        self.assertEqual(collector.nextdue,
+                         collector.lastspawn + tcollector.DEAD_COLLECTOR_RETRY)  # pylint:disable=no-member
+        self.assertEqual(list(tcollector.all_valid_collectors()), [])  # pylint:disable=no-member
+        collector.lastspawn -= tcollector.DEAD_COLLECTOR_RETRY + 1  # pylint:disable=no-member
+        self.assertEqual(list(tcollector.all_valid_collectors()), [collector])  # pylint:disable=no-member
+
+
+class MainLoopTests(unittest.TestCase):
+    """Tests for the main loop."""
+
+    def test_without_main(self):
+        """It can be run directly, as the EOS agent does."""
+        cdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cdir)
+        os.mkdir(os.path.join(cdir, "0"))
+        os.symlink("/bin/pwd", os.path.join(cdir, "0", "pwd"))
+        options = tcollector.parse_cmdline(["tcollector.py", "-c", cdir])[0]  # pylint:disable=no-member
+        self.addCleanup(setattr, tcollector, "SCHEDULER", None)
+        self.addCleanup(setattr, tcollector, "ALIVE", True)
+        self.addCleanup(tcollector.COLLECTORS.clear)  # pylint:disable=no-member
+        spawn_children = tcollector.spawn_children  # pylint:disable=no-member
+
+        def spawn_once():
+            spawn_children()
+            tcollector.ALIVE = False  # pylint:disable=no-member
+
+        with mock.patch.object(tcollector, "spawn_children", spawn_once), \
+                self.assertLogs("tcollector", "INFO"):
+            tcollector.main_loop(options, {}, None, {"host": "myhost"})  # pylint:disable=no-member
+        collector = tcollector.COLLECTORS["pwd"]  # pylint:disable=no-member
+        self.addCleanup(collector.shutdown)
+        self.assertIsNotNone(collector.proc)
+        self.assertEqual(tcollector.SCHEDULER.host, "myhost")  # pylint:disable=no-member
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only on Linux")
+class DirectoryWatcherTests(unittest.TestCase):
+    """Tests for picking up changes to the collectors with inotify."""
+
+    def setUp(self):
+        self.cdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cdir)
+        os.mkdir(os.path.join(self.cdir, "60"))
+        os.mkdir(os.path.join(self.cdir, "etc"))
+        self.watcher = tcollector.DirectoryWatcher()  # pylint:disable=no-member
+        self.addCleanup(self.watcher.close)
+        tcollector.watch_collector_dirs(self.watcher, self.cdir)  # pylint:disable=no-member
+        self.addCleanup(tcollector.COLLECTORS.clear)  # pylint:disable=no-member
+        self.options = tcollector.parse_cmdline(["tcollector.py", "-c", self.cdir])[0]  # pylint:disable=no-member
+        self.modules = {}
+
+    def apply_events(self):
+        events = self.watcher.wait(5)
+        self.assertTrue(events)
+        return tcollector.apply_watch_events(events, self.options, self.modules, None, {})  # pylint:disable=no-member
+
+    def write(self, path, mode=0o755):
+        with open(os.path.join(self.cdir, path), "w") as f:
+            os.fchmod(f.fileno(), mode)
+            f.write("#!/bin/sh\n")
+
+    def test_collectors(self):
+        self.write("60/col.sh")
+        self.assertFalse(self.apply_events())
+        collector = tcollector.COLLECTORS["col.sh"]  # pylint:disable=no-member
+        self.assertEqual(collector.interval, 60)
+        self.assertEqual(collector.filename, os.path.join(self.cdir, "60/col.sh"))
+
+        os.chmod(collector.filename, 0o644)
+        with self.assertLogs("tcollector", "INFO") as logs:
+            self.assertFalse(self.apply_events())
+        self.assertEqual(logs.output, ["INFO:tcollector:collector col.sh removed from the "
+                                       "filesystem, forgetting"])
+        self.assertEqual(tcollector.COLLECTORS, {})  # pylint:disable=no-member
+
+        os.symlink("/bin/true", os.path.join(self.cdir, "60/true"))
+        self.assertFalse(self.apply_events())
+        self.assertIn("true", tcollector.COLLECTORS)  # pylint:disable=no-member
+
+    def test_rescan(self):
+        """New interval directories need a rescan, other files don't."""
+        self.write("README", mode=0o644)
+        self.assertFalse(self.apply_events())
+        os.mkdir(os.path.join(self.cdir, "0"))
+        self.assertTrue(self.apply_events())
+        os.rmdir(os.path.join(self.cdir, "60"))
+        self.assertTrue(self.apply_events())
+
+    def test_config_modules(self):
+        sys.path.append(os.path.join(self.cdir, "etc"))
+        self.addCleanup(sys.path.remove, os.path.join(self.cdir, "etc"))
+        self.addCleanup(sys.modules.pop, "watched_config", None)
+        self.write("etc/watched_config.py", mode=0o644)
+        with self.assertLogs("tcollector", "INFO"):
+            self.assertFalse(self.apply_events())
+        self.assertEqual(list(self.modules), [os.path.join(self.cdir, "etc/watched_config.py")])
+
 
 class CollectorsTests(unittest.TestCase):
 
@@ -113,6 +1114,18 @@ class CollectorsTests(unittest.TestCase):
             "/collectors/available"
         check_access_rights(collectors_path)
 
+    def test_frame_lines(self):
+        """Lines split across reads are put back together, blank ones dropped."""
+        collector = tcollector.Collector("c", 0, "c")  # pylint:disable=no-member
+        collector.frame_lines(b"mymetric 1 1 a=b\n\n  \nmymetric 2")
+        self.assertEqual(list(collector.datalines), ["mymetric 1 1 a=b"])
+        collector.frame_lines(b" 2 a=b")
+        self.assertEqual(list(collector.datalines), ["mymetric 1 1 a=b"])
+        collector.frame_lines(b"\nmymetric 3 3 a=b\r\nmymetric")
+        self.assertEqual(list(collector.datalines),
+                         ["mymetric 1 1 a=b", "mymetric 2 2 a=b", "mymetric 3 3 a=b"])
+        self.assertEqual(collector.buffer, b"mymetric")
+
     def test_json(self):
         """A collector can be serialized to JSON."""
         collector = tcollector.Collector("myname", 17, "myname.py", mtime=23, lastspawn=15)  # pylint:disable=no-member
@@ -127,11 +1140,21 @@ class CollectorsTests(unittest.TestCase):
                           "lastspawn": 15,
                           "killstate": 2,
                           "nextkill": 8,
+                          "nextdue": 0,
                           "lines_sent": 10,
                           "lines_received": 65,
                           "lines_invalid": 7,
                           "last_datapoint": collector.last_datapoint,
-                          "dead": False})
+                          "dead": False,
+                          "priority": "normal",
+                          "bytes_read": 0,
+                          "budget_exhausted": 0,
+                          "in_process": False,
+                          "spawn_latency_ms": 0,
+                          "schedule_lag_ms": 0,
+                          "time_to_first_datapoint_ms": None,
+                          "lines_backlog": 0,
+                          "pipe_backlog_bytes": 0})
 
 
 class StatusServerTests(unittest.TestCase):
@@ -148,10 +1171,25 @@ class StatusServerTests(unittest.TestCase):
         thread = threading.Thread(target=server.serve_forever, daemon=True)
         thread.start()
 
-        with tcollector.urlopen("http://127.0.0.1:32025") as resource:
+        with urlopen("http://127.0.0.1:32025") as resource:
             result = resource.read()
         self.assertEqual(json.loads(result), [c.to_json() for c in collectors.values()])
 
+    def test_endpoints(self):
+        """Extra endpoints serve whatever their function returns."""
+        reader = tcollector.ReaderThread(300, 600, False)  # pylint:disable=no-member
+        reader.process_line(tcollector.Collector("c", 0, "c"), "mymetric 100 2 a=b")  # pylint:disable=no-member
+        server = tcollector.StatusServer("127.0.0.1", 32026, {},  # pylint:disable=no-member
+                                         {"/reader": reader.to_json})
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        with urlopen("http://127.0.0.1:32026/reader") as resource:
+            result = json.loads(resource.read())
+        self.assertEqual(result["lines_collected"], 1)
+        self.assertEqual(result["dedup"]["series"], 1)
+        self.assertEqual(result["dedup"]["bytes"], reader.dedup.bytes)
+
 
 @unittest.skipUnless(flask, "Flask not installed")
 class SenderThreadHTTPTests(unittest.TestCase):
@@ -202,6 +1240,483 @@ class SenderThreadHTTPTests(unittest.TestCase):
         self.assertEqual(len(sender.sendq), 0)
 
 
+class FakeTSDHandler(BaseHTTPRequestHandler):
+    """Answers /api/put with the server's response_code, keeping the
+    connection open, and remembers which client port each request came
+    from and what it sent."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers["Content-Encoding"] == "gzip":
+            body = gzip.decompress(body)
+        self.server.bodies.append((self.headers["Content-Encoding"], json.loads(body)))
+        self.server.client_ports.append(self.client_address[1])
+        self.send_response(self.server.response_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPConnectionPoolTests(unittest.TestCase):
+    """Tests for keep-alive connections to the TSD."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTSDHandler)
+        self.server.response_code = 204
+        self.server.client_ports = []
+        self.server.bodies = []
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def mkSenderThread(self, **kwargs):
+        reader = tcollector.ReaderThread(1, 10, True)  # pylint:disable=no-member
+        sender = tcollector.SenderThread(  # pylint:disable=no-member
+            reader, False, [("127.0.0.1", self.port)], False, {},
+            http=True, http_api_path="api/put", **kwargs)
+        self.addCleanup(sender.http_pool.close_all)
+        return sender
+
+    def test_reuses_connection(self):
+        """Batches are sent over the same connection."""
+        sender = self.mkSenderThread()
+        for i in range(3):
+            sender.sendq.append("mymetric %d 12 a=b" % (100 + i))
+            sender.send_data()
+            self.assertEqual(sender.sendq, [])
+        self.assertEqual(len(set(self.server.client_ports)), 1)
+        self.assertEqual((sender.http_pool.connects, sender.http_pool.requests), (1, 3))
+
+    def test_reconnects(self):
+        """A connection closed under our feet is replaced transparently."""
+        sender = self.mkSenderThread()
+        sender.sendq.append("mymetric 100 12 a=b")
+        sender.send_data()
+        sender.http_pool.connections[("127.0.0.1", self.port)].sock.close()
+        sender.sendq.append("mymetric 101 12 a=b")
+        sender.send_data()
+        self.assertEqual(sender.sendq, [])
+        self.assertEqual(len(set(self.server.client_ports)), 2)
+
+    def test_errors(self):
+        """Bad data is dropped, but other errors are retried."""
+        sender = self.mkSenderThread()
+        self.server.response_code = 500
+        sender.sendq.append("mymetric 100 12 a=b")
+        sender.send_data()
+        self.assertEqual(len(sender.sendq), 1)
+        self.server.response_code = 400
+        sender.send_data()
+        self.assertEqual(len(sender.sendq), 0)
+        self.assertEqual(sender.http_pool.connects, 1)
+
+    def test_gzip(self):
+        """Only requests over the threshold are compressed."""
+        sender = self.mkSenderThread(http_gzip_level=6, http_gzip_min_bytes=500)
+        for count in (1, 20):
+            sender.sendq = ["mymetric %d 12 a=b" % (100 + i) for i in range(count)]
+            sender.send_data()
+        self.assertEqual([(encoding, len(body)) for encoding, body in self.server.bodies],
+                         [(None, 1), ("gzip", 20)])
+        self.assertLess(sender.http_sent_bytes, sender.http_body_bytes)
+
+    def test_ssl(self):
+        """Over TLS, the socket we connect is wrapped, so talking to a
+        plain HTTP server fails."""
+        pool = tcollector.HTTPConnectionPool(  # pylint:disable=no-member
+            ssl=True, dns_cache=tcollector.DNSCache())  # pylint:disable=no-member
+        self.addCleanup(pool.close_all)
+        with self.assertRaises(ssl.SSLError):
+            pool.request("127.0.0.1", self.port, "POST", "/api/put", b"[]", {})
+        self.assertEqual(pool.connects, 1)
+
+
+class DNSCacheTests(unittest.TestCase):
+    """Tests for resolving and connecting to the TSDs."""
+
+    def setUp(self):
+        # Stub out the DNS
+        self.getaddrinfo = tcollector.socket.getaddrinfo  # pylint:disable=no-member
+        self.lookups = []
+        self.answer = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 4242))]
+
+        def getaddrinfo(host, port, *args):
+            self.lookups.append(host)
+            if isinstance(self.answer, Exception):
+                raise self.answer
+            return self.answer
+        tcollector.socket.getaddrinfo = getaddrinfo  # pylint:disable=no-member
+
+    def tearDown(self):
+        tcollector.socket.getaddrinfo = self.getaddrinfo  # pylint:disable=no-member
+
+    def test_cached(self):
+        cache = tcollector.DNSCache(ttl=60)  # pylint:disable=no-member
+        self.assertEqual(self.answer, cache.resolve("tsd", 4242))
+        self.assertEqual(self.answer, cache.resolve("tsd", 4242))
+        self.assertEqual(["tsd"], self.lookups)
+        cache.entries[("tsd", 4242)] = (0, self.answer)
+        cache.resolve("tsd", 4242)
+        self.assertEqual(["tsd", "tsd"], self.lookups)
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_negative_caching(self):
+        cache = tcollector.DNSCache(ttl=60, negative_ttl=60)  # pylint:disable=no-member
+        self.answer = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        for _ in range(3):
+            with self.assertRaises(socket.gaierror) as raised:
+                cache.resolve("tsd", 4242)
+            self.assertEqual(socket.EAI_NONAME, raised.exception.errno)
+        self.assertEqual(["tsd"], self.lookups)
+
+    def test_stale_addresses_kept(self):
+        """When DNS goes down, we keep using the addresses we had."""
+        cache = tcollector.DNSCache(ttl=60)  # pylint:disable=no-member
+        addresses = cache.resolve("tsd", 4242)
+        cache.expire("tsd", 4242)
+        self.answer = socket.gaierror(socket.EAI_AGAIN, "Temporary failure")
+        self.assertEqual(addresses, cache.resolve("tsd", 4242))
+        self.assertEqual(addresses, cache.resolve("tsd", 4242))
+        self.assertEqual(["tsd", "tsd"], self.lookups)
+
+    def test_interleave_families(self):
+        v6 = [(socket.AF_INET6, 0, 0, '', ('::%d' % i, 1)) for i in range(3)]
+        v4 = [(socket.AF_INET, 0, 0, '', ('10.0.0.%d' % i, 1)) for i in range(2)]
+        self.assertEqual([v6[0], v4[0], v6[1], v4[1], v6[2]],
+                         tcollector.interleave_families(v6 + v4))  # pylint:disable=no-member
+        self.assertEqual([], tcollector.interleave_families([]))  # pylint:disable=no-member
+
+    def test_connect_race(self):
+        """Addresses that don't answer don't hold up those that do."""
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        # Nothing listens on this one, so it fails right away.
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        refused = closed.getsockname()
+        closed.close()
+        # TEST-NET-1 isn't routed: this hangs, or fails, depending on the host.
+        addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', address)
+                     for address in (("192.0.2.1", 4242), refused, server.getsockname())]
+        start = time.time()
+        sock, sockaddr = tcollector.connect_race(  # pylint:disable=no-member
+            addresses, timeout=10, delay=0.1)
+        sock.close()
+        self.assertEqual(server.getsockname(), sockaddr)
+        self.assertLess(time.time() - start, 5)
+
+    def test_connect_race_fails(self):
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        refused = closed.getsockname()
+        closed.close()
+        with self.assertRaises(ConnectionRefusedError):
+            tcollector.connect_race(  # pylint:disable=no-member
+                [(socket.AF_INET, socket.SOCK_STREAM, 6, '', refused)])
+
+
+class PutEncoderTests(unittest.TestCase):
+    """Tests for the JSON encoding of /api/put requests."""
+
+    def encode(self, lines, tags=(("host", "web01"),), maxtags=8):
+        encoder = tcollector.PutEncoder(list(tags), maxtags)  # pylint:disable=no-member
+        return json.loads(encoder.encode(lines))
+
+    def test_encode(self):
+        self.assertEqual(
+            self.encode(["mymetric 100 12 a=b c=d", "mymetric  0100 1.5e3"]),
+            [{"metric": "mymetric", "timestamp": 100, "value": 12.0,
+              "tags": {"host": "web01", "a": "b", "c": "d"}},
+             {"metric": "mymetric", "timestamp": 100, "value": 1500.0, "tags": {"host": "web01"}}])
+        self.assertEqual(self.encode(["mymetric 100 12"], tags=()),
+                         [{"metric": "mymetric", "timestamp": 100, "value": 12.0, "tags": {}}])
+        # Same as json.dumps(), even though the TSD won't take it.
+        self.assertTrue(math.isnan(self.encode(["mymetric 100 nan"])[0]["value"]))
+
+    def test_escaping(self):
+        """Tags that aren't safe to paste into JSON as-is are escaped."""
+        self.assertEqual(self.encode(['my"metric 100 1 a=\\'], tags=[("dc", 'a "b"')]),
+                         [{"metric": 'my"metric', "timestamp": 100, "value": 1.0,
+                           "tags": {"dc": 'a "b"', "a": "\\"}}])
+
+    def test_global_tags_overridden(self):
+        self.assertEqual(self.encode(["mymetric 100 1 a=b host=web02"])[0]["tags"],
+                         {"host": "web02", "a": "b"})
+        # Not just the last of two "host" keys.
+        encoder = tcollector.PutEncoder([("host", "web01")], 8)  # pylint:disable=no-member
+        self.assertEqual(encoder.encode(["mymetric 100 1 host=web02"]),
+                         b'[{"metric":"mymetric","timestamp":100,"value":1.0,'
+                         b'"tags":{"host":"web02"}}]')
+
+    def test_repeated_tags(self):
+        """A repeated tag is sent once, with its last value."""
+        encoder = tcollector.PutEncoder([("host", "web01")], 8)  # pylint:disable=no-member
+        self.assertEqual(encoder.encode(["mymetric 100 1 a=b  c=d a=e"]),
+                         b'[{"metric":"mymetric","timestamp":100,"value":1.0,'
+                         b'"tags":{"host":"web01","a":"e","c":"d"}}]')
+
+    def test_maxtags(self):
+        """Tags over the limit are dropped, the global tags are kept."""
+        datapoint = self.encode(["mymetric 100 1 a=1 b=2 c=3 host=web02"], maxtags=3)[0]
+        self.assertEqual(datapoint["tags"], {"host": "web02", "a": "1", "b": "2"})
+
+    def test_invalid_lines_skipped(self):
+        self.assertEqual(len(self.encode(["mymetric 100.5 1", "mymetric", "mymetric 100 x",
+                                          "mymetric 100 1"])), 1)
+
+
+class FlushPolicyTests(unittest.TestCase):
+    """Tests for deciding when to send batches of datapoints."""
+
+    def mkSenderThread(self, policy):
+        reader = tcollector.ReaderThread(1, 10, True)  # pylint:disable=no-member
+        return tcollector.SenderThread(  # pylint:disable=no-member
+            reader, True, [("localhost", 4242)], False, {}, flush_policy=policy)
+
+    def test_linger_follows_rtt(self):
+        policy = tcollector.FlushPolicy(min_linger=1, max_linger=5)  # pylint:disable=no-member
+        self.assertEqual(policy.linger(), 1)
+        policy.record_send(100, 101, 101.2)
+        self.assertAlmostEqual(policy.linger(), 2)
+        policy.record_send(100, 101, 111)
+        self.assertEqual(policy.linger(), 5)
+        self.assertEqual(policy.latency_percentiles((50, 100)), {50: 11, 100: 11})
+
+    def test_full_batch_sent_right_away(self):
+        sender = self.mkSenderThread(tcollector.FlushPolicy(  # pylint:disable=no-member
+            max_points=3, min_linger=10, max_linger=10))
+        for i in range(5):
+            sender.reader.readerq.nput("mymetric %d 1" % (100 + i))
+        start = time.time()
+        self.assertTrue(sender.fill_sendq())
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(sender.sendq), 3)
+
+        sender.sendq = []
+        sender.flush_policy.max_bytes = 10
+        self.assertTrue(sender.fill_sendq())
+        self.assertEqual(sender.sendq, ["mymetric 103 1"])
+
+    def test_small_batch_lingers(self):
+        sender = self.mkSenderThread(tcollector.FlushPolicy(  # pylint:disable=no-member
+            min_linger=0.2, max_linger=0.2))
+        sender.reader.readerq.nput("mymetric 100 1")
+        threading.Timer(0.1, sender.reader.readerq.nput, ["mymetric 101 1"]).start()
+        start = time.time()
+        self.assertTrue(sender.fill_sendq())
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(sender.sendq, ["mymetric 100 1", "mymetric 101 1"])
+
+
+class RateLimitTests(unittest.TestCase):
+    """Tests for limiting how fast we send to the TSD."""
+
+    def mkSenderThread(self, **kwargs):
+        reader = tcollector.ReaderThread(1, 10, True)  # pylint:disable=no-member
+        return tcollector.SenderThread(  # pylint:disable=no-member
+            reader, True, [("localhost", 4242)], False, {}, **kwargs)
+
+    def test_token_bucket(self):
+        bucket = tcollector.TokenBucket(100)  # pylint:disable=no-member
+        self.assertAlmostEqual(bucket.available(), 100)
+        self.assertEqual(bucket.delay(), 0)
+        # A batch bigger than the bucket puts it in debt.
+        bucket.take(150)
+        self.assertAlmostEqual(bucket.delay(), 0.5, places=2)
+        bucket.last_refill -= 1
+        self.assertAlmostEqual(bucket.available(), 50, places=0)
+        bucket.last_refill -= 10
+        self.assertEqual(bucket.available(), 100)
+
+    def test_throttle(self):
+        sender = self.mkSenderThread(send_rate_points=10, send_rate_bytes=1000)
+        sleeps = []
+        time_sleep = tcollector.time.sleep  # pylint:disable=no-member
+        tcollector.time.sleep = sleeps.append  # pylint:disable=no-member
+        try:
+            # Going over the limit is fine once, but the next batch has to
+            # wait for the debt to be paid back.
+            sender.sendq = ["mymetric %d 1" % i for i in range(15)]
+            sender.throttle()
+            self.assertEqual(sleeps, [])
+            sender.sendq = ["mymetric 15 1"]
+            sender.throttle()
+        finally:
+            tcollector.time.sleep = time_sleep  # pylint:disable=no-member
+        self.assertEqual(len(sleeps), 1)
+        self.assertAlmostEqual(sleeps[0], 0.5, places=2)
+        state = sender.rate_limits_to_json()
+        self.assertAlmostEqual(state["points"]["tokens"], -6, places=0)
+        self.assertAlmostEqual(state["bytes"]["tokens"], 1000 - 12 * 10 - 13 * 6, places=0)
+        self.assertAlmostEqual(state["throttled_seconds"], 0.5, places=2)
+
+    def test_batches_fit_the_burst(self):
+        sender = self.mkSenderThread(send_rate_points=3)
+        for i in range(5):
+            sender.reader.readerq.nput("mymetric %d 1" % (100 + i))
+        self.assertTrue(sender.fill_sendq())
+        self.assertEqual(len(sender.sendq), 3)
+
+    def test_live_data_first(self):
+        """Spooled lines only get what the rate limit leaves of the live ones."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spool = tcollector.DiskSpool(directory, 1024 * 1024)  # pylint:disable=no-member
+        self.addCleanup(spool.close)
+        sender = self.mkSenderThread(send_rate_points=10, spool=spool)
+        spool.append(["mymetric %d 1 spooled=yes" % i for i in range(10)])
+        for i in range(8):
+            sender.reader.readerq.nput("mymetric %d 1" % i)
+        sender.replay_spool()
+        self.assertEqual(sender.sendq, ["mymetric 0 1 spooled=yes", "mymetric 1 1 spooled=yes"])
+        sender.sendq = []
+        sender.reader.readerq.nput("mymetric 8 1")
+        sender.reader.readerq.nput("mymetric 9 1")
+        sender.replay_spool()
+        self.assertEqual(sender.sendq, [])
+
+
+class TSDResponseReaderTests(unittest.TestCase):
+    """Tests for reading the responses of a TSD over telnet."""
+
+    def setUp(self):
+        self.tsd, self.sock = socket.socketpair()
+        self.addCleanup(self.tsd.close)
+        self.addCleanup(self.sock.close)
+        reader = tcollector.ReaderThread(1, 10, True)  # pylint:disable=no-member
+        self.sender = tcollector.SenderThread(  # pylint:disable=no-member
+            reader, False, [("localhost", 4242)], False, {})
+        self.sender.pick_connection()
+        self.sender.tsd = self.sock
+        self.sender.response_reader = tcollector.TSDResponseReader(  # pylint:disable=no-member
+            self.sock, self.sender.tsd_errors)
+        self.sender.response_reader.start()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_errors_counted_by_metric(self):
+        self.tsd.sendall(b"put: unknown metric: No such name for 'metrics': 'foo.bar'\n"
+                         b"put: illegal argument: Invalid metric name (\"foo.bar\"): bad\n"
+                         b"put: illegal argument: not a valid value: x\nnet.opentsdb ")
+        self.wait_for(lambda: sum(self.sender.tsd_errors.values()) == 3)
+        self.assertEqual(self.sender.tsd_errors, {"foo.bar": 2, "unknown": 1})
+
+    def test_liveness(self):
+        """The version command doesn't block, but the TSD has to answer it."""
+        self.assertTrue(self.sender.verify_conn())
+        self.assertEqual(self.tsd.recv(100), b"version\n")
+        self.assertTrue(self.sender.verify_conn())
+        self.tsd.sendall(b"net.opentsdb built at revision abc\n")
+        self.wait_for(lambda: self.sender.response_reader.last_received > 0)
+        self.sender.last_verify = 0
+        self.assertTrue(self.sender.verify_conn())
+        # No answer this time.
+        reader = self.sender.response_reader
+        timeout = tcollector.TSD_RESPONSE_TIMEOUT  # pylint:disable=no-member
+        self.sender.version_sent = time.time() - timeout
+        reader.last_received = self.sender.version_sent - 1
+        self.assertFalse(self.sender.verify_conn())
+        self.assertIsNone(self.sender.tsd)
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+
+    def test_closed_connection(self):
+        self.tsd.close()
+        self.sender.response_reader.join(5)
+        self.assertFalse(self.sender.verify_conn())
+        self.assertIsNone(self.sender.tsd)
+
+    def test_version_round_trip(self):
+        """The answer to the version command tells us how fast the TSD is."""
+        self.sender.report_stats = lambda: None
+        self.assertTrue(self.sender.verify_conn())
+        self.assertEqual(b'version\n', self.tsd.recv(100))
+        # Put errors don't count, they answer earlier puts.
+        self.tsd.sendall(b'put: illegal argument: foo\n')
+        self.wait_for(lambda: self.sender.response_reader.last_received)
+        self.assertTrue(self.sender.verify_conn())
+        self.assertIsNone(self.sender.health[("localhost", 4242)].latency)
+        self.tsd.sendall(b'net.opentsdb built at revision x\n')
+        self.wait_for(lambda: self.sender.response_reader.last_answer)
+        self.assertTrue(self.sender.verify_conn())
+        self.assertIsNotNone(self.sender.health[("localhost", 4242)].latency)
+        self.assertEqual(1, self.sender.health[("localhost", 4242)].successes)
+
+
+class ShardRouterTests(unittest.TestCase):
+    """Tests for spreading series over several TSD connections."""
+
+    def mkRouter(self, shards):
+        reader = tcollector.ReaderThread(1, 10, True)  # pylint:disable=no-member
+        senders = []
+        for i in range(shards):
+            sender = tcollector.SenderThread(  # pylint:disable=no-member
+                reader, False, [("localhost", 4242 + i)], False, {},
+                queue=tcollector.ReaderQueue(100), shard=i)  # pylint:disable=no-member
+            sender.tsd = True  # Connected, as far as the router can tell.
+            senders.append(sender)
+        return tcollector.ShardRouter(reader, senders)  # pylint:disable=no-member
+
+    def test_ring_is_consistent(self):
+        keys = ["mymetric a=%d" % i for i in range(1000)]
+        ring = tcollector.HashRing([0, 1, 2])  # pylint:disable=no-member
+        before = dict((key, ring.get(key)) for key in keys)
+        self.assertEqual(set(before.values()), set([0, 1, 2]))
+        # The keys are spread about evenly.
+        for member in (0, 1, 2):
+            self.assertGreater(list(before.values()).count(member), 250)
+        ring = tcollector.HashRing([0, 2])  # pylint:disable=no-member
+        for key in keys:
+            if before[key] != 1:
+                self.assertEqual(ring.get(key), before[key])
+
+    def test_series_stick_to_a_shard(self):
+        router = self.mkRouter(3)
+        router.route(["mymetric %d 1 a=%d" % (100 + i, i % 10) for i in range(100)])
+        for shard in router.shards:
+            lines = shard.queue.get_batch()
+            series = set(line.split()[3] for line in lines)
+            # Each series went to a single shard, in order.
+            self.assertEqual(len(lines), 10 * len(series))
+            self.assertEqual(lines, sorted(lines))
+            self.assertEqual(shard.lines_routed, len(lines))
+
+    def test_rebalance(self):
+        """A shard that's down for too long is taken out of the ring and
+        what's queued for it goes to the others, until it's back."""
+        router = self.mkRouter(3)
+        lines = ["mymetric 100 1 a=%d" % i for i in range(60)]
+        router.route(lines)
+        down = router.shards[1]
+        queued = down.queue.qsize()
+        down.tsd = None
+        router.check_shards()
+        self.assertEqual(router.healthy, set([0, 1, 2]))
+        router.down_since[1] -= tcollector.SHARD_FAILOVER_DELAY  # pylint:disable=no-member
+        router.check_shards()
+        self.assertEqual(router.healthy, set([0, 2]))
+        self.assertEqual(down.queue.qsize(), 0)
+        self.assertEqual(sum(shard.queue.qsize() for shard in router.shards), 60)
+        router.route(lines)
+        self.assertEqual(down.lines_routed, queued)
+        down.tsd = True
+        router.check_shards()
+        self.assertEqual((router.healthy, router.rebalances), (set([0, 1, 2]), 2))
+
+
 class NamespacePrefixTests(unittest.TestCase):
     """Tests for metric namespace prefix."""
 
@@ -216,6 +1731,68 @@ class NamespacePrefixTests(unittest.TestCase):
         self.assertEqual(collector.lines_invalid, 0)
 
 
+class DiskSpoolTests(unittest.TestCase):
+    """Tests for spooling datapoints to disk."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def mkSpool(self, max_bytes=1000):
+        spool = tcollector.DiskSpool(  # pylint:disable=no-member
+            self.directory, max_bytes, segment_bytes=50)
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_replays_oldest_first(self):
+        """Lines come back in order, and survive a restart."""
+        spool = self.mkSpool()
+        lines = ["mymetric %d 1 a=b" % i for i in range(10)]
+        spool.append(lines[:5])
+        spool.append(lines[5:])
+        self.assertEqual(spool.read(7), lines[:7])
+        spool.close()
+        # Segments we've read completely are gone, the rest is picked up,
+        # including what we've already read of the oldest one.
+        spool = self.mkSpool()
+        self.assertEqual(spool.read(100), lines[5:])
+        self.assertEqual((len(spool), spool.bytes), (0, 0))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_discards_oldest(self):
+        """The oldest segments go first when the spool is full."""
+        spool = self.mkSpool(max_bytes=100)
+        lines = ["mymetric %d 1 a=b" % i for i in range(100, 120)]
+        for line in lines:
+            spool.append([line])
+        self.assertLessEqual(spool.bytes, 100)
+        self.assertGreater(spool.bytes_discarded, 0)
+        replayed = spool.read(100)
+        self.assertEqual(replayed, lines[-len(replayed):])
+
+    def test_sender_spills_and_replays(self):
+        """The SenderThread spools what it can't send and replays it at the
+        configured rate."""
+        reader = tcollector.ReaderThread(1, 10, True)  # pylint:disable=no-member
+        sender = tcollector.SenderThread(  # pylint:disable=no-member
+            reader, True, [("localhost", 4242)], False, {},
+            spool=self.mkSpool(), spool_replay_rate=2)
+        sender.sendq.append("mymetric 100 1 a=b")
+        for i in range(101, 105):
+            reader.readerq.nput("mymetric %d 1 a=b" % i)
+        sender.spill_to_spool()
+        self.assertEqual((sender.sendq, reader.readerq.qsize()), ([], 0))
+        sender.last_replay = time.time() - 1
+        sender.replay_spool()
+        self.assertEqual(sender.sendq, ["mymetric 100 1 a=b", "mymetric 101 1 a=b"])
+        # Nothing is replayed while we're failing to send.
+        sender.sendq = []
+        sender.send_failed = True
+        sender.last_replay = time.time() - 10
+        sender.replay_spool()
+        self.assertEqual(sender.sendq, [])
+
+
 class TSDBlacklistingTests(unittest.TestCase):
     """
     Tests of TSD blacklisting logic
@@ -274,6 +1851,72 @@ class TSDBlacklistingTests(unittest.TestCase):
         sender.pick_connection()
         self.assertEqual(tsd1, (sender.host, sender.port))
 
+    def test_pickFastestConnection(self):
+        tsd1 = ("localhost", 4242)
+        tsd2 = ("localhost", 4243)
+        tsd3 = ("localhost", 4244)
+        sender = self.mkSenderThread([tsd1, tsd2, tsd3])
+        sender.health[tsd1].record_latency(0.5)
+        sender.health[tsd2].record_latency(0.01)
+        sender.health[tsd3].record_latency(0.012)
+        # The slow host is skipped, the others are close enough to share.
+        picked = []
+        for _ in range(4):
+            sender.pick_connection()
+            picked.append((sender.host, sender.port))
+        self.assertEqual([tsd2, tsd3, tsd2, tsd3], picked)
+
+    def test_errorsLowerTheScore(self):
+        tsd1 = ("localhost", 4242)
+        tsd2 = ("localhost", 4243)
+        sender = self.mkSenderThread([tsd1, tsd2])
+        sender.health[tsd1].record_latency(0.01)
+        sender.health[tsd2].record_latency(0.02)
+        sender.health[tsd1].record_error()
+        sender.health[tsd1].record_error()
+        for _ in range(3):
+            sender.pick_connection()
+            self.assertEqual(tsd2, (sender.host, sender.port))
+        # Successes bring it back.
+        for _ in range(20):
+            sender.health[tsd1].record_latency(0.01)
+        sender.pick_connection()
+        self.assertEqual(tsd1, (sender.host, sender.port))
+
+    def test_blacklistExpiresWithSlowStart(self):
+        tsd1 = ("localhost", 4242)
+        tsd2 = ("localhost", 4243)
+        sender = self.mkSenderThread([tsd1, tsd2])
+        sender.health[tsd1].record_latency(0.01)
+        sender.health[tsd2].record_latency(0.014)
+        sender.pick_connection()
+        self.assertEqual(tsd1, (sender.host, sender.port))
+        sender.blacklist_connection()
+        sender.pick_connection()
+        self.assertEqual(tsd2, (sender.host, sender.port))
+        self.assertIn(tsd1, sender.blacklisted_hosts)
+
+        # Once the blacklisting expires, the host is back but still looks
+        # slow for a while.
+        now = time.time()
+        blacklist_time = tcollector.BLACKLIST_TIME  # pylint:disable=no-member
+        sender.health[tsd1].blacklisted = now - blacklist_time
+        sender.health[tsd1].record_latency(0.01)
+        sender.health[tsd1].error_rate = 0
+        sender.pick_connection()
+        self.assertNotIn(tsd1, sender.blacklisted_hosts)
+        self.assertEqual(tsd2, (sender.host, sender.port))
+        hosts = sender.hosts_to_json()
+        self.assertGreater(hosts["localhost:4242"]["slow_start"], 1)
+        self.assertFalse(hosts["localhost:4242"]["blacklisted"])
+
+        # Once the slow start is over, it is the best one again.
+        slow_start_time = tcollector.SLOW_START_TIME  # pylint:disable=no-member
+        sender.health[tsd1].readmitted = now - slow_start_time
+        sender.pick_connection()
+        self.assertEqual(tsd1, (sender.host, sender.port))
+        self.assertEqual(1, sender.hosts_to_json()["localhost:4242"]["slow_start"])
+
 
 if __name__ == '__main__':
     import logging